@@ -8,7 +8,28 @@ from orchestra.contrib.resources import ServiceMonitor
 from . import settings
 
 
-class MySQLController(ServiceController):
+class MySQLSessionMixin(object):
+    """
+    Runs all the SQL statements of an execution on a single <tt>mysql</tt> session,
+    fed through stdin, instead of spawning a client per statement.
+    
+    Actions append SQL statements (and # comments), statement errors do not abort the
+    session (<tt>--force</tt>) but are recorded on the exit code.
+    """
+    def prepare(self):
+        super(MySQLSessionMixin, self).prepare()
+        self.append("mysql --force <<'EOSQL' || exit_code=$?")
+    
+    def commit(self):
+        self.append(textwrap.dedent("""\
+            # Apply permissions
+            FLUSH PRIVILEGES;
+            EOSQL""")
+        )
+        super(MySQLSessionMixin, self).commit()
+
+
+class MySQLController(MySQLSessionMixin, ServiceController):
     """
     Simple backend for creating MySQL databases using <tt>CREATE DATABASE</tt> statement.
     """
@@ -25,10 +46,10 @@ class MySQLController(ServiceController):
         context = self.get_context(database)
         # Not available on delete()
         context['owner'] = database.owner
-        self.append(textwrap.dedent("""
+        self.append(textwrap.dedent("""\
             # Create database and re-set permissions
-            mysql -e 'CREATE DATABASE `%(database)s`;' || true
-            mysql mysql -e 'DELETE FROM db WHERE db = "%(database)s";'\
+            CREATE DATABASE IF NOT EXISTS `%(database)s`;
+            DELETE FROM mysql.db WHERE db = "%(database)s";\
             """) % context
         )
         for user in database.users.all():
@@ -37,7 +58,7 @@ class MySQLController(ServiceController):
                 'grant': 'WITH GRANT OPTION' if user == context['owner'] else ''
             })
             self.append(textwrap.dedent("""\
-                mysql -e 'GRANT ALL PRIVILEGES ON `%(database)s`.* TO "%(username)s"@"%(host)s" %(grant)s;'\
+                GRANT ALL PRIVILEGES ON `%(database)s`.* TO "%(username)s"@"%(host)s" %(grant)s;\
                 """) % context
             )
     
@@ -45,21 +66,13 @@ class MySQLController(ServiceController):
         if database.type != database.MYSQL:
             return
         context = self.get_context(database)
-        self.append(textwrap.dedent("""
+        self.append(textwrap.dedent("""\
             # Remove database %(database)s
-            mysql -e 'DROP DATABASE `%(database)s`;' || exit_code=$?
-            mysql mysql -e 'DELETE FROM db WHERE db = "%(database)s";'\
+            DROP DATABASE `%(database)s`;
+            DELETE FROM mysql.db WHERE db = "%(database)s";\
             """) % context
         )
     
-    def commit(self):
-        self.append(textwrap.dedent("""
-            # Apply permissions
-            mysql -e 'FLUSH PRIVILEGES;'\
-            """)
-        )
-        super(MySQLController, self).commit()
-    
     def get_context(self, database):
         context = {
             'database': database.name,
@@ -68,9 +81,9 @@ class MySQLController(ServiceController):
         return replace(replace(context, "'", '"'), ';', '')
 
 
-class MySQLUserController(ServiceController):
+class MySQLUserController(MySQLSessionMixin, ServiceController):
     """
-    Simple backend for creating MySQL users using <tt>CREATE USER</tt> statement.
+    Simple backend for creating MySQL users using <tt>CREATE USER IF NOT EXISTS</tt> statement (MySQL 5.7+).
     """
     verbose_name = "MySQL user"
     model = 'databases.DatabaseUser'
@@ -85,8 +98,8 @@ class MySQLUserController(ServiceController):
         context = self.get_context(user)
         self.append(textwrap.dedent("""\
             # Create user %(username)s
-            mysql -e 'CREATE USER "%(username)s"@"%(host)s";' || true # User already exists
-            mysql -e 'UPDATE mysql.user SET Password="%(password)s" WHERE User="%(username)s";'\
+            CREATE USER IF NOT EXISTS "%(username)s"@"%(host)s";
+            UPDATE mysql.user SET Password="%(password)s" WHERE User="%(username)s";\
             """) % context
         )
     
@@ -94,16 +107,12 @@ class MySQLUserController(ServiceController):
         if user.type != user.MYSQL:
             return
         context = self.get_context(user)
-        self.append(textwrap.dedent("""
+        self.append(textwrap.dedent("""\
             # Delete user %(username)s
-            mysql -e 'DROP USER "%(username)s"@"%(host)s";' || exit_code=$? \
+            DROP USER "%(username)s"@"%(host)s";\
             """) % context
         )
     
-    def commit(self):
-        self.append("# Apply permissions")
-        self.append("mysql -e 'FLUSH PRIVILEGES;'")
-    
     def get_context(self, user):
         context = {
             'username': user.username,
@@ -115,16 +124,13 @@ class MySQLUserController(ServiceController):
 
 class MysqlDisk(ServiceMonitor):
     """
-    <tt>du -bs &lt;database_path&gt;</tt>
+    Data and index length of the tables of every database,
+    with a single <tt>information_schema</tt> query per server.
     Implements triggers for resource limit exceeded and recovery, disabling insert and create privileges.
     """
     model = 'databases.Database'
     verbose_name = _("MySQL disk")
     delete_old_equal_values = True
-    doc_settings = (settings,
-        ('DATABASES_MYSQL_DB_DIR',)
-    )
-    mysql_db_dir = settings.DATABASES_MYSQL_DB_DIR
     
     def exceeded(self, db):
         if db.type != db.MYSQL:
@@ -146,33 +152,26 @@ class MysqlDisk(ServiceMonitor):
         
     def prepare(self):
         super().prepare()
-        context = {
-            'mysql_db_dir': self.mysql_db_dir,
-        }
+        # Sizes of all the databases with a single query
         self.append(textwrap.dedent("""\
-            function monitor_mysql () {
-                { SIZE=$(du -bs "%(mysql_db_dir)s/$1") && echo $SIZE || echo 0; } | awk {'print $1'}
-            }""") % context)
-        # Slower way
-        #self.append(textwrap.dedent("""\
-        #    function monitor () {
-        #        mysql -B -e "
-        #            SELECT IFNULL(sum(data_length + index_length), 0) 'Size'
-        #            FROM information_schema.TABLES
-        #            WHERE table_schema = '$1';
-        #        " | tail -n 1
-        #    }"""))
+            declare -A sizes
+            while IFS=$'\\t' read -r db_name size; do
+                sizes["$db_name"]=$size
+            done < <(mysql -B -N -e '
+                SELECT table_schema, IFNULL(SUM(data_length + index_length), 0)
+                FROM information_schema.TABLES
+                GROUP BY table_schema;')""")
+        )
     
     def monitor(self, db):
         if db.type != db.MYSQL:
             return
         context = self.get_context(db)
-        self.append('echo %(db_id)s $(monitor_%(db_type)s "%(db_dirname)s")' % context)
+        self.append('echo %(db_id)s ${sizes["%(db_name)s"]:-0}' % context)
     
     def get_context(self, db):
         context = {
             'db_name': db.name,
-            'db_dirname': db.name.replace('-', '@003f'),
             'db_id': db.pk,
             'db_type': db.type,
         }
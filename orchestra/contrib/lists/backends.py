@@ -3,7 +3,7 @@ import textwrap
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceController, replace
-from orchestra.contrib.resources import ServiceMonitor
+from orchestra.contrib.resources import ServiceMonitor, ServiceLogMonitor
 
 from . import settings
 from .models import List
@@ -221,119 +221,39 @@ class MailmanController(MailmanVirtualDomainController):
         return replace(context, "'", '"')
 
 
-class MailmanTraffic(ServiceMonitor):
+class MailmanTraffic(ServiceLogMonitor):
     """
     Parses mailman log file looking for email size and multiples it by <tt>list_members</tt> count.
     """
     model = 'lists.List'
-    resource = ServiceMonitor.TRAFFIC
     verbose_name = _("Mailman traffic")
-    script_executable = '/usr/bin/python'
-    monthly_sum_old_values = True
+    matcher = 'mailman_matcher(keys)'
+    parse_date = 'parse_mailman_date'
     doc_settings = (settings,
         ('LISTS_MAILMAN_POST_LOG_PATH',)
     )
     
     def prepare(self):
-        postlog = settings.LISTS_MAILMAN_POST_LOG_PATH
-        context = {
-            'postlogs': str((postlog, postlog+'.1')),
-            'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-        }
-        self.append(textwrap.dedent("""\
-            import re
+        super(MailmanTraffic, self).prepare()
+        self.append(textwrap.dedent("""
             import subprocess
             import sys
-            from datetime import datetime
-            from dateutil import tz
-            
-            def to_local_timezone(date, tzlocal=tz.tzlocal()):
-                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
-                date = date.replace(tzinfo=tz.tzutc())
-                date = date.astimezone(tzlocal)
-                return date
             
-            postlogs = {postlogs}
-            # Use local timezone
-            end_date = to_local_timezone('{current_date}')
-            end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
-            lists = {{}}
-            months = {{
-                'Jan': '01',
-                'Feb': '02',
-                'Mar': '03',
-                'Apr': '04',
-                'May': '05',
-                'Jun': '06',
-                'Jul': '07',
-                'Aug': '08',
-                'Sep': '09',
-                'Oct': '10',
-                'Nov': '11',
-                'Dec': '12',
-            }}
-            mailman_addr = re.compile(r'.*-(admin|bounces|confirm|join|leave|owner|request|subscribe|unsubscribe)@.*|mailman@.*')
-            
-            def prepare(object_id, list_name, ini_date):
-                global lists
-                ini_date = to_local_timezone(ini_date)
-                ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
-                lists[list_name] = [ini_date, object_id, 0]
-            
-            def monitor(lists, end_date, months, postlogs):
-                for postlog in postlogs:
-                    try:
-                        with open(postlog, 'r') as postlog:
-                            for line in postlog.readlines():
-                                line = line.split()
-                                if len(line) < 11:
-                                    continue
-                                month, day, time, year, __, __, __, list_name, __, addr, size = line[:11]
-                                try:
-                                    list = lists[list_name]
-                                except KeyError:
-                                    continue
-                                else:
-                                    # discard mailman messages because of inconsistent POST logging
-                                    if mailman_addr.match(addr):
-                                        continue
-                                    date = year + months[month] + day + time.replace(':', '')
-                                    if list[0] < int(date) < end_date:
-                                        size = size[5:-1]
-                                        try:
-                                            list[2] += int(size)
-                                        except ValueError:
-                                            # anonymized post
-                                            pass
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
-                
-                for list_name, opts in lists.items():
-                    __, object_id, size = opts
-                    if size:
-                        cmd = ' '.join(('list_members', list_name, '| wc -l'))
-                        ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        subscribers = ps.communicate()[0].strip()
-                        size *= int(subscribers)
-                        sys.stderr.write("%s %s*%s traffic*subscribers\\n" % (object_id, size, subscribers))
-                    print object_id, size
-            """).format(**context)
+            def report(object_id, list_name, size):
+                if size:
+                    cmd = ' '.join(('list_members', list_name, '| wc -l'))
+                    subscribers = subprocess.check_output(cmd, shell=True).strip().decode()
+                    size *= int(subscribers)
+                    sys.stderr.write("%s %s*%s traffic*subscribers\\n" % (object_id, size, subscribers))
+                print(object_id, size)
+            """)
         )
     
-    def monitor(self, user):
-        context = self.get_context(user)
-        self.append("prepare(%(object_id)s, '%(list_name)s', '%(last_date)s')" % context)
-    
-    def commit(self):
-        self.append('monitor(lists, end_date, months, postlogs)')
+    def get_key(self, mail_list):
+        return mail_list.name
     
-    def get_context(self, mail_list):
-        context = {
-            'list_name': mail_list.name,
-            'object_id': mail_list.pk,
-            'last_date': self.get_last_date(mail_list.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
-        }
-        return replace(context, "'", '"')
+    def get_log_files(self, mail_list):
+        return (settings.LISTS_MAILMAN_POST_LOG_PATH,)
 
 
 class MailmanSubscribers(ServiceMonitor):
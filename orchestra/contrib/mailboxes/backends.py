@@ -2,12 +2,15 @@ import logging
 import os
 import re
 import textwrap
+from collections import OrderedDict
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceController
-from orchestra.contrib.resources import ServiceMonitor
+from orchestra.contrib.resources import ServiceMonitor, ServiceLogMonitor
+from orchestra.contrib.resources.helpers import prefetch_resources
+from orchestra.contrib.systemusers.backends import UNIXUserBulkMixin
 
 from . import settings
 from .models import Address, Mailbox
@@ -53,7 +56,7 @@ class SieveFilteringMixin:
         self.append('chown %(user)s:%(group)s %(filtering_path)s' % context)
 
 
-class UNIXUserMaildirController(SieveFilteringMixin, ServiceController):
+class UNIXUserMaildirController(SieveFilteringMixin, UNIXUserBulkMixin, ServiceController):
     """
     Assumes that all system users on this servers all mail accounts.
     If you want to have system users AND mailboxes on the same server you should consider using virtual mailboxes.
@@ -63,14 +66,28 @@ class UNIXUserMaildirController(SieveFilteringMixin, ServiceController):
     
     verbose_name = _("UNIX maildir user")
     model = 'mailboxes.Mailbox'
+    doc_settings = (settings,
+        ('MAILBOXES_BULK_THRESHOLD',)
+    )
+    # Postfix SASL caches passwords
+    bulk_password_flag = 'RESTART_POSTFIX'
+    
+    @classmethod
+    def prefetch_instances(cls, mailboxes):
+        # Disk quotas with a single query
+        prefetch_resources(mailboxes, names=('disk',))
+    
+    def get_bulk_threshold(self):
+        return settings.MAILBOXES_BULK_THRESHOLD
     
     def save(self, mailbox):
         context = self.get_context(mailbox)
-        self.append(textwrap.dedent("""
+        self.append_user_state(context['user'], textwrap.dedent("""
             # Update/create %(user)s user state
             if id %(user)s ; then
                 old_password=$(getent shadow %(user)s | cut -d':' -f2)
                 usermod %(user)s \\
+                    --home %(home)s \\
                     --shell %(initial_shell)s \\
                     --password '%(password)s'
                 if [[ "$old_password" != '%(password)s' ]]; then
@@ -80,11 +97,18 @@ class UNIXUserMaildirController(SieveFilteringMixin, ServiceController):
             else
                 useradd %(user)s \\
                     --home %(home)s \\
+                    --shell %(initial_shell)s \\
                     --password '%(password)s'
             fi
             mkdir -p %(home)s
             chmod 751 %(home)s
-            chown %(user)s:%(group)s %(home)s""") % context
+            chown %(user)s:%(group)s %(home)s""") % context,
+            password=context['password'],
+            home=context['home'],
+            shell=context['initial_shell'],
+            dirs=[
+                (context['home'], '751', '%(user)s:%(group)s' % context),
+            ]
         )
         if hasattr(mailbox, 'resources') and hasattr(mailbox.resources, 'disk'):
             self.set_quota(mailbox, context)
@@ -261,6 +285,12 @@ class PostfixAddressVirtualDomainController(ServiceController):
     
     def include_virtual_alias_domain(self, context):
         domain = context['domain']
+        # Prevent including the same domain multiple times on bulk saves
+        if not hasattr(self, '_included_domains'):
+            self._included_domains = set()
+        if domain.name in self._included_domains:
+            return
+        self._included_domains.add(domain.name)
         if domain.name != context['local_domain'] and self.is_hosted_domain(domain):
             self.append(textwrap.dedent("""
                 # %(domain)s is a virtual domain belonging to this server
@@ -334,9 +364,16 @@ class PostfixAddressController(PostfixAddressVirtualDomainController):
     doc_settings = (settings, (
         'MAILBOXES_LOCAL_DOMAIN',
         'MAILBOXES_VIRTUAL_ALIAS_DOMAINS_PATH',
-        'MAILBOXES_VIRTUAL_ALIAS_MAPS_PATH'
+        'MAILBOXES_VIRTUAL_ALIAS_MAPS_PATH',
+        'MAILBOXES_VIRTUAL_ALIAS_MAPS_FULL_STATE_THRESHOLD',
     ))
     
+    def __init__(self):
+        super().__init__()
+        self.full_state = False
+        self.virtual_alias_addresses = 0
+        self.virtual_alias_updates = []
+    
     def is_implicit_entry(self, context):
         """
         check if virtual_alias_map entry can be omitted because the address is
@@ -347,10 +384,34 @@ class PostfixAddressController(PostfixAddressVirtualDomainController):
             context['destination'] == context['name'] and
             Mailbox.objects.filter(name=context['name']).exists())
     
+    def set_full_state(self):
+        """
+        bulk executions switch to full-state generation once they reach the threshold,
+        incremental updates already generated are discarded
+        """
+        self.virtual_alias_addresses += 1
+        threshold = settings.MAILBOXES_VIRTUAL_ALIAS_MAPS_FULL_STATE_THRESHOLD
+        if not self.full_state and threshold and self.virtual_alias_addresses >= threshold:
+            self.full_state = True
+            # content is a list of (method, commands)
+            for __, commands in self.content:
+                for update in self.virtual_alias_updates:
+                    if update in commands:
+                        commands.remove(update)
+            self.virtual_alias_updates = []
+            self.append("\n# Regenerate %(virtual_alias_maps)s on commit" % self.get_context_files())
+        return self.full_state
+    
+    def append_virtual_alias_update(self, update):
+        self.virtual_alias_updates.append(update)
+        self.append(update)
+    
     def update_virtual_alias_maps(self, address, context):
+        if self.set_full_state():
+            return
         context['destination'] = address.destination
         if not self.is_implicit_entry(context):
-            self.append(textwrap.dedent("""
+            self.append_virtual_alias_update(textwrap.dedent("""
                 # Set virtual alias entry for %(email)s
                 LINE='%(email)s\t%(destination)s'
                 if ! grep '^%(email)s\s' %(virtual_alias_maps)s > /dev/null; then
@@ -367,7 +428,7 @@ class PostfixAddressController(PostfixAddressVirtualDomainController):
         else:
             if not context['destination']:
                 msg = "Address %i is empty" % address.pk
-                self.append("\necho 'msg' >&2" % msg)
+                self.append("\necho '%s' >&2" % msg)
                 logger.warning(msg)
             else:
                 self.append("\n# %(email)s %(destination)s entry is redundant" % context)
@@ -382,7 +443,7 @@ class PostfixAddressController(PostfixAddressVirtualDomainController):
 #                destination.append(forward)
     
     def exclude_virtual_alias_maps(self, context):
-        self.append(textwrap.dedent("""\
+        self.append_virtual_alias_update(textwrap.dedent("""\
             # Remove %(email)s virtual alias entry
             if grep '^%(email)s\s' %(virtual_alias_maps)s > /dev/null; then
                 sed -i '/^%(email)s\s/d' %(virtual_alias_maps)s
@@ -396,10 +457,62 @@ class PostfixAddressController(PostfixAddressVirtualDomainController):
     
     def delete(self, address):
         context = super().delete(address)
-        self.exclude_virtual_alias_maps(context)
+        if not self.set_full_state():
+            self.exclude_virtual_alias_maps(context)
+    
+    def get_virtual_alias_maps(self):
+        """ renders all virtual_alias_maps entries without per-address queries """
+        local_domain = settings.MAILBOXES_LOCAL_DOMAIN
+        mailboxes = set(Mailbox.objects.values_list('name', flat=True))
+        route = self.route
+        if route and route.match.strip() != 'True':
+            addresses = Address.objects.select_related('domain')
+            routed = set(address.pk for address in addresses if route.matches(address))
+        else:
+            routed = None
+        entries = OrderedDict()
+        addresses = Address.objects.order_by('domain__name', 'name', 'mailboxes__name')
+        addresses = addresses.values_list('pk', 'name', 'domain__name', 'forward', 'mailboxes__name')
+        for pk, name, domain, forward, mailbox in addresses:
+            if routed is not None and pk not in routed:
+                continue
+            try:
+                entry = entries[pk]
+            except KeyError:
+                entry = entries[pk] = (name, domain, forward.split(), [])
+            if mailbox:
+                entry[3].append(mailbox)
+        lines = []
+        for name, domain, forward, destination in entries.values():
+            destination = ' '.join(destination + forward)
+            if not destination:
+                continue
+            if domain == local_domain and destination == name and name in mailboxes:
+                # Implicit entry, equivalent to its local mbox
+                continue
+            lines.append('%s@%s\t%s' % (name, domain, destination))
+        return lines
+    
+    def update_full_virtual_alias_maps(self, context):
+        """ ships the whole map once, swapping it atomically only when it has changed """
+        self.append(textwrap.dedent("""
+            # Regenerate virtual alias maps
+            read -r -d '' virtual_alias_maps << 'EOF' || true
+            """) + '\n'.join(self.get_virtual_alias_maps()) + textwrap.dedent("""
+            EOF
+            echo "${virtual_alias_maps}" > %(virtual_alias_maps)s.tmp
+            if cmp -s %(virtual_alias_maps)s.tmp %(virtual_alias_maps)s; then
+                rm %(virtual_alias_maps)s.tmp
+            else
+                mv %(virtual_alias_maps)s.tmp %(virtual_alias_maps)s
+                UPDATED_VIRTUAL_ALIAS_MAPS=1
+            fi""") % context
+        )
     
     def commit(self):
         context = self.get_context_files()
+        if self.full_state:
+            self.update_full_virtual_alias_maps(context)
         self.append(textwrap.dedent("""
             # Apply changes if needed
             [[ $UPDATED_VIRTUAL_ALIAS_DOMAINS == 1 ]] && {
@@ -455,153 +568,22 @@ class DovecotMaildirDisk(ServiceMonitor):
         return context
 
 
-class PostfixMailscannerTraffic(ServiceMonitor):
+class PostfixMailscannerTraffic(ServiceLogMonitor):
     """
     A high-performance log parser.
-    Reads the mail.log file only once, for all users.
+    Reads the mail.log file only once, for all users,
+    and only the lines appended since the previous run.
     """
     model = 'mailboxes.Mailbox'
-    resource = ServiceMonitor.TRAFFIC
     verbose_name = _("Postfix-Mailscanner traffic")
-    script_executable = '/usr/bin/python'
-    monthly_sum_old_values = True
+    matcher = 'PostfixMailscannerMatcher(checkpoint, keys)'
+    parse_date = 'parse_syslog_date'
     doc_settings = (settings,
         ('MAILBOXES_MAIL_LOG_PATH',)
     )
     
-    def prepare(self):
-        mail_log = settings.MAILBOXES_MAIL_LOG_PATH
-        context = {
-            'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'mail_logs': str((mail_log, mail_log+'.1')),
-        }
-        self.append(textwrap.dedent("""\
-            import re
-            import sys
-            from datetime import datetime
-            from dateutil import tz
-            
-            def to_local_timezone(date, tzlocal=tz.tzlocal()):
-                # Converts orchestra's UTC dates to local timezone
-                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
-                date = date.replace(tzinfo=tz.tzutc())
-                date = date.astimezone(tzlocal)
-                return date
-            
-            maillogs = {mail_logs}
-            end_datetime = to_local_timezone('{current_date}')
-            end_date = int(end_datetime.strftime('%Y%m%d%H%M%S'))
-            months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
-            months = dict((m, '%02d' % n) for n, m in enumerate(months, 1))
-            
-            def inside_period(month, day, time, ini_date):
-                global months
-                global end_datetime
-                # Mar  9 17:13:22
-                month = months[month]
-                year = end_datetime.year
-                if month == '12' and end_datetime.month == 1:
-                    year = year+1
-                if len(day) == 1:
-                    day = '0' + day
-                date = str(year) + month + day
-                date += time.replace(':', '')
-                return ini_date < int(date) < end_date
-            
-            users = {{}}
-            delivers = {{}}
-            reverse = {{}}
-            
-            def prepare(object_id, mailbox, ini_date):
-                global users
-                global delivers
-                global reverse
-                ini_date = to_local_timezone(ini_date)
-                ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
-                users[mailbox] = (ini_date, object_id)
-                delivers[mailbox] = set()
-                reverse[mailbox] = set()
-            
-            def monitor(users, delivers, reverse, maillogs):
-                targets = {{}}
-                counter = {{}}
-                user_regex = re.compile(r'\(Authenticated sender: ([^ ]+)\)')
-                for maillog in maillogs:
-                    try:
-                        with open(maillog, 'r') as maillog:
-                            for line in maillog.readlines():
-                                # Only search for Authenticated sendings
-                                if '(Authenticated sender: ' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        sender = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        month, day, time, __, proc, id = line.split()[:6]
-                                        if inside_period(month, day, time, sender[0]):
-                                            # Add new email
-                                            delivers[id[:-1]] = username
-                                # Look for a MailScanner requeue ID
-                                elif ' Requeue: ' in line:
-                                    id, __, req_id = line.split()[6:9]
-                                    id = id.split('.')[0]
-                                    try:
-                                        username = delivers[id]
-                                    except KeyError:
-                                        pass
-                                    else:
-                                        targets[req_id] = (username, 0)
-                                        reverse[username].add(req_id)
-                                # Look for the mail size and count the number of recipients of each email
-                                else:
-                                    try:
-                                        month, day, time, __, proc, req_id, __, msize = line.split()[:8]
-                                    except ValueError:
-                                        # not interested in this line
-                                        continue
-                                    if proc.startswith('postfix/'):
-                                        req_id = req_id[:-1]
-                                        if msize.startswith('size='):
-                                            try:
-                                                target = targets[req_id]
-                                            except KeyError:
-                                                pass
-                                            else:
-                                                targets[req_id] = (target[0], int(msize[5:-1]))
-                                        elif proc.startswith('postfix/smtp'):
-                                            try:
-                                                target = targets[req_id]
-                                            except KeyError:
-                                                pass
-                                            else:
-                                                if inside_period(month, day, time, users[target[0]][0]):
-                                                    try:
-                                                        counter[req_id] += 1
-                                                    except KeyError:
-                                                        counter[req_id] = 1
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
-                    
-                for username, opts in users.iteritems():
-                    size = 0
-                    for req_id in reverse[username]:
-                        size += targets[req_id][1] * counter.get(req_id, 0)
-                    print opts[1], size
-            """).format(**context)
-        )
+    def get_key(self, mailbox):
+        return mailbox.name
     
-    def commit(self):
-        self.append('monitor(users, delivers, reverse, maillogs)')
-    
-    def monitor(self, mailbox):
-        context = self.get_context(mailbox)
-        self.append("prepare(%(object_id)s, '%(mailbox)s', '%(last_date)s')" % context)
-    
-    def get_context(self, mailbox):
-        context = {
-            'mailbox': mailbox.name,
-            'object_id': mailbox.pk,
-            'last_date': self.get_last_date(mailbox.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
-        }
-        return context
+    def get_log_files(self, mailbox):
+        return (settings.MAILBOXES_MAIL_LOG_PATH,)
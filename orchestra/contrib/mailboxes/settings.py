@@ -64,6 +64,22 @@ MAILBOXES_VIRTUAL_ALIAS_MAPS_PATH = Setting('MAILBOXES_VIRTUAL_ALIAS_MAPS_PATH',
 )
 
 
+MAILBOXES_VIRTUAL_ALIAS_MAPS_FULL_STATE_THRESHOLD = Setting('MAILBOXES_VIRTUAL_ALIAS_MAPS_FULL_STATE_THRESHOLD',
+    100,
+    help_text=_("Number of addresses changed on a single execution from which the whole "
+                "<tt>virtual_alias_maps</tt> file is regenerated instead of updated line by line.<br>"
+                "<tt>0</tt> disables full-state generation.")
+)
+
+
+MAILBOXES_BULK_THRESHOLD = Setting('MAILBOXES_BULK_THRESHOLD',
+    100,
+    help_text=("Number of mailboxes saved on a single execution from which the user database "
+               "is updated in a single pass (<tt>newusers</tt>, <tt>chpasswd</tt>) instead of "
+               "mailbox by mailbox.<br><tt>0</tt> disables bulk updates.")
+)
+
+
 MAILBOXES_VIRTUAL_ALIAS_DOMAINS_PATH = Setting('MAILBOXES_VIRTUAL_ALIAS_DOMAINS_PATH',
     '/etc/postfix/virtual_domains'
 )
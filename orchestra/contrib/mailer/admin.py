@@ -6,6 +6,7 @@ from django.contrib import admin
 from django.core.urlresolvers import reverse
 from django.db.models import Count
 from django.shortcuts import redirect
+from django.utils.html import escape
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.admin import ExtendedModelAdmin
@@ -43,12 +44,12 @@ class MessageAdmin(ExtendedModelAdmin):
         }),
         (_("Edit"), {
             'classes': ('collapse',),
-            'fields': ('subject', 'from_address', 'to_address', 'content'),
+            'fields': ('subject', 'from_address', 'to_address', 'display_raw_content'),
         }),
     )
     readonly_fields = (
         'retries', 'last_try_delta', 'created_at_delta', 'display_full_subject',
-        'display_to', 'display_from', 'display_content',
+        'display_to', 'display_from', 'display_content', 'display_raw_content',
     )
     date_hierarchy = 'created_at'
     change_view_actions = (last,)
@@ -103,6 +104,11 @@ class MessageAdmin(ExtendedModelAdmin):
     display_content.short_description = _("Content")
     display_content.allow_tags = True
     
+    def display_raw_content(self, instance):
+        return '<pre>%s</pre>' % escape(instance.content)
+    display_raw_content.short_description = _("Content")
+    display_raw_content.allow_tags = True
+    
     def display_full_subject(self, instance):
         return instance.subject
     display_full_subject.short_description = _("Subject")
@@ -128,7 +134,7 @@ class MessageAdmin(ExtendedModelAdmin):
     
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.annotate(Count('logs')).defer('content')
+        return qs.annotate(Count('logs'))
     
     def send_pending_view(self, request):
         task(send_pending).apply_async()
@@ -5,7 +5,8 @@ from django.core.mail.backends.base import BaseEmailBackend
 from orchestra.core.caches import get_request_cache
 
 from . import settings
-from .models import Message
+from .notifications import notify
+from .models import Message, MessageContent
 from .tasks import send_message
 
 
@@ -29,16 +30,19 @@ class EmailBackend(BaseEmailBackend):
         default_priority = Message.NORMAL if is_bulk else Message.CRITICAL
         num_sent = 0
         connection = None
-        for message in email_messages:
-            priority = message.extra_headers.get('X-Mail-Priority', default_priority)
-            content = message.message().as_string()
-            for to_email in message.recipients():
+        queued = []
+        for email_message in email_messages:
+            priority = email_message.extra_headers.get('X-Mail-Priority', default_priority)
+            # Content is stored once and shared by all recipients
+            body = MessageContent.objects.get_for_content(email_message.message().as_string())
+            from_address = getattr(email_message, 'from_email', djsettings.DEFAULT_FROM_EMAIL)
+            for to_email in email_message.recipients():
                 message = Message(
                     priority=priority,
                     to_address=to_email,
-                    from_address=getattr(message, 'from_email', djsettings.DEFAULT_FROM_EMAIL),
-                    subject=message.subject,
-                    content=content,
+                    from_address=from_address,
+                    subject=email_message.subject,
+                    body=body,
                 )
                 if priority == Message.CRITICAL:
                     # send immidiately
@@ -46,8 +50,11 @@ class EmailBackend(BaseEmailBackend):
                         connection = get_connection(backend='django.core.mail.backends.smtp.EmailBackend')
                     send_message.apply_async(message, connection=connection)
                 else:
-                    message.save()
+                    queued.append(message)
             num_sent += 1
+        if queued:
+            Message.objects.bulk_create(queued)
+            notify()
         if connection is not None:
             connection.close()
         return num_sent
@@ -1,9 +1,8 @@
 import smtplib
-from datetime import timedelta
 from socket import error as SocketError
 
 from django.core.mail import get_connection
-from django.db.models import Q
+from django.db.models import Min
 from django.utils import timezone
 from django.utils.encoding import smart_str
 
@@ -11,6 +10,7 @@ from orchestra.utils.sys import LockFile, OperationLocked
 
 from . import settings
 from .models import Message
+from .notifications import Listener
 
 
 def send_message(message, connection=None, bulk=settings.MAILER_BULK_MESSAGES):
@@ -49,19 +49,15 @@ def send_pending(bulk=settings.MAILER_BULK_MESSAGES):
         with LockFile('/dev/shm/mailer.send_pending.lock'):
             connection = get_connection(backend='django.core.mail.backends.smtp.EmailBackend')
             cur, total = 0, 0
-            for message in Message.objects.filter(state=Message.QUEUED).order_by('priority', 'last_try', 'created_at'):
+            for message in Message.objects.filter(state=Message.QUEUED).select_related('body').order_by('priority', 'last_try', 'created_at'):
                 if cur >= bulk:
                     connection.close()
                     cur = 0
                 send_message(message, connection, bulk)
                 cur += 1
                 total += 1
-            now = timezone.now()
-            qs = Q()
-            for retries, seconds in enumerate(settings.MAILER_DEFERE_SECONDS):
-                delta = timedelta(seconds=seconds)
-                qs = qs | Q(retries=retries, last_try__lte=now-delta)
-            for message in Message.objects.filter(state=Message.DEFERRED).filter(qs).order_by('priority', 'last_try'):
+            deferred = Message.objects.filter(state=Message.DEFERRED, next_try__lte=timezone.now())
+            for message in deferred.select_related('body').order_by('priority', 'last_try'):
                 if cur >= bulk:
                     connection.close()
                     cur = 0
@@ -74,3 +70,20 @@ def send_pending(bulk=settings.MAILER_BULK_MESSAGES):
     finally:
         if 'connection' in vars() and connection.connection is not None:
             connection.close()
+
+
+def listen(max_wait=settings.MAILER_LISTEN_MAX_WAIT):
+    """
+    Resident sender: sends queued messages as soon as EmailBackend notifies them
+    and wakes up on its own when the next deferred message becomes due
+    """
+    with Listener() as listener:
+        while True:
+            send_pending()
+            timeout = max_wait
+            next_try = Message.objects.filter(
+                state=Message.DEFERRED).aggregate(Min('next_try'))['next_try__min']
+            if next_try:
+                seconds = (next_try-timezone.now()).total_seconds()
+                timeout = min(max(seconds, 0), max_wait)
+            listener.wait(timeout)
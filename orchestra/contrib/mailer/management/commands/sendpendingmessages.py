@@ -2,11 +2,18 @@ from django.core.management.base import BaseCommand
 
 from orchestra.contrib.tasks.decorators import keep_state
 
-from ...engine import send_pending
+from ...engine import send_pending, listen
 
 
 class Command(BaseCommand):
     help = 'Runs Orchestra method.'
     
+    def add_arguments(self, parser):
+        parser.add_argument('--listen', action='store_true', dest='listen', default=False,
+            help='Keeps running as a resident sender, waking up as soon as messages are queued.')
+    
     def handle(self, *args, **options):
-        keep_state(send_pending)()
+        if options.get('listen'):
+            listen()
+        else:
+            keep_state(send_pending)()
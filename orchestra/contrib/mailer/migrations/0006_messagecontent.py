@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0005_auto_20160219_1056'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(help_text='SHA-256 of the content.', max_length=64, unique=True, verbose_name='digest')),
+                ('content', models.TextField(verbose_name='content')),
+                ('updated_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='Last time a message used this content.', verbose_name='updated')),
+            ],
+            options={
+                'verbose_name': 'message content',
+                'verbose_name_plural': 'message contents',
+            },
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='body',
+            field=models.ForeignKey(null=True, related_name='messages', to='mailer.MessageContent', verbose_name='content'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.TextField(default='', verbose_name='content'),
+        ),
+    ]
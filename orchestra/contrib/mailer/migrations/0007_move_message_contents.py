@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations
+
+
+def move_contents(apps, schema_editor):
+    Message = apps.get_model('mailer', 'Message')
+    MessageContent = apps.get_model('mailer', 'MessageContent')
+    contents = {}
+    for message in Message.objects.only('id', 'content').iterator():
+        digest = hashlib.sha256(message.content.encode('utf8')).hexdigest()
+        try:
+            body_id = contents[digest]
+        except KeyError:
+            body_id = MessageContent.objects.create(digest=digest, content=message.content).pk
+            contents[digest] = body_id
+        Message.objects.filter(pk=message.pk).update(body_id=body_id)
+
+
+def restore_contents(apps, schema_editor):
+    Message = apps.get_model('mailer', 'Message')
+    for message in Message.objects.select_related('body').iterator():
+        Message.objects.filter(pk=message.pk).update(content=message.body.content)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0006_messagecontent'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_contents, restore_contents),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0007_move_message_contents'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='content',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='body',
+            field=models.ForeignKey(related_name='messages', to='mailer.MessageContent', verbose_name='content'),
+        ),
+    ]
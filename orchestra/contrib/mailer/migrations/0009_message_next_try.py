@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_next_try(apps, schema_editor):
+    from orchestra.contrib.mailer import settings
+    Message = apps.get_model('mailer', 'Message')
+    for retries, seconds in enumerate(settings.MAILER_DEFERE_SECONDS):
+        Message.objects.filter(state='DEFERRED', retries=retries).update(
+            next_try=F('last_try')+timedelta(seconds=seconds))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0008_remove_message_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='next_try',
+            field=models.DateTimeField(help_text='When a deferred message becomes due for a new attempt.', null=True, verbose_name='next try'),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('state', 'next_try')]),
+        ),
+        migrations.RunPython(set_next_try, migrations.RunPython.noop),
+    ]
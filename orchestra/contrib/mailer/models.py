@@ -1,9 +1,48 @@
+import hashlib
+from datetime import timedelta
+
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from . import settings
 
 
+class MessageContentQuerySet(models.QuerySet):
+    def get_for_content(self, content):
+        """ returns the stored content blob for content, creating it if necessary """
+        digest = hashlib.sha256(content.encode('utf8')).hexdigest()
+        # Touched contents are not removed by cleanup_messages() before being referenced
+        if self.filter(digest=digest).update(updated_at=timezone.now()):
+            return self.get(digest=digest)
+        return self.get_or_create(digest=digest, defaults={'content': content})[0]
+    
+    def unreferenced(self, epoch):
+        """ contents not referenced by any message and not used since epoch """
+        return self.filter(messages__isnull=True, updated_at__lt=epoch)
+
+
+class MessageContent(models.Model):
+    """
+    Rendered MIME content shared by all the messages with the same body,
+    e.g. a bulk notification sent to many recipients
+    """
+    digest = models.CharField(_("digest"), max_length=64, unique=True,
+        help_text=_("SHA-256 of the content."))
+    content = models.TextField(_("content"))
+    updated_at = models.DateTimeField(_("updated"), default=timezone.now, db_index=True,
+        help_text=_("Last time a message used this content."))
+    
+    objects = MessageContentQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name = _("message content")
+        verbose_name_plural = _("message contents")
+    
+    def __str__(self):
+        return self.digest
+
+
 class Message(models.Model):
     QUEUED = 'QUEUED'
     SENT = 'SENT'
@@ -34,20 +73,39 @@ class Message(models.Model):
     to_address = models.CharField(max_length=256)
     from_address = models.CharField(max_length=256)
     subject = models.TextField(_("subject"))
-    content = models.TextField(_("content"))
+    body = models.ForeignKey(MessageContent, verbose_name=_("content"), related_name='messages')
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     retries = models.PositiveIntegerField(_("retries"), default=0, db_index=True)
     last_try = models.DateTimeField(_("last try"), null=True, db_index=True)
+    next_try = models.DateTimeField(_("next try"), null=True,
+        help_text=_("When a deferred message becomes due for a new attempt."))
+    
+    class Meta:
+        index_together = (
+            ('state', 'next_try'),
+        )
     
     def __str__(self):
         return '%s to %s' % (self.subject, self.to_address)
     
+    @property
+    def content(self):
+        return self.body.content
+    
+    @content.setter
+    def content(self, content):
+        self.body = MessageContent.objects.get_for_content(content)
+    
     def defer(self):
         self.state = self.DEFERRED
         # Max tries
         if self.retries >= len(settings.MAILER_DEFERE_SECONDS):
             self.state = self.FAILED
-        self.save(update_fields=('state',))
+            self.next_try = None
+        else:
+            delta = timedelta(seconds=settings.MAILER_DEFERE_SECONDS[self.retries])
+            self.next_try = (self.last_try or timezone.now()) + delta
+        self.save(update_fields=('state', 'next_try'))
     
     def sent(self):
         self.state = self.SENT
@@ -0,0 +1,99 @@
+import os
+import select
+import socket
+
+from django.db import connection, transaction
+
+from . import settings
+
+
+CHANNEL = 'mailer_message'
+
+
+def is_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def notify_socket():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        sock.sendto(b'\0', settings.MAILER_NOTIFY_SOCKET)
+    except OSError:
+        # Nobody is listening, messages will be sent by orchestra-beat
+        pass
+    finally:
+        sock.close()
+
+
+def notify():
+    """ wakes up the resident sender, if any, once the current transaction commits """
+    if is_postgres():
+        # PostgreSQL already delivers notifications on commit
+        with connection.cursor() as cursor:
+            cursor.execute('NOTIFY %s' % CHANNEL)
+    else:
+        transaction.on_commit(notify_socket)
+
+
+class Listener(object):
+    """
+    Waits for notify() calls, using PostgreSQL LISTEN or a UNIX datagram socket
+    
+    with Listener() as listener:
+        while True:
+            listener.wait(timeout=60)
+    """
+    def __enter__(self):
+        if is_postgres():
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN %s' % CHANNEL)
+            self.conn = connection.connection
+        else:
+            path = settings.MAILER_NOTIFY_SOCKET
+            if os.path.exists(path):
+                os.remove(path)
+            self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.conn.bind(path)
+            self.conn.setblocking(False)
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        if is_postgres():
+            with connection.cursor() as cursor:
+                cursor.execute('UNLISTEN %s' % CHANNEL)
+        else:
+            self.conn.close()
+            os.remove(settings.MAILER_NOTIFY_SOCKET)
+    
+    def drain(self):
+        """ consumes all pending notifications, bursts only wake us up once """
+        if is_postgres():
+            self.conn.poll()
+            del self.conn.notifies[:]
+        else:
+            try:
+                while self.conn.recv(64):
+                    pass
+            except BlockingIOError:
+                pass
+    
+    def is_pending(self):
+        """
+        psycopg2 buffers on conn.notifies the notifications received during any query,
+        e.g. the ones of send_pending(), they are no longer readable on the socket
+        """
+        if is_postgres():
+            self.conn.poll()
+            return bool(self.conn.notifies)
+        return False
+    
+    def wait(self, timeout=None):
+        """ returns True when woken up by a notification, False on timeout """
+        if self.is_pending():
+            self.drain()
+            return True
+        readable = select.select([self.conn], [], [], timeout)[0]
+        if readable:
+            self.drain()
+        return bool(readable)
@@ -22,3 +22,16 @@ MAILER_NON_QUEUED_PER_REQUEST_THRESHOLD = Setting('MAILER_NON_QUEUED_PER_REQUEST
 MAILER_BULK_MESSAGES = Setting('MAILER_BULK_MESSAGES',
     500,
 )
+
+
+MAILER_NOTIFY_SOCKET = Setting('MAILER_NOTIFY_SOCKET',
+    '/dev/shm/mailer.sock',
+    help_text=_("UNIX socket used for waking up the resident sender (<tt>sendpendingmessages --listen</tt>) "
+                "when not using PostgreSQL, which relies on LISTEN/NOTIFY instead."),
+)
+
+
+MAILER_LISTEN_MAX_WAIT = Setting('MAILER_LISTEN_MAX_WAIT',
+    60,
+    help_text=_("Maximum number of seconds the resident sender sleeps without checking for pending messages."),
+)
@@ -16,8 +16,12 @@ def send_message(message, connection=None):
 
 @periodic_task(run_every=crontab(hour=7, minute=30))
 def cleanup_messages():
-    from .models import Message
+    from .models import Message, MessageContent
     delta = timedelta(days=settings.MAILER_MESSAGES_CLEANUP_DAYS)
     now = timezone.now()
     epoch = (now-delta)
-    return Message.objects.filter(state=Message.SENT, created_at__lt=epoch).only('id').delete()
+    deleted = Message.objects.filter(state=Message.SENT, created_at__lt=epoch).only('id').delete()
+    # Contents are shared between messages, only delete the ones no longer referenced,
+    # recently used contents may be about to be referenced by messages being queued
+    MessageContent.objects.unreferenced(epoch).only('id').delete()
+    return deleted
@@ -30,11 +30,12 @@ class Operation():
         """ set() """
         return hash(self) == hash(operation)
     
-    def __init__(self, backend, instance, action, routes=None):
+    def __init__(self, backend, instance, action, routes=None, copy_instance=True):
         self.backend = backend
         # instance should maintain any dynamic attribute until backend execution
         # deep copy is prefered over copy otherwise objects will share same atributes (queryset cache)
-        self.instance = copy.deepcopy(instance)
+        # read-only snapshots, like the ones loaded by manager.collect_many(), are not copied
+        self.instance = copy.deepcopy(instance) if copy_instance else instance
         self.action = action
         self.routes = routes
     
@@ -144,7 +144,7 @@ class BackendLogAdmin(ChangeViewActionsMixin, admin.ModelAdmin):
     fields = (
         'backend', 'server_link', 'state', 'display_script', 'mono_stdout',
         'mono_stderr', 'mono_traceback', 'exit_code', 'task_id', 'display_created',
-        'execution_time'
+        'execution_time', 'waiting_time', 'critical_path'
     )
     readonly_fields = fields
     actions = (retry_backend,)
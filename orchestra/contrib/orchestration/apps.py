@@ -8,7 +8,10 @@ class OrchestrationConfig(AppConfig):
     verbose_name = "Orchestration"
     
     def ready(self):
+        from .backends import ServiceBackend
         from .models import Server, Route, BackendLog
         administration.register(BackendLog, icon='scriptlog.png')
         administration.register(Server, parent=BackendLog, icon='vps.png')
         administration.register(Route, parent=BackendLog, icon='hal.png')
+        # All backends are registered by now, build the model index at startup
+        ServiceBackend.get_model_index()
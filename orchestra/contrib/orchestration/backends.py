@@ -1,13 +1,16 @@
+import hashlib
+import json
 import textwrap
 from functools import partial
 
 from django.apps import apps
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
-from orchestra import plugins
+from orchestra import get_version, plugins
 
-from . import methods
+from . import methods, settings
 
 
 def replace(context, pattern, repl):
@@ -39,13 +42,22 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     script_method = methods.SSH
     script_executable = '/bin/bash'
     function_method = methods.Python
+    # Declarative states (dicts) are applied by orchestra-agent, see ORCHESTRATION_AGENT_BACKENDS
+    agent_method = methods.Agent
     type = 'task'  # 'sync'
     # Don't wait for the backend to finish before continuing with request/response
     ignore_fields = []
     actions = []
     default_route_match = 'True'
     # Force the backend manager to block in multiple backend executions executing them synchronously
+    # prefer dependencies, serialize makes the backend wait for and block all the other backends
     serialize = False
+    # Names of the backends that have to finish before this one when running on the same server
+    dependencies = ()
+    # Allow save operations to be queued and merged across requests (ORCHESTRATION_COALESCE_SECONDS)
+    coalesce = False
+    # Route the script is being generated for, set by the manager
+    route = None
     doc_settings = None
     # By default backend will not run if actions do not generate insctructions,
     # If your backend uses prepare() or commit() only then you should set force_empty_action_execution = True
@@ -58,29 +70,10 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         self.head = []
         self.content = []
         self.tail = []
-    
-    def __getattribute__(self, attr):
-        """ Select head, content or tail section depending on the method name """
-        IGNORE_ATTRS = (
-            'append',
-            'cmd_section',
-            'head',
-            'tail',
-            'content',
-            'script_method',
-            'function_method',
-            'set_head',
-            'set_tail',
-            'set_content',
-            'actions',
-        )
-        if attr == 'prepare':
-            self.set_head()
-        elif attr == 'commit':
-            self.set_tail()
-        elif attr not in IGNORE_ATTRS and attr in self.actions:
-            self.set_content()
-        return super(ServiceBackend, self).__getattribute__(attr)
+        # {path: digest} stored as DeployedContent once the execution succeeds
+        self.content_digests = {}
+        # Sections are explicitly selected by the manager: set_head(), set_content(), set_tail()
+        self.cmd_section = self.content
     
     def set_head(self):
         self.cmd_section = self.head
@@ -93,48 +86,95 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     
     @classmethod
     def get_actions(cls):
-        return [ action for action in cls.actions if action in dir(cls) ]
+        try:
+            return cls.__dict__['_actions']
+        except KeyError:
+            cls._actions = [ action for action in cls.actions if action in dir(cls) ]
+            return cls._actions
     
     @classmethod
     def get_name(cls):
         return cls.__name__
     
+    @classmethod
+    def is_agent_enabled(cls):
+        """ whether the backend declares its state for orchestra-agent instead of generating bash """
+        return cls.get_name() in settings.ORCHESTRATION_AGENT_BACKENDS
+    
+    @classmethod
+    def prefetch(cls, queryset):
+        """ hook for loading in bulk the related objects used by the backend """
+        return queryset
+    
+    @classmethod
+    def prefetch_instances(cls, instances):
+        """
+        hook for loading the data required by the actions of all the instances
+        of an execution at once, instead of instance by instance; unlike prefetch()
+        the instances are already loaded
+        """
+        pass
+    
+    @staticmethod
+    def get_model_index():
+        """
+        {'app_label.Model': [(backend, None or related accessor)]} on registration order,
+        main backends have no accessor, related_models backends have their accessor path
+        built once all backends have been registered
+        """
+        plugins = ServiceBackend.plugins
+        index = ServiceBackend.__dict__.get('_model_index')
+        if index is None or ServiceBackend._model_index_size != len(plugins):
+            index = {}
+            for backend in plugins:
+                if backend.model:
+                    index.setdefault(backend.model, []).append((backend, None))
+                for rel_model, field in backend.related_models:
+                    index.setdefault(rel_model, []).append((backend, field))
+            ServiceBackend._model_index = index
+            ServiceBackend._model_index_size = len(plugins)
+        return index
+    
+    @classmethod
+    def get_model_backends(cls, model):
+        """ [(backend, None or related accessor)] of model class or instance """
+        backends = ServiceBackend.get_model_index().get(model._meta.label, [])
+        if cls is ServiceBackend:
+            return backends
+        return [(backend, field) for backend, field in backends if issubclass(backend, cls)]
+    
     @classmethod
     def is_main(cls, obj):
-        opts = obj._meta
-        return cls.model == '%s.%s' % (opts.app_label, opts.object_name)
+        return cls.model == obj._meta.label
+    
+    @staticmethod
+    def follow_related(obj, field):
+        related = obj
+        for attribute in field.split('__'):
+            related = getattr(related, attribute)
+        if type(related).__name__ == 'RelatedManager':
+            return related.all()
+        return [related]
     
     @classmethod
     def get_related(cls, obj):
-        opts = obj._meta
-        model = '%s.%s' % (opts.app_label, opts.object_name)
+        model = obj._meta.label
         for rel_model, field in cls.related_models:
             if rel_model == model:
-                related = obj
-                for attribute in field.split('__'):
-                    related = getattr(related, attribute)
-                if type(related).__name__ == 'RelatedManager':
-                    return related.all()
-                return [related]
+                return cls.follow_related(obj, field)
         return []
     
     @classmethod
     def get_backends(cls, instance=None, action=None):
-        backends = cls.get_plugins()
-        included = []
-        # Filter for instance or action
-        for backend in backends:
-            include = True
-            if instance:
-                opts = instance._meta
-                if backend.model != '.'.join((opts.app_label, opts.object_name)):
-                    include = False
-            if include and action:
-                if action not in backend.get_actions():
-                    include = False
-            if include:
-                included.append(backend)
-        return included
+        if instance is not None:
+            backends = [
+                backend for backend, field in cls.get_model_backends(instance) if field is None
+            ]
+        else:
+            backends = cls.get_plugins()
+        if action:
+            backends = [backend for backend in backends if action in backend.get_actions()]
+        return backends
     
     @classmethod
     def get_backend(cls, name):
@@ -195,6 +235,10 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         if isinstance(cmd[0], str):
             method = self.script_method
             cmd = cmd[0]
+        elif isinstance(cmd[0], dict):
+            # {'type': 'file', 'path': path, 'content': content, 'reload': cmd}
+            method = self.agent_method
+            cmd = cmd[0]
         else:
             method = self.function_method
             cmd = partial(*cmd)
@@ -206,6 +250,40 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     def get_context(self, obj):
         return {}
     
+    @cached_property
+    def deployed_digests(self):
+        from .models import DeployedContent
+        deployed = DeployedContent.objects.filter(server=self.route.host)
+        return dict(deployed.values_list('path', 'digest'))
+    
+    def is_unchanged(self, path, inputs):
+        """
+        whether path was last deployed from the same inputs on the route server,
+        in which case rendering and transfer can be skipped
+        inputs: JSON serializable data that fully determines the content of path
+        """
+        inputs = json.dumps([get_version(), inputs], sort_keys=True, default=str)
+        digest = hashlib.sha256(inputs.encode('utf8')).hexdigest()
+        if self.route is None:
+            return False
+        if settings.ORCHESTRATION_SKIP_UNCHANGED_CONTENT and self.deployed_digests.get(path) == digest:
+            return True
+        self.content_digests[path] = digest
+        return False
+    
+    def forget_content(self, path):
+        """ path will be removed from the server """
+        self.content_digests[path] = None
+    
+    def store_content_digests(self, server, success):
+        """ failed executions leave paths in an unknown state, their digests are forgotten """
+        from .models import DeployedContent
+        if self.content_digests:
+            digests = self.content_digests
+            if not success:
+                digests = dict.fromkeys(digests)
+            DeployedContent.objects.store(server, digests)
+    
     def prepare(self):
         """
         hook for executing something at the beging
@@ -24,6 +24,7 @@ def get_backends_help_text(backends):
             'function_method': '.'.join(
                 (backend.function_method.__module__, backend.function_method.__name__)),
             'actions': str(backend.actions),
+            'dependencies': str(backend.dependencies),
         }
         help_text += textwrap.dedent("""
             - Model: <tt>'%(model)s'</tt>
@@ -32,6 +33,7 @@ def get_backends_help_text(backends):
             - Script method: <tt>%(script_method)s</tt>
             - Function method: <tt>%(function_method)s</tt>
             - Actions: <tt>%(actions)s</tt>
+            - Dependencies: <tt>%(dependencies)s</tt>
             """
         ) % context
         help_text = help_text.lstrip().splitlines()
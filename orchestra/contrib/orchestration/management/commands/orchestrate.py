@@ -1,15 +1,84 @@
+import difflib
+import json
+import os
+import re
 import time
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from django import db
 from django.apps import apps
 from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Q
 
-from orchestra.contrib.orchestration import manager, Operation
-from orchestra.contrib.orchestration.models import Server
+from orchestra.contrib.orchestration import manager, methods, settings, Operation
+from orchestra.contrib.orchestration.models import Route, Server
 from orchestra.contrib.orchestration.backends import ServiceBackend
 from orchestra.utils.python import OrderedSet
 from orchestra.utils.sys import confirm
 
 
+# Banner timestamps change on every generation
+BANNER_RE = re.compile(r'Generated by Orchestra at [^\n]*')
+
+
+def get_script(backend):
+    scripts = []
+    for method, commands in backend.scripts:
+        if method is methods.Agent:
+            scripts.append(json.dumps(commands, indent=2))
+        else:
+            scripts.append('\n'.join(commands))
+    return '\n'.join(scripts)
+
+
+def generate_scripts(operations):
+    """ worker process, returns (server, backend, script) of a single backend scripts """
+    # Full scripts, otherwise content already deployed would show up as removed
+    settings.ORCHESTRATION_SKIP_UNCHANGED_CONTENT = False
+    try:
+        scripts, __ = manager.generate(operations)
+        return [
+            (str(route.host), backend.get_name(), get_script(backend))
+                for (route, __, __), (backend, __) in scripts.items()
+        ]
+    finally:
+        db.connection.close()
+
+
+class Checkpoint(object):
+    """ last executed pk of each model, stored as JSON """
+    def __init__(self, path, action):
+        self.path = path
+        self.action = action
+        self.models = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as handler:
+                state = json.loads(handler.read())
+            if state['action'] != action:
+                raise CommandError("%s is a checkpoint of a '%s' re-sync." % (path, state['action']))
+            self.models = state['models']
+    
+    def get(self, label):
+        return self.models.get(label)
+    
+    def save(self, label, pk):
+        self.models[label] = pk
+        if self.path:
+            state = {
+                'action': self.action,
+                'models': self.models,
+            }
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as handler:
+                handler.write(json.dumps(state))
+            os.rename(tmp_path, self.path)
+    
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class Command(BaseCommand):
     help = 'Runs orchestration backends.'
     
@@ -30,17 +99,34 @@ class Command(BaseCommand):
             help='List available baclends.')
         parser.add_argument('--dry-run', action='store_true', dest='dry', default=False,
             help='Only prints scrtipt.')
+        parser.add_argument('-o', '--output', action='store', dest='output', default='',
+            help=('Dry run that writes the scripts into OUTPUT, one file per server and backend, '
+                  'and shows the differences with the previous generation.'))
+        parser.add_argument('-p', '--processes', action='store', dest='processes', type=int,
+            default=os.cpu_count(), help='Number of worker processes used by --output.')
+        parser.add_argument('--batch', action='store', dest='batch', type=int, default=0,
+            help=('Re-syncs in batches of BATCH objects, each batch is collected, generated and '
+                  'executed before the next one.'))
+        parser.add_argument('--max-servers', action='store', dest='max_servers', type=int,
+            default=0, help='Maximum number of servers executing a batch concurrently.')
+        parser.add_argument('--force', action='store_true', dest='force', default=False,
+            help=('Renders and transfers all the files, including the ones deployed from unchanged '
+                  'inputs (ORCHESTRATION_SKIP_UNCHANGED_CONTENT).'))
+        parser.add_argument('--checkpoint', action='store', dest='checkpoint', default='',
+            help=('File where --batch records the last executed object of each model, '
+                  'an interrupted re-sync continues where it stopped.'))
     
-    
-    def collect_operations(self, **options):
-        model = options.get('model')
+    def get_filters(self, **options):
         backends = options.get('backends') or set()
         if backends:
             backends = set(backends.split(','))
         servers = options.get('servers') or set()
         if servers:
             servers = set([Server.objects.get(Q(address=server)|Q(name=server)) for server in servers.split(',')])
-        action = options.get('action')
+        return backends, servers
+    
+    def get_querysets(self, backends, servers, **options):
+        model = options.get('model')
         if not model:
             models = set()
             if servers:
@@ -56,22 +142,16 @@ class Command(BaseCommand):
             for route in routes.filter(is_active=True):
                 model = route.backend_class.model_class()
                 models.add(model)
-            querysets = [model.objects.order_by('id') for model in models]
-        else:
-            kwargs = {}
-            for comp in options.get('query', []):
-                comps = iter(comp.split('='))
-                for arg in comps:
-                    kwargs[arg] = next(comps).strip().rstrip(',')
-            model = apps.get_model(*model.split('.'))
-            queryset = model.objects.filter(**kwargs).order_by('id')
-            querysets = [queryset]
-        
-        operations = OrderedSet()
-        route_cache = {}
-        for queryset in querysets:
-            for instance in queryset:
-                manager.collect(instance, action, operations=operations, route_cache=route_cache)
+            return [model.objects.order_by('id') for model in models]
+        kwargs = {}
+        for comp in options.get('query', []):
+            comps = iter(comp.split('='))
+            for arg in comps:
+                kwargs[arg] = next(comps).strip().rstrip(',')
+        model = apps.get_model(*model.split('.'))
+        return [model.objects.filter(**kwargs).order_by('id')]
+    
+    def filter_operations(self, operations, backends, servers):
         if backends:
             result = []
             for operation in operations:
@@ -89,6 +169,156 @@ class Command(BaseCommand):
             operations = result
         return operations
     
+    def collect_operations(self, **options):
+        backends, servers = self.get_filters(**options)
+        querysets = self.get_querysets(backends, servers, **options)
+        action = options.get('action')
+        operations = OrderedSet()
+        route_cache = {}
+        for queryset in querysets:
+            manager.collect_many(queryset, action, operations=operations, route_cache=route_cache)
+        return self.filter_operations(operations, backends, servers)
+    
+    def generate_scripts(self, operations, processes):
+        """ generates the scripts of each backend on a worker process """
+        by_backend = OrderedDict()
+        for operation in operations:
+            by_backend.setdefault(operation.backend, []).append(operation)
+        scripts = OrderedDict()
+        if not by_backend:
+            return scripts
+        # Forked workers can not share the parent database connection
+        db.connections.close_all()
+        with Pool(processes=max(1, min(processes, len(by_backend)))) as pool:
+            for result in pool.imap_unordered(generate_scripts, by_backend.values()):
+                for server, backend, script in result:
+                    # sync and async scripts of the same backend go to the same file
+                    key = (server, backend)
+                    if key in scripts:
+                        script = '\n'.join((scripts[key], script))
+                    scripts[key] = script
+        return scripts
+    
+    def write_scripts(self, operations, output, processes):
+        """
+        writes one file per server and backend, showing the diff with the previous one,
+        files of a previous generation that are no longer generated are removed
+        """
+        start = time.time()
+        scripts = self.generate_scripts(operations, processes)
+        created, changed, unchanged, removed = 0, 0, 0, 0
+        written = set()
+        for (server, backend), script in sorted(scripts.items()):
+            path = os.path.join(output, server, backend)
+            written.add(path)
+            previous = None
+            if os.path.exists(path):
+                with open(path, 'r') as handler:
+                    previous = handler.read()
+            if previous is None:
+                created += 1
+                self.stdout.write('# New %s' % path)
+            else:
+                old = BANNER_RE.sub('Generated by Orchestra', previous).splitlines()
+                new = BANNER_RE.sub('Generated by Orchestra', script).splitlines()
+                if old == new:
+                    unchanged += 1
+                    continue
+                changed += 1
+                diff = difflib.unified_diff(old, new, path, path, lineterm='')
+                self.stdout.write('\n'.join(diff).encode('ascii', errors='replace').decode())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as handler:
+                handler.write(script)
+            os.rename(tmp_path, path)
+        if os.path.isdir(output):
+            for server in sorted(os.listdir(output)):
+                server_dir = os.path.join(output, server)
+                if not os.path.isdir(server_dir):
+                    continue
+                for backend in sorted(os.listdir(server_dir)):
+                    path = os.path.join(server_dir, backend)
+                    if path in written or not os.path.isfile(path):
+                        continue
+                    with open(path, 'r') as handler:
+                        old = BANNER_RE.sub('Generated by Orchestra', handler.read()).splitlines()
+                    removed += 1
+                    diff = difflib.unified_diff(old, [], path, path, lineterm='')
+                    self.stdout.write('# Removed %s' % path)
+                    self.stdout.write('\n'.join(diff).encode('ascii', errors='replace').decode())
+                    os.remove(path)
+                if not os.listdir(server_dir):
+                    os.rmdir(server_dir)
+        self.stdout.write(
+            '%i scripts generated in %.2fs on %s: %i new, %i changed, %i unchanged, %i removed.' % (
+                len(scripts), time.time()-start, output, created, changed, unchanged, removed))
+    
+    def execute_batch(self, operations, max_servers):
+        """ executes on at most max_servers servers at a time """
+        scripts, serialize = manager.generate(operations)
+        by_server = OrderedDict()
+        for key, value in scripts.items():
+            route = key[0]
+            by_server.setdefault(route.host, OrderedDict())[key] = value
+        by_server = list(by_server.values())
+        step = max_servers or len(by_server) or 1
+        logs = []
+        for ix in range(0, len(by_server), step):
+            wave = OrderedDict()
+            for server_scripts in by_server[ix:ix+step]:
+                wave.update(server_scripts)
+            logs += manager.execute(wave, serialize=serialize, async=False)
+        return logs
+    
+    def resync(self, **options):
+        """ collects, generates and executes batch by batch, checkpointing the progress """
+        batch = options.get('batch')
+        action = options.get('action')
+        backends, servers = self.get_filters(**options)
+        checkpoint = Checkpoint(options.get('checkpoint'), action)
+        querysets = []
+        for queryset in self.get_querysets(backends, servers, **options):
+            label = queryset.model._meta.label
+            last_pk = checkpoint.get(label)
+            if last_pk is not None:
+                self.stdout.write('Resuming %s after pk %s' % (label, last_pk))
+                queryset = queryset.filter(pk__gt=last_pk)
+            querysets.append((label, queryset))
+        if options.get('interactive'):
+            context = {
+                'total': sum(queryset.count() for __, queryset in querysets),
+                'batch': batch,
+            }
+            if not confirm("Are your sure to re-sync %(total)i objects in batches of %(batch)i (yes/no)? " % context):
+                return
+        route_cache = {}
+        for label, queryset in querysets:
+            pks = list(queryset.values_list('pk', flat=True))
+            for ix in range(0, len(pks), batch):
+                start = time.time()
+                chunk = pks[ix:ix+batch]
+                operations = OrderedSet()
+                manager.collect_many(queryset.filter(pk__in=chunk), action,
+                    operations=operations, route_cache=route_cache)
+                operations = self.filter_operations(operations, backends, servers)
+                logs = self.execute_batch(operations, options.get('max_servers'))
+                checkpoint.save(label, chunk[-1])
+                elapsed = time.time()-start
+                context = {
+                    'label': label,
+                    'done': ix+len(chunk),
+                    'total': len(pks),
+                    'operations': len(operations),
+                    'failed': len([log for log in logs if not log.is_success]),
+                    'elapsed': elapsed,
+                    'rate': len(chunk)/elapsed if elapsed else 0,
+                }
+                self.stdout.write(
+                    '%(label)s %(done)i/%(total)i: %(operations)i operations, %(failed)i failed '
+                    'executions, %(elapsed).2fs (%(rate).0f objects/s)' % context)
+        checkpoint.clear()
+    
     def handle(self, *args, **options):
         list_backends = options.get('list_backends')
         if list_backends:
@@ -97,7 +327,17 @@ class Command(BaseCommand):
             return
         interactive = options.get('interactive')
         dry = options.get('dry')
+        output = options.get('output')
+        if options.get('force'):
+            # Servers with drifted or restored files are re-synced in full
+            settings.ORCHESTRATION_SKIP_UNCHANGED_CONTENT = False
+        if options.get('batch'):
+            if dry or output:
+                raise CommandError("--batch executes the scripts, it can not be a dry run.")
+            return self.resync(**options)
         operations = self.collect_operations(**options)
+        if output:
+            return self.write_scripts(operations, output, options.get('processes'))
         scripts, serialize = manager.generate(operations)
         servers = set()
         # Print scripts
@@ -106,9 +346,8 @@ class Command(BaseCommand):
             backend, operations = value
             servers.add(str(route.host))
             self.stdout.write('# Execute %s on %s' % (backend.get_name(), route.host))
-            for method, commands in backend.scripts:
-                script = '\n'.join(commands)
-                self.stdout.write(script.encode('ascii', errors='replace').decode())
+            script = get_script(backend)
+            self.stdout.write(script.encode('ascii', errors='replace').decode())
         if interactive:
             context = {
                 'servers': ', '.join(servers),
@@ -1,24 +1,45 @@
 import logging
 import threading
+import time
 import traceback
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.mail import mail_admins
+from django.db.models import Q, Max, Min
+from django.utils import timezone
 
 from orchestra.utils import db
-from orchestra.utils.python import import_class, OrderedSet
+from orchestra.utils.python import import_class, toposort, OrderedSet
 
-from . import settings, Operation
+from . import settings, methods, Operation
 from .backends import ServiceBackend
 from .helpers import send_report
 from .models import BackendLog
 from .signals import pre_action, post_action, pre_commit, post_commit, pre_prepare, post_prepare
+from .utils import sort_parts
 
 
 logger = logging.getLogger(__name__)
 router = import_class(settings.ORCHESTRATION_ROUTER)
 
 
+def store_log(execute, args, log, operations):
+    """ stores the executed operations and sends a report on failure """
+    for operation in operations:
+        logger.info("Executed %s" % operation)
+        operation.store(log)
+    backend = execute.__self__
+    backend.store_content_digests(args[0], log.is_success)
+    if not log.is_success:
+        send_report(execute, args, log)
+    stdout = log.stdout.strip()
+    stdout and logger.debug('STDOUT %s', stdout.encode('ascii', errors='replace').decode())
+    stderr = log.stderr.strip()
+    stderr and logger.debug('STDERR %s', stderr.encode('ascii', errors='replace').decode())
+
+
 def keep_log(execute, log, operations):
     def wrapper(*args, **kwargs):
         """ send report """
@@ -39,22 +60,42 @@ def keep_log(execute, log, operations):
             # We don't propagate the exception further to avoid transaction rollback
         finally:
             # Store and log the operation
-            for operation in operations:
-                logger.info("Executed %s" % operation)
-                operation.store(log)
-            if not log.is_success:
-                send_report(execute, args, log)
-            stdout = log.stdout.strip()
-            stdout and logger.debug('STDOUT %s', stdout.encode('ascii', errors='replace').decode())
-            stderr = log.stderr.strip()
-            stderr and logger.debug('STDERR %s', stderr.encode('ascii', errors='replace').decode())
+            store_log(execute, args, log, operations)
     return wrapper
 
 
+def keep_bundle_logs(server, parts, **kwargs):
+    """ keep_log() counterpart for scripts bundled into a single execution """
+    try:
+        methods.SSHBundle(server, parts, **kwargs)
+    except Exception:
+        trace = traceback.format_exc()
+        for backend, log, operations in parts:
+            if not log.has_finished:
+                log.state = log.EXCEPTION
+                log.stderr += trace
+                log.save()
+        subject = 'EXCEPTION executing bundled backends %s on %s' % (
+            ', '.join(str(part[0]) for part in parts), server)
+        logger.error(subject)
+        logger.error(trace)
+        mail_admins(subject, trace)
+    finally:
+        for backend, log, operations in parts:
+            store_log(backend.execute, (server,), log, operations)
+
+
 def generate(operations):
     scripts = OrderedDict()
     cache = {}
+    # Kept for backwards compatibility, execution order is defined by execute() dependencies
     serialize = False
+    operations = list(operations)
+    instances = OrderedDict()
+    for operation in operations:
+        instances.setdefault(operation.backend, []).append(operation.instance)
+    for backend_cls, backend_instances in instances.items():
+        backend_cls.prefetch_instances(backend_instances)
     # Generate scripts per route+backend
     for operation in operations:
         logger.debug("Queued %s" % operation)
@@ -66,6 +107,7 @@ def generate(operations):
             key = (route, operation.backend, async_action)
             if key not in scripts:
                 backend, operations = (operation.backend(), [operation])
+                backend.route = route
                 scripts[key] = (backend, operations)
                 backend.set_head()
                 pre_prepare.send(sender=backend.__class__, backend=backend)
@@ -86,8 +128,6 @@ def generate(operations):
             pre_action.send(**kwargs)
             method(operation.instance)
             post_action.send(**kwargs)
-            if backend.serialize:
-                serialize = True
     for value in scripts.values():
         backend, operations = value
         backend.set_tail()
@@ -97,18 +137,124 @@ def generate(operations):
     return scripts, serialize
 
 
+class Execution(object):
+    """
+    Scheduling unit: a backend script or a bundle of backend scripts executed on a server
+    """
+    def __init__(self, server, is_async, parts, task=None, args=(), kwargs=None):
+        self.server = server
+        self.is_async = is_async
+        self.parts = parts
+        self.task = task
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.dependencies = []
+        self.finished = threading.Event()
+        self.path = []
+        self.end = None
+    
+    def __str__(self):
+        return '%s@%s' % ('+'.join(str(part[0]) for part in self.parts), self.server)
+    
+    @property
+    def backends(self):
+        return [part[0] for part in self.parts]
+    
+    def run(self):
+        """ waits for its dependencies, executes and records the critical path timing """
+        for dependency in self.dependencies:
+            dependency.finished.wait()
+        previous = []
+        if self.dependencies:
+            previous = max(self.dependencies, key=lambda d: d.end).path
+        started_at = timezone.now()
+        for backend, log, operations in self.parts:
+            log.started_at = started_at
+            log.save(update_fields=('started_at',))
+        start = time.time()
+        try:
+            self.task(*self.args, **self.kwargs)
+        finally:
+            self.end = time.time()
+            self.set_critical_paths(previous, start)
+            self.finished.set()
+    
+    def set_critical_paths(self, previous, start):
+        paths = {}
+        for num, (backend, log, operations), dependencies in sort_parts(self.parts):
+            path = previous
+            part_start = start
+            if dependencies:
+                part_start, path = max([paths[dep] for dep in dependencies], key=lambda p: p[0])
+            # Bundled scripts report their own duration, timings are local wall-clock times
+            duration = getattr(log, 'duration', None)
+            if duration is None:
+                part_start, duration = start, self.end-start
+            part_end = part_start + duration
+            path = path + [(backend.get_name(), duration)]
+            paths[num] = (part_end, path)
+            log.critical_path = ' > '.join('%s (%.2fs)' % step for step in path)
+            log.save(update_fields=('critical_path',))
+        self.path = max(paths.values(), key=lambda p: p[0])[1]
+
+
+def schedule(executions):
+    """
+    Sets the dependencies between executions of the same server and returns them
+    sorted in topological order
+    
+    Dependencies are declared by ServiceBackend.dependencies, backends with serialize=True
+    act as barriers, waiting for all previous executions and blocking all the following ones
+    """
+    servers = OrderedDict()
+    for execution in executions:
+        servers.setdefault(execution.server, []).append(execution)
+    for server_executions in servers.values():
+        providers = {}
+        for execution in server_executions:
+            for backend in execution.backends:
+                providers[backend.get_name()] = execution
+        barrier = None
+        previous = []
+        for execution in server_executions:
+            dependencies = [barrier] if barrier else []
+            for backend in execution.backends:
+                if backend.serialize:
+                    dependencies += previous
+                for name in backend.dependencies:
+                    provider = providers.get(name)
+                    if provider is not None and provider is not execution:
+                        dependencies.append(provider)
+            execution.dependencies = list(OrderedSet(dependencies))
+            if any(backend.serialize for backend in execution.backends):
+                barrier = execution
+            previous.append(execution)
+    executions, cyclic = toposort(executions, lambda execution: execution.dependencies)
+    for execution in cyclic:
+        logger.warning("Circular backend dependencies on %s, ignoring them." % execution)
+        execution.dependencies = [
+            dependency for dependency in execution.dependencies if dependency in executions
+        ]
+        executions.append(execution)
+    return executions
+
+
 def execute(scripts, serialize=False, async=None):
     """
     executes the operations on the servers
     
     serialize: execute one backend at a time
     async: do not join threads (overrides route.async)
+    
+    Executions of the same server run concurrently, except when ServiceBackend.dependencies
+    define an execution order between them
     """
     if settings.ORCHESTRATION_DISABLE_EXECUTION:
         logger.info('Orchestration execution is dissabled by ORCHESTRATION_DISABLE_EXECUTION.')
         return []
     # Execute scripts on each server
     executions = []
+    bundles = {}
     threads_to_join = []
     logs = []
     for key, value in scripts.items():
@@ -127,18 +273,45 @@ def execute(scripts, serialize=False, async=None):
             log = backend.create_log(*args, using=handle.target)
             log._state.db = handle.origin
         kwargs['log'] = log
-        task = keep_log(backend.execute, log, operations)
+        logs.append(log)
         logger.debug('%s is going to be executed on %s.' % (backend, route.host))
+        part = (backend, log, operations)
+        if (settings.ORCHESTRATION_BUNDLE_SCRIPTS and log.state != BackendLog.NOTHING and
+                methods.is_bundleable(backend)):
+            # All bash scripts of a host are sent over a single SSH session
+            bundle_key = (route.host, is_async)
+            if bundle_key not in bundles:
+                bundles[bundle_key] = Execution(route.host, is_async, [])
+                executions.append(bundles[bundle_key])
+            bundles[bundle_key].parts.append(part)
+            continue
+        task = keep_log(backend.execute, log, operations)
+        executions.append(Execution(route.host, is_async, [part], task, args, kwargs))
+    for execution in bundles.values():
+        if len(execution.parts) > 1:
+            execution.task = keep_bundle_logs
+            execution.args = (execution.server, execution.parts)
+            execution.kwargs = {
+                'serialize': serialize,
+                'async': execution.is_async,
+            }
+        else:
+            backend, log, operations = execution.parts[0]
+            execution.task = keep_log(backend.execute, log, operations)
+            execution.args = (execution.server,)
+            execution.kwargs = {
+                'async': execution.is_async,
+                'log': log,
+            }
+    for execution in schedule(executions):
         if serialize:
             # Execute one backend at a time, no need for threads
-            task(*args, **kwargs)
+            execution.run()
         else:
-            task = db.close_connection(task)
-            thread = threading.Thread(target=task, args=args, kwargs=kwargs)
+            thread = threading.Thread(target=db.close_connection(execution.run))
             thread.start()
-            if not is_async:
+            if not execution.is_async:
                 threads_to_join.append(thread)
-        logs.append(log)
     [ thread.join() for thread in threads_to_join ]
     return logs
 
@@ -147,33 +320,40 @@ def collect(instance, action, **kwargs):
     """ collect operations """
     operations = kwargs.get('operations', OrderedSet())
     route_cache = kwargs.get('route_cache', {})
-    for backend_cls in ServiceBackend.get_backends():
+    handled = set()
+    # Only backends that have instance model as main or related model
+    for backend_cls, field in ServiceBackend.get_model_backends(instance):
         # Check if there exists a related instance to be executed for this backend and action
+        if action not in backend_cls.actions or backend_cls in handled:
+            continue
         instances = []
-        if action in backend_cls.actions:
-            if backend_cls.is_main(instance):
-                instances = [(instance, action)]
-            else:
-                for candidate in backend_cls.get_related(instance):
-                    if candidate.__class__.__name__ == 'ManyRelatedManager':
-                        if 'pk_set' in kwargs:
-                            # m2m_changed signal
-                            candidates = kwargs['model'].objects.filter(pk__in=kwargs['pk_set'])
-                        else:
-                            candidates = candidate.all()
+        if field is None:
+            if not backend_cls.is_main(instance):
+                # e.g. Bind9MasterDomainController subdomains, related_models are tried next
+                continue
+            instances = [(instance, action)]
+        else:
+            for candidate in backend_cls.follow_related(instance, field):
+                if candidate.__class__.__name__ == 'ManyRelatedManager':
+                    if 'pk_set' in kwargs:
+                        # m2m_changed signal
+                        candidates = kwargs['model'].objects.filter(pk__in=kwargs['pk_set'])
                     else:
-                        candidates = [candidate]
-                    for candidate in candidates:
-                        # Check if a delete for candidate is in operations
-                        delete_mock = Operation(backend_cls, candidate, Operation.DELETE)
-                        if delete_mock not in operations:
-                            # related objects with backend.model trigger save()
-                            instances.append((candidate, Operation.SAVE))
+                        candidates = candidate.all()
+                else:
+                    candidates = [candidate]
+                for candidate in candidates:
+                    # Check if a delete for candidate is in operations
+                    delete_mock = Operation(backend_cls, candidate, Operation.DELETE, copy_instance=False)
+                    if delete_mock not in operations:
+                        # related objects with backend.model trigger save()
+                        instances.append((candidate, Operation.SAVE))
+        handled.add(backend_cls)
         for selected, iaction in instances:
             # Maintain consistent state of operations based on save/delete behaviour
             # Prevent creating a deleted selected by deleting existing saves
             if iaction == Operation.DELETE:
-                save_mock = Operation(backend_cls, selected, Operation.SAVE)
+                save_mock = Operation(backend_cls, selected, Operation.SAVE, copy_instance=False)
                 try:
                     operations.remove(save_mock)
                 except KeyError:
@@ -207,3 +387,164 @@ def collect(instance, action, **kwargs):
                     operation.preload_context()
                 operations.add(operation)
     return operations
+
+
+def iterate_chunks(queryset, size=1000):
+    """ iterates queryset in chunks, keeping its order, so prefetches do not load everything at once """
+    pks = list(queryset.values_list('pk', flat=True))
+    for ix in range(0, len(pks), size):
+        chunk = pks[ix:ix+size]
+        objects = queryset.in_bulk(chunk)
+        for pk in chunk:
+            yield objects[pk]
+
+
+def collect_many(queryset, action, **kwargs):
+    """
+    collect() counterpart for bulk operations over a queryset
+    
+    Backend applicability is computed once per model, related objects are prefetched,
+    routes are resolved once per backend and instances are not deep-copied, since they
+    are fresh read-only snapshots of the database.
+    """
+    operations = kwargs.get('operations', OrderedSet())
+    route_cache = kwargs.get('route_cache', {})
+    backends = []
+    for backend_cls, field in ServiceBackend.get_model_backends(queryset.model):
+        if action in backend_cls.actions:
+            backends.append((backend_cls, field))
+            if field is None:
+                queryset = backend_cls.prefetch(queryset)
+            else:
+                queryset = queryset.prefetch_related(field)
+    if not backends:
+        return operations
+    fill_cache = getattr(router.objects, 'fill_cache', None)
+    if fill_cache and not route_cache:
+        fill_cache(route_cache)
+    
+    def get_routes(operation):
+        if not fill_cache:
+            return router.objects.get_for_operation(operation, cache=route_cache)
+        routes = route_cache.get((operation.backend.get_name(), operation.action), [])
+        # Avoid evaluating the default match expression for every instance
+        return [
+            route for route in routes if route.match == 'True' or route.matches(operation.instance)
+        ]
+    
+    for instance in iterate_chunks(queryset):
+        selected = []
+        handled = set()
+        for backend_cls, field in backends:
+            if backend_cls in handled:
+                continue
+            if field is None:
+                if not backend_cls.is_main(instance):
+                    continue
+                selected.append((backend_cls, instance, action))
+            else:
+                for candidate in backend_cls.follow_related(instance, field):
+                    if candidate.__class__.__name__ == 'ManyRelatedManager':
+                        candidates = candidate.all()
+                    else:
+                        candidates = [candidate]
+                    for candidate in candidates:
+                        # related objects with backend.model trigger save()
+                        selected.append((backend_cls, candidate, Operation.SAVE))
+            handled.add(backend_cls)
+        for backend_cls, candidate, iaction in selected:
+            operation = Operation(backend_cls, candidate, iaction, copy_instance=False)
+            if iaction == Operation.DELETE:
+                operations.discard(Operation(backend_cls, candidate, Operation.SAVE, copy_instance=False))
+            elif Operation(backend_cls, candidate, Operation.DELETE, copy_instance=False) in operations:
+                continue
+            routes = get_routes(operation)
+            if routes:
+                operation.routes = routes
+                if iaction == Operation.DELETE:
+                    operation.preload_context()
+                else:
+                    operations.discard(operation)
+                operations.add(operation)
+    return operations
+
+
+def coalesce(operations):
+    """
+    Moves save operations of coalescing backends to the persistent queue,
+    returning the operations that still have to be executed right away
+    """
+    from .models import QueuedOperation
+    if not settings.ORCHESTRATION_COALESCE_SECONDS:
+        return operations
+    remaining = OrderedSet()
+    for operation in operations:
+        backend_cls = operation.backend
+        if not backend_cls.coalesce:
+            remaining.add(operation)
+            continue
+        lookup = {
+            'backend': backend_cls.get_name(),
+            'content_type': ContentType.objects.get_for_model(operation.instance),
+            'object_id': operation.instance.pk,
+        }
+        if operation.action == Operation.SAVE:
+            for route in operation.routes:
+                # Touching updated_at restarts the debounce window of the route server
+                QueuedOperation.objects.update_or_create(
+                    route=route, action=operation.action, defaults={}, **lookup)
+            logger.debug("Operation %s queued for coalescing" % operation)
+        else:
+            if operation.action == Operation.DELETE:
+                # Deleted objects can not be saved later on
+                QueuedOperation.objects.filter(**lookup).delete()
+            remaining.add(operation)
+    return remaining
+
+
+def flush_coalesced(force=False):
+    """
+    Executes the queued operations of the servers that did not receive new operations
+    during the last ORCHESTRATION_COALESCE_SECONDS, one combined script per server and backend
+    """
+    from .models import QueuedOperation
+    now = timezone.now()
+    queued = QueuedOperation.objects.filter(updated_at__lte=now)
+    if not force:
+        window = timedelta(seconds=settings.ORCHESTRATION_COALESCE_SECONDS)
+        max_delay = timedelta(seconds=settings.ORCHESTRATION_COALESCE_MAX_DELAY)
+        hosts = queued.values('route__host').annotate(
+            last=Max('updated_at'), first=Min('created_at')
+        ).filter(Q(last__lte=now-window) | Q(first__lte=now-max_delay))
+        queued = queued.filter(route__host__in=[host['route__host'] for host in hosts])
+    queued = list(queued.select_related('route__host', 'content_type'))
+    if not queued:
+        return []
+    # Load the current state of the queued objects, one query per model
+    object_ids = defaultdict(set)
+    for qoperation in queued:
+        object_ids[qoperation.content_type].add(qoperation.object_id)
+    instances = {}
+    for content_type, ids in object_ids.items():
+        instances[content_type] = content_type.model_class()._default_manager.in_bulk(ids)
+    operations = OrderedDict()
+    for qoperation in queued:
+        instance = instances[qoperation.content_type].get(qoperation.object_id)
+        if instance is None:
+            # Deleted after being queued
+            continue
+        try:
+            backend_cls = qoperation.backend_class
+        except KeyError:
+            logger.warning("Backed '%s' not installed." % qoperation.backend)
+            continue
+        operation = Operation(backend_cls, instance, qoperation.action, routes=[])
+        operation = operations.setdefault(operation, operation)
+        operation.routes.append(qoperation.route)
+    # Operations queued meanwhile (updated_at > now) are kept for the next flush
+    QueuedOperation.objects.filter(
+        pk__in=[qoperation.pk for qoperation in queued], updated_at__lte=now).delete()
+    if not operations:
+        return []
+    scripts, serialize = generate(operations)
+    return execute(scripts, serialize=serialize)
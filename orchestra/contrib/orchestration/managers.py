@@ -1,7 +1,6 @@
 import sys
 from threading import local
 
-from django.contrib.admin.models import LogEntry
 from django.db.models.signals import pre_delete, post_save, m2m_changed
 from django.dispatch import receiver
 from django.utils.decorators import ContextDecorator
@@ -9,20 +8,18 @@ from django.utils.decorators import ContextDecorator
 from orchestra.utils.python import OrderedSet
 
 from . import manager, Operation, helpers
-from .middlewares import OperationsMiddleware
-from .models import BackendLog, BackendOperation
+from .middlewares import OperationsMiddleware, is_tracked
 
 
 @receiver(post_save, dispatch_uid='orchestration.post_save_manager_collector')
 def post_save_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
-        instance = kwargs.get('instance')
+    if is_tracked(sender):
         orchestrate.collect(Operation.SAVE, **kwargs)
 
 
 @receiver(pre_delete, dispatch_uid='orchestration.pre_delete_manager_collector')
 def pre_delete_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if is_tracked(sender):
         orchestrate.collect(Operation.DELETE, **kwargs)
 
 
@@ -30,7 +27,7 @@ def pre_delete_collector(sender, *args, **kwargs):
 def m2m_collector(sender, *args, **kwargs):
     # m2m relations without intermediary models are shit. Model.post_save is not sent and
     # by the time related.post_save is sent rel objects are not accessible via RelatedManager.all()
-    if kwargs.pop('action') == 'post_add' and kwargs['pk_set']:
+    if kwargs.pop('action') == 'post_add' and kwargs['pk_set'] and is_tracked(type(kwargs['instance'])):
         orchestrate.collect(Operation.SAVE, **kwargs)
 
 
@@ -1,5 +1,7 @@
 import inspect
+import json
 import logging
+import re
 import socket
 import sys
 import select
@@ -9,9 +11,10 @@ from celery.datastructures import ExceptionInfo
 
 from orchestra.settings import ORCHESTRA_SSH_DEFAULT_USER
 from orchestra.utils.sys import sshrun
-from orchestra.utils.python import CaptureStdout, import_class
+from orchestra.utils.python import CaptureStdout, import_class, random_ascii
 
 from . import settings
+from .utils import sort_parts
 
 
 logger = logging.getLogger(__name__)
@@ -148,6 +151,169 @@ def SSH(*args, **kwargs):
     return method(*args, **kwargs)
 
 
+def is_bundleable(backend, interpreters=False):
+    """
+    whether backend scripts can be merged with other backends into a single bash execution
+    interpreters: also scripts of other executables, like python monitors, fed through stdin
+    """
+    if not interpreters and backend.script_executable not in ('/bin/bash', 'bash'):
+        return False
+    scripts = backend.scripts
+    return len(scripts) == 1 and scripts[0][0] is SSH
+
+
+def parse_bundle_output(output, boundary):
+    """ {num: (header, output)} of the parts of a bundle whose output is complete """
+    boundary = re.escape(boundary.encode())
+    regex = re.compile(rb'\n%s (\d+)([^\n]*)\n(.*?)\n%s-end \1(?:\n|$)' % (boundary, boundary), re.S)
+    return {
+        int(num): (header.decode('utf8'), output.decode('utf8'))
+            for num, header, output in regex.findall(b'\n' + output)
+    }
+
+
+def SSHBundle(server, parts, serialize=False, async=False):
+    """
+    Executes the scripts of multiple backends on a single SSH session,
+    each backend runs on its own subshell and gets its own output and exit code.
+    Independent scripts run concurrently, ServiceBackend.dependencies are waited for.
+    The output of every script is reported as soon as it finishes, on async executions
+    each log is saved without waiting for the rest of the bundle.
+    
+    parts: [(backend, log, operations)]
+    """
+    boundary = '--orchestra-part-%s' % random_ascii(16)
+    bundle = [textwrap.dedent("""\
+        bundle=$(mktemp -d)
+        trap 'rm -rf ${bundle}' EXIT""")
+    ]
+    for num, (backend, log, operations), dependencies in sort_parts(parts):
+        __, cmds = backend.scripts[0]
+        script = '\n'.join(cmds).replace('\r', '')
+        log.state = log.STARTED
+        log.script = '\n'.join((log.script, script))
+        log.save(update_fields=('script', 'state', 'updated_at'))
+        if backend.script_executable not in ('/bin/bash', 'bash'):
+            script = "%s <<'%s'\n%s\n%s" % (backend.script_executable, boundary, script, boundary)
+        part = []
+        if not serialize:
+            for dependency in dependencies:
+                part.append(
+                    'while [[ ! -e ${bundle}/%i.code ]]; do sleep 0.1; done' % dependency)
+        part.append('start=$(date +%s.%N)')
+        part.append('(\n%s\n) > ${bundle}/%i.out 2> ${bundle}/%i.err' % (script, num, num))
+        context = {
+            'num': num,
+            'boundary': boundary,
+        }
+        # Outputs of concurrent scripts are not interleaved
+        part.append(textwrap.dedent("""\
+            code=$?
+            end=$(date +%%s.%%N)
+            {
+                flock 9
+                echo; echo "%(boundary)s %(num)i ${code} ${start} ${end}"
+                cat ${bundle}/%(num)i.out; echo; echo "%(boundary)s-end %(num)i"
+                echo >&2; echo "%(boundary)s %(num)i" >&2
+                cat ${bundle}/%(num)i.err >&2; echo >&2; echo "%(boundary)s-end %(num)i" >&2
+            } 9> ${bundle}/lock
+            touch ${bundle}/%(num)i.code""") % context
+        )
+        if serialize:
+            bundle += part
+        else:
+            bundle.append('{\n%s\n} &' % '\n'.join(part))
+    bundle.append('wait')
+    logger.debug('%s running on %s' % (', '.join(str(part[0]) for part in parts), server))
+    finished = set()
+    
+    def save_finished(stdout, stderr):
+        """ saves the logs of the scripts whose stdout and stderr are complete """
+        outputs = parse_bundle_output(stdout, boundary)
+        errors = parse_bundle_output(stderr, boundary)
+        for num, (header, part_stdout) in outputs.items():
+            if num in finished or num not in errors:
+                continue
+            finished.add(num)
+            backend, log, operations = parts[num]
+            exit_code, *timing = header.split()
+            log.stdout += part_stdout
+            log.stderr += errors[num][1]
+            log.exit_code = int(exit_code)
+            log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
+            try:
+                # Remote clocks may be skewed, only durations are used for the critical path
+                start, end = map(float, timing)
+            except ValueError:
+                pass
+            else:
+                log.duration = end - start
+            logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+            log.save()
+    
+    ssh = sshrun(server.get_address(), '\n'.join(bundle), executable='/bin/bash',
+        persist=True, silent=True, async=async)
+    if async:
+        stdout = stderr = b''
+        for state in ssh:
+            if state.stdout or state.stderr:
+                stdout += state.stdout
+                stderr += state.stderr
+                save_finished(stdout, stderr)
+        exit_code = state.exit_code
+    else:
+        stdout, stderr, exit_code = ssh.stdout, ssh.stderr, ssh.exit_code
+        save_finished(stdout, stderr)
+    stderr = stderr.decode('utf8')
+    timeout = exit_code == 255 and stderr.lstrip().startswith('ssh: connect to host')
+    for num, (backend, log, operations) in enumerate(parts):
+        if num not in finished:
+            log.stderr += stderr
+            log.state = log.TIMEOUT if timeout else log.ABORTED
+            logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+            log.save()
+
+
+def Agent(backend, log, server, cmds, async=False):
+    """
+    Sends the declared states to orchestra-agent running on the remote server,
+    which applies them idempotently and coalesces the service reloads
+    """
+    payload = json.dumps({
+        'backend': str(backend),
+        'states': cmds,
+    }, indent=2)
+    log.state = log.STARTED
+    log.script = '\n'.join((log.script, payload))
+    log.save(update_fields=('script', 'state', 'updated_at'))
+    if not cmds:
+        return
+    try:
+        ssh = sshrun(server.get_address(), payload, executable=settings.ORCHESTRATION_AGENT_COMMAND,
+            persist=True, silent=True)
+        logger.debug('%s running on %s' % (backend, server))
+        log.stdout += ssh.stdout.decode('utf8')
+        log.stderr += ssh.stderr.decode('utf8')
+        if not log.exit_code:
+            log.exit_code = ssh.exit_code
+            if ssh.exit_code == 255 and log.stderr.startswith('ssh: connect to host'):
+                log.state = log.TIMEOUT
+            else:
+                log.state = log.SUCCESS if ssh.exit_code == 0 else log.FAILURE
+        logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+        log.save()
+    except:
+        log.state = log.ERROR
+        log.traceback = ExceptionInfo(sys.exc_info()).traceback
+        logger.error('Exception while executing %s on %s' % (backend, server))
+        logger.debug(log.traceback)
+        log.save()
+    finally:
+        if log.state == log.STARTED:
+            log.state = log.ABORTED
+            log.save(update_fields=('state', 'updated_at'))
+
+
 def Python(backend, log, server, cmds, async=False):
     script = ''
     functions = set()
@@ -1,6 +1,5 @@
 from threading import local
 
-from django.contrib.admin.models import LogEntry
 from django.core.urlresolvers import resolve
 from django.db import transaction
 from django.db.models.signals import pre_delete, post_save, m2m_changed
@@ -10,20 +9,27 @@ from django.http.response import HttpResponseServerError
 from orchestra.utils.python import OrderedSet
 
 from . import manager, Operation
+from .backends import ServiceBackend
 from .helpers import message_user
-from .models import BackendLog, BackendOperation
+
+
+def is_tracked(sender):
+    """
+    whether sender is the main or a related model of any backend,
+    saves and deletes of untracked models (e.g. MonitorData or BillLine) return right away
+    """
+    return sender._meta.label in ServiceBackend.get_model_index()
 
 
 @receiver(post_save, dispatch_uid='orchestration.post_save_collector')
 def post_save_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
-        instance = kwargs.get('instance')
+    if is_tracked(sender):
         OperationsMiddleware.collect(Operation.SAVE, **kwargs)
 
 
 @receiver(pre_delete, dispatch_uid='orchestration.pre_delete_collector')
 def pre_delete_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if is_tracked(sender):
         OperationsMiddleware.collect(Operation.DELETE, **kwargs)
 
 
@@ -31,7 +37,7 @@ def pre_delete_collector(sender, *args, **kwargs):
 def m2m_collector(sender, *args, **kwargs):
     # m2m relations without intermediary models are shit. Model.post_save is not sent and
     # by the time related.post_save is sent rel objects are not accessible via RelatedManager.all()
-    if kwargs.pop('action') == 'post_add' and kwargs['pk_set']:
+    if kwargs.pop('action') == 'post_add' and kwargs['pk_set'] and is_tracked(type(kwargs['instance'])):
         OperationsMiddleware.collect(Operation.SAVE, **kwargs)
 
 
@@ -101,6 +107,8 @@ class OperationsMiddleware(object):
             operations = self.get_pending_operations()
             if operations:
                 try:
+                    # Bursts of changes are merged across requests when coalescing is enabled
+                    operations = manager.coalesce(operations)
                     scripts, serialize = manager.generate(operations)
                 except Exception as exception:
                     self.leave_transaction_management(exception)
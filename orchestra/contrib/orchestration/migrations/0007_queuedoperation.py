@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('orchestration', '0006_auto_20160219_1110'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedOperation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(max_length=256, verbose_name='backend')),
+                ('action', models.CharField(max_length=64, verbose_name='action')),
+                ('object_id', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True, verbose_name='updated')),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('route', models.ForeignKey(related_name='queued_operations', to='orchestration.Route')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='queuedoperation',
+            unique_together=set([('route', 'backend', 'action', 'content_type', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestration', '0007_queuedoperation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backendlog',
+            name='critical_path',
+            field=models.TextField(blank=True, help_text='Chain of backend executions that determined when this execution finished.', verbose_name='critical path'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='started_at',
+            field=models.DateTimeField(help_text='When the backend dependencies were satisfied and the execution started.', null=True, verbose_name='started'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestration', '0008_backendlog_critical_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeployedContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=256, verbose_name='path')),
+                ('digest', models.CharField(max_length=64, verbose_name='digest')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deployed_contents', to='orchestration.Server', verbose_name='server')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='deployedcontent',
+            unique_together=set([('server', 'path')]),
+        ),
+    ]
@@ -4,7 +4,7 @@ import socket
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils.encoding import force_text
 from django.utils.functional import cached_property
 from django.utils.module_loading import autodiscover_modules
@@ -99,7 +99,11 @@ class BackendLog(models.Model):
     task_id = models.CharField(_("task ID"), max_length=36, unique=True, null=True,
         help_text="Celery task ID when used as execution backend")
     created_at = models.DateTimeField(_("created"), auto_now_add=True, db_index=True)
+    started_at = models.DateTimeField(_("started"), null=True,
+        help_text=_("When the backend dependencies were satisfied and the execution started."))
     updated_at = models.DateTimeField(_("updated"), auto_now=True)
+    critical_path = models.TextField(_("critical path"), blank=True,
+        help_text=_("Chain of backend executions that determined when this execution finished."))
     
     class Meta:
         get_latest_by = 'id'
@@ -111,6 +115,12 @@ class BackendLog(models.Model):
     def execution_time(self):
         return (self.updated_at-self.created_at).total_seconds()
     
+    @property
+    def waiting_time(self):
+        if self.started_at is None:
+            return None
+        return (self.started_at-self.created_at).total_seconds()
+    
     @property
     def has_finished(self):
         return self.state not in (self.STARTED, self.RECEIVED)
@@ -160,25 +170,94 @@ class BackendOperation(models.Model):
         return ServiceBackend.get_backend(self.backend)
 
 
+class QueuedOperation(models.Model):
+    """
+    Save operation waiting on the coalescing queue for its route to be executed
+    """
+    route = models.ForeignKey('orchestration.Route', related_name='queued_operations')
+    backend = models.CharField(_("backend"), max_length=256)
+    action = models.CharField(_("action"), max_length=64)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    created_at = models.DateTimeField(_("created"), auto_now_add=True)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True, db_index=True)
+    
+    instance = GenericForeignKey('content_type', 'object_id')
+    
+    class Meta:
+        unique_together = ('route', 'backend', 'action', 'content_type', 'object_id')
+    
+    def __str__(self):
+        return '%s.%s(%s-%s)' % (self.backend, self.action, self.content_type_id, self.object_id)
+    
+    @cached_property
+    def backend_class(self):
+        return ServiceBackend.get_backend(self.backend)
+
+
 autodiscover_modules('backends')
 
 
+class DeployedContentQuerySet(models.QuerySet):
+    def store(self, server, digests):
+        """ digests: {path: digest}, None digests forget their path """
+        paths = list(digests)
+        with transaction.atomic():
+            for ix in range(0, len(paths), 500):
+                self.filter(server=server, path__in=paths[ix:ix+500]).delete()
+            try:
+                with transaction.atomic():
+                    self.bulk_create([
+                        self.model(server=server, path=path, digest=digest)
+                            for path, digest in digests.items() if digest is not None
+                    ])
+            except IntegrityError:
+                # A concurrent execution has stored some of the paths, the last one wins
+                for path, digest in digests.items():
+                    if digest is not None:
+                        self.update_or_create(server=server, path=path,
+                            defaults={'digest': digest})
+
+
+class DeployedContent(models.Model):
+    """
+    Digest of the inputs of the last successfully deployed content of a server path
+    """
+    server = models.ForeignKey(Server, verbose_name=_("server"), related_name='deployed_contents')
+    path = models.CharField(_("path"), max_length=256)
+    digest = models.CharField(_("digest"), max_length=64)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
+    
+    objects = DeployedContentQuerySet.as_manager()
+    
+    class Meta:
+        unique_together = ('server', 'path')
+    
+    def __str__(self):
+        return '%s:%s' % (self.server, self.path)
+
+
 class RouteQuerySet(models.QuerySet):
+    def fill_cache(self, cache):
+        """ cache: {(backend name, action): [route]} """
+        for route in self.filter(is_active=True).select_related('host'):
+            try:
+                backend_class = route.backend_class
+            except KeyError:
+                logger.warning("Backed '%s' not installed." % route.backend)
+            else:
+                for action in backend_class.get_actions():
+                    key = (route.backend, action)
+                    try:
+                        cache[key].append(route)
+                    except KeyError:
+                        cache[key] = [route]
+        return cache
+    
     def get_for_operation(self, operation, **kwargs):
         cache = kwargs.get('cache', {})
         if not cache:
-            for route in self.filter(is_active=True).select_related('host'):
-                try:
-                    backend_class = route.backend_class
-                except KeyError:
-                    logger.warning("Backed '%s' not installed." % route.backend)
-                else:
-                    for action in backend_class.get_actions():
-                        key = (route.backend, action)
-                        try:
-                            cache[key].append(route)
-                        except KeyError:
-                            cache[key] = [route]
+            self.fill_cache(cache)
         routes = []
         backend_cls = operation.backend
         key = (backend_cls.get_name(), operation.action)
@@ -49,3 +49,47 @@ ORCHESTRATION_SSH_METHOD_BACKEND = Setting('ORCHESTRATION_SSH_METHOD_BACKEND',
                 "Both perform similarly, but OpenSSH has the advantage that the connections are shared between workers. "
                 "Paramiko, in contrast, has a per worker connection pool.")
 )
+
+
+ORCHESTRATION_COALESCE_SECONDS = Setting('ORCHESTRATION_COALESCE_SECONDS',
+    0,
+    help_text=_("Save operations of backends with <tt>coalesce = True</tt> are queued and executed once "
+                "their server has not received new operations for this amount of seconds, "
+                "producing one combined execution per burst of changes.<br>"
+                "<tt>0</tt> disables coalescing.")
+)
+
+
+ORCHESTRATION_COALESCE_MAX_DELAY = Setting('ORCHESTRATION_COALESCE_MAX_DELAY',
+    5*60,
+    help_text=_("Maximum number of seconds an operation can be kept on the coalescing queue.")
+)
+
+
+ORCHESTRATION_BUNDLE_SCRIPTS = Setting('ORCHESTRATION_BUNDLE_SCRIPTS',
+    False,
+    help_text=_("Send the bash scripts of all the backends that run on the same server over a single "
+                "SSH session, each one on its own subshell and with its own backend log.")
+)
+
+
+ORCHESTRATION_AGENT_BACKENDS = Setting('ORCHESTRATION_AGENT_BACKENDS',
+    (),
+    help_text=_("Names of the backends that send declarative payloads to <tt>orchestra-agent</tt> "
+                "instead of bash scripts, e.g. <tt>('Apache2Controller',)</tt>.<br>"
+                "Their servers need to have <tt>orchestra-agent</tt> installed.")
+)
+
+
+ORCHESTRATION_AGENT_COMMAND = Setting('ORCHESTRATION_AGENT_COMMAND',
+    'orchestra-agent apply',
+    help_text=_("Remote command that reads the payload from stdin.")
+)
+
+
+ORCHESTRATION_SKIP_UNCHANGED_CONTENT = Setting('ORCHESTRATION_SKIP_UNCHANGED_CONTENT',
+    False,
+    help_text=_("Backends skip rendering and transferring configuration files whose inputs have "
+                "not changed since their last successful deployment on that server.<br>"
+                "Files modified on the servers are only restored by <tt>orchestrate --force</tt>.")
+)
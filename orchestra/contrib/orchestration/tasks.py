@@ -4,8 +4,9 @@ from celery.task.schedules import crontab
 from django.utils import timezone
 
 from orchestra.contrib.tasks import periodic_task
+from orchestra.utils.sys import LockFile
 
-from . import settings
+from . import settings, manager
 from .models import BackendLog
 
 
@@ -14,3 +15,10 @@ def backend_logs_cleanup():
     days = settings.ORCHESTRATION_BACKEND_CLEANUP_DAYS
     epoch = timezone.now()-timedelta(days=days)
     return BackendLog.objects.filter(created_at__lt=epoch).only('id').delete()
+
+
+@periodic_task(run_every=crontab(minute='*'), name='orchestration.flush_coalesced_operations')
+def flush_coalesced_operations():
+    if settings.ORCHESTRATION_COALESCE_SECONDS:
+        with LockFile('/dev/shm/orchestration.flush_coalesced.lock', expire=60*60):
+            return manager.flush_coalesced()
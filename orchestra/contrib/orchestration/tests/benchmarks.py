@@ -0,0 +1,113 @@
+"""
+Save signal overhead on untracked models benchmark
+
+    python3 manage.py shell -c "from orchestra.contrib.orchestration.tests.benchmarks import run; run()"
+
+Bulk inserts MonitorData and BillLine objects, like the monitoring and billing tasks do,
+while OperationsMiddleware is collecting operations for a request. Inserts are
+measured with the model signal receivers disconnected, with the legacy receivers that
+inspect every instance and with the current per-model dispatch. Everything is rolled back.
+"""
+import time
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.signals import pre_delete, post_save, post_delete
+from django.utils import timezone
+
+from orchestra.contrib.accounts.models import Account
+from orchestra.contrib.bills.models import Bill, BillLine
+from orchestra.contrib.orders import helpers, settings as orders_settings, signals as orders
+from orchestra.contrib.orders.models import Order
+from orchestra.contrib.resources.models import MonitorData
+from orchestra.core import services
+
+from .. import Operation, managers, middlewares
+from ..middlewares import OperationsMiddleware
+from ..models import BackendLog, BackendOperation, QueuedOperation, DeployedContent
+
+
+class Request(object):
+    pass
+
+
+def legacy_save_collector(sender, *args, **kwargs):
+    if sender not in (BackendLog, BackendOperation, QueuedOperation, DeployedContent):
+        OperationsMiddleware.collect(Operation.SAVE, **kwargs)
+
+
+def legacy_update_orders(sender, **kwargs):
+    if sender._meta.app_label not in orders_settings.ORDERS_EXCLUDED_APPS:
+        instance = kwargs['instance']
+        if type(instance) in services:
+            Order.objects.update_by_instance(instance)
+        elif not hasattr(instance, 'account'):
+            related = helpers.get_related_object(instance)
+            if related and related != instance:
+                Order.objects.update_by_instance(related)
+
+
+RECEIVERS = (
+    (post_save, middlewares.post_save_collector, 'orchestration.post_save_collector'),
+    (pre_delete, middlewares.pre_delete_collector, 'orchestration.pre_delete_collector'),
+    (post_save, managers.post_save_collector, 'orchestration.post_save_manager_collector'),
+    (pre_delete, managers.pre_delete_collector, 'orchestration.pre_delete_manager_collector'),
+    (post_save, orders.update_orders, 'orders.update_orders'),
+    (post_delete, orders.cancel_orders, 'orders.cancel_orders'),
+)
+
+LEGACY_RECEIVERS = (
+    (post_save, legacy_save_collector, 'benchmarks.legacy_save_collector'),
+    (post_save, legacy_update_orders, 'benchmarks.legacy_update_orders'),
+)
+
+
+def connect(receivers):
+    for signal, receiver, dispatch_uid in receivers:
+        signal.connect(receiver, dispatch_uid=dispatch_uid)
+
+
+def disconnect(receivers):
+    for signal, receiver, dispatch_uid in receivers:
+        signal.disconnect(receiver, dispatch_uid=dispatch_uid)
+
+
+def insert(num, account, bill):
+    content_type = ContentType.objects.get_for_model(account)
+    now = timezone.now()
+    start = time.time()
+    for ix in range(num):
+        MonitorData(monitor='benchmark', content_type=content_type, object_id=account.pk,
+            created_at=now, value=Decimal(ix), content_object_repr=str(account)).save()
+        BillLine(bill=bill, description='benchmark', rate=1, quantity=ix, subtotal=ix,
+            tax=0, start_on=now.date()).save()
+    return time.time() - start
+
+
+def measure(num, receivers):
+    account = Account.objects.order_by('pk').first()
+    OperationsMiddleware.thread_locals.request = Request()
+    disconnect(RECEIVERS)
+    connect(receivers)
+    try:
+        with transaction.atomic():
+            bill = Bill.objects.create(account=account, type=Bill.INVOICE)
+            elapsed = insert(num, account, bill)
+            transaction.set_rollback(True)
+    finally:
+        disconnect(receivers)
+        connect(RECEIVERS)
+        del OperationsMiddleware.thread_locals.request
+    return elapsed
+
+
+def run(num=2000):
+    total = num*2
+    baseline = measure(num, ())
+    print("No receivers:       %.2fs (%.0f inserts/s)" % (baseline, total/baseline))
+    legacy = measure(num, LEGACY_RECEIVERS)
+    print("Legacy receivers:   %.2fs (%.0f inserts/s)" % (legacy, total/legacy))
+    current = measure(num, RECEIVERS)
+    print("Per-model dispatch: %.2fs (%.0f inserts/s)" % (current, total/current))
+    print("Speedup:            %.2fx" % (legacy/current))
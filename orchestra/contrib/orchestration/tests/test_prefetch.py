@@ -0,0 +1,90 @@
+from unittest import mock
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from orchestra.contrib.mailboxes.backends import UNIXUserMaildirController
+from orchestra.contrib.mailboxes.models import Mailbox
+from orchestra.contrib.websites.backends.apache import Apache2Controller
+from orchestra.contrib.websites.models import Website
+from orchestra.utils.tests import BaseTestCase
+
+from .. import manager, Operation
+from ..models import Route, Server
+
+
+class PrefetchTests(BaseTestCase):
+    """ prefetch() works on querysets for collect_many(), prefetch_instances() on generate() """
+    def setUp(self):
+        self.account = self.create_account()
+        self.host = Server.objects.create(name='web.example.com')
+
+    def add_route(self, backend):
+        return Route.objects.create(backend=backend.get_name(), host=self.host, match='True')
+
+    def add_websites(self, *names):
+        for name in names:
+            Website.objects.create(name=name, account=self.account)
+
+    def add_mailboxes(self, *names):
+        for name in names:
+            Mailbox.objects.create(name=name, password='test', account=self.account)
+
+    def count_queries(self, func, *args):
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args)
+        return len(context), result
+
+    def collect_many(self, queryset, backend):
+        operations = manager.collect_many(queryset, Operation.SAVE)
+        return [operation for operation in operations if operation.backend is backend]
+
+    def test_generate_prefetch_instances(self):
+        self.add_route(Apache2Controller)
+        self.add_websites('test', 'test2')
+        operations = [
+            Operation(Apache2Controller, website, Operation.SAVE) for website in Website.objects.all()
+        ]
+        with mock.patch.object(Apache2Controller, 'prefetch_instances') as prefetch_instances:
+            with mock.patch.object(Apache2Controller, 'prefetch') as prefetch:
+                scripts, serialize = manager.generate(operations)
+        self.assertEqual(1, len(scripts))
+        # A single call with all the instances, querysets are only prefetched by collect_many()
+        self.assertEqual(1, prefetch_instances.call_count)
+        instances = prefetch_instances.call_args[0][0]
+        self.assertEqual(
+            sorted(Website.objects.values_list('pk', flat=True)), sorted(site.pk for site in instances))
+        self.assertFalse(prefetch.called)
+
+    def test_collect_many_queryset_prefetch(self):
+        self.add_route(Apache2Controller)
+        self.add_websites('test', 'test2')
+        queryset = Website.objects.all()
+        with mock.patch.object(Apache2Controller, 'prefetch', wraps=Apache2Controller.prefetch) as prefetch:
+            queries, operations = self.count_queries(self.collect_many, queryset, Apache2Controller)
+        self.assertEqual(1, prefetch.call_count)
+        self.assertEqual(2, len(operations))
+        # The number of queries does not grow with the number of objects
+        self.add_websites('test3', 'test4', 'test5')
+        more_queries, operations = self.count_queries(self.collect_many, queryset, Apache2Controller)
+        self.assertEqual(5, len(operations))
+        self.assertEqual(queries, more_queries)
+
+    def test_collect_many_instances_prefetch(self):
+        self.add_route(UNIXUserMaildirController)
+        self.add_mailboxes('test', 'test2')
+        queryset = Mailbox.objects.all()
+        queries, operations = self.count_queries(
+            self.collect_many, queryset, UNIXUserMaildirController)
+        self.assertEqual(2, len(operations))
+        self.add_mailboxes('test3', 'test4', 'test5')
+        more_queries, operations = self.count_queries(
+            self.collect_many, queryset, UNIXUserMaildirController)
+        self.assertEqual(5, len(operations))
+        self.assertEqual(queries, more_queries)
+        with mock.patch.object(UNIXUserMaildirController, 'prefetch_instances',
+                wraps=UNIXUserMaildirController.prefetch_instances) as prefetch_instances:
+            scripts, serialize = manager.generate(operations)
+        self.assertEqual(1, len(scripts))
+        self.assertEqual(1, prefetch_instances.call_count)
+        self.assertEqual(5, len(prefetch_instances.call_args[0][0]))
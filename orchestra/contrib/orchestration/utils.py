@@ -1,3 +1,4 @@
+from orchestra.utils.python import toposort
 from orchestra.utils.sys import run, sshrun, join
 
 
@@ -30,3 +31,24 @@ def retrieve_state(servers):
         state[server.pk] = (ping, uptime)
     
     return state
+
+
+def sort_parts(parts):
+    """
+    Sorts [(backend, log, operations)] according to ServiceBackend.dependencies
+    returns [(num, part, dependency_nums)], num being the original position
+    """
+    names = {}
+    for num, (backend, log, operations) in enumerate(parts):
+        names[backend.get_name()] = num
+    dependencies = {}
+    for num, (backend, log, operations) in enumerate(parts):
+        dependencies[num] = [names[name] for name in backend.dependencies if name in names]
+    ordered, cyclic = toposort(range(len(parts)), lambda num: dependencies[num])
+    result = []
+    for num in ordered:
+        result.append((num, parts[num], dependencies[num]))
+    for num in cyclic:
+        # Circular dependencies are ignored
+        result.append((num, parts[num], [dep for dep in dependencies[num] if dep in ordered]))
+    return result
@@ -33,6 +33,15 @@ ORDERS_EXCLUDED_APPS = Setting('ORDERS_EXCLUDED_APPS',
 )
 
 
+ORDERS_EXCLUDED_MODELS = Setting('ORDERS_EXCLUDED_MODELS',
+    (
+        'resources.MonitorData',
+    ),
+    help_text=("Prevent inspecting these models for service accounting, "
+               "useful for high-volume models of otherwise inspected apps."),
+)
+
+
 ORDERS_METRIC_ERROR = Setting('ORDERS_METRIC_ERROR',
     0.05,
     help_text=("Only account for significative changes.<br>"
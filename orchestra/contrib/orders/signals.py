@@ -1,3 +1,4 @@
+from django.apps import apps
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
@@ -7,17 +8,46 @@ from . import helpers, settings
 from .models import Order
 
 
+SKIP, SERVICE, RELATED = range(3)
+
+
+def get_dispatch(sender, cache={}):
+    """
+    Classifies sender models once per process, saves and deletes of
+    excluded models (e.g. MonitorData) or models without relations return right away
+    """
+    try:
+        return cache[sender]
+    except KeyError:
+        pass
+    opts = sender._meta
+    if (opts.app_label in settings.ORDERS_EXCLUDED_APPS or
+            opts.label in settings.ORDERS_EXCLUDED_MODELS):
+        dispatch = SKIP
+    elif sender in services:
+        dispatch = SERVICE
+    elif any(field.rel for field in opts.fields) or any(
+            hasattr(field, 'ct_field') for field in opts.private_fields):
+        dispatch = RELATED
+    else:
+        dispatch = SKIP
+    # services are registered on app loading, don't cache any decision before
+    if apps.ready:
+        cache[sender] = dispatch
+    return dispatch
+
+
 # TODO perhas use cache = caches.get_request_cache() to cache an account delete and don't processes get_related_objects() if the case
 # FIXME https://code.djangoproject.com/ticket/24576
-# TODO build a cache hash table {model: related, model: None}
 @receiver(post_delete, dispatch_uid="orders.cancel_orders")
 def cancel_orders(sender, **kwargs):
-    if sender._meta.app_label not in settings.ORDERS_EXCLUDED_APPS:
+    dispatch = get_dispatch(sender)
+    if dispatch != SKIP:
         instance = kwargs['instance']
         # Account delete will delete all related orders, no need to maintain order consistency
         if isinstance(instance, Order.account.field.rel.to):
             return
-        if type(instance) in services:
+        if dispatch == SERVICE:
             for order in Order.objects.by_object(instance).active():
                 order.cancel()
         elif not hasattr(instance, 'account'):
@@ -29,11 +59,12 @@ def cancel_orders(sender, **kwargs):
 
 @receiver(post_save, dispatch_uid="orders.update_orders")
 def update_orders(sender, **kwargs):
-    if sender._meta.app_label not in settings.ORDERS_EXCLUDED_APPS:
+    dispatch = get_dispatch(sender)
+    if dispatch == SERVICE:
+        Order.objects.update_by_instance(kwargs['instance'])
+    elif dispatch == RELATED:
         instance = kwargs['instance']
-        if type(instance) in services:
-            Order.objects.update_by_instance(instance)
-        elif not hasattr(instance, 'account'):
+        if not hasattr(instance, 'account'):
             related = helpers.get_related_object(instance)
             if related and related != instance:
                 Order.objects.update_by_instance(related)
@@ -1,4 +1,4 @@
-from .backends import ServiceMonitor
+from .backends import ServiceMonitor, ServiceLogMonitor
 
 
 default_app_config = 'orchestra.contrib.resources.apps.ResourcesConfig'
@@ -22,7 +22,7 @@ from orchestra.utils import db, sys
 from orchestra.utils.functional import cached
 
 from .actions import run_monitor, show_history
-from .api import history_data
+from .api import history_data, history_series
 from .filters import ResourceDataListFilter
 from .forms import ResourceForm
 from .models import Resource, ResourceData, MonitorData
@@ -114,12 +114,12 @@ content_object_link.allow_tags = True
 class ResourceDataAdmin(ExtendedModelAdmin):
     list_display = (
         'id', 'resource_link', content_object_link, 'allocated', 'display_used',
-        'display_updated'
+        'display_updated', 'state'
     )
-    list_filter = ('resource',)
+    list_filter = ('resource', 'state')
     fields = (
         'resource_link', 'content_type', content_object_link, 'display_updated', 'display_used',
-        'allocated',
+        'allocated', 'state',
     )
     search_fields = ('content_object_repr',)
     readonly_fields = fields
@@ -145,6 +145,10 @@ class ResourceDataAdmin(ExtendedModelAdmin):
                 admin_site.admin_view(history_data),
                 name='%s_%s_history_data' % (opts.app_label, opts.model_name)
             ),
+            url('^history_series/$',
+                admin_site.admin_view(history_series),
+                name='%s_%s_history_series' % (opts.app_label, opts.model_name)
+            ),
             url('^list-related/(.+)/(.+)/(\d+)/$',
                 admin_site.admin_view(self.list_related_view),
                 name='%s_%s_list_related' % (opts.app_label, opts.model_name)
@@ -2,6 +2,7 @@ import datetime
 import decimal
 import itertools
 
+from django.db.models import Avg, Sum
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -13,6 +14,8 @@ from orchestra import plugins
 class Aggregation(plugins.Plugin, metaclass=plugins.PluginMount):
     """ filters and computes dataset usage """
     aggregated_history = False
+    # Database aggregate of the values that fall on the same history bucket
+    history_aggregate = Avg
     
     def filter(self, dataset):
         """ Filter the dataset to get the relevant data according to the period """
@@ -65,6 +68,7 @@ class MonthlySum(Last):
     name = 'monthly-sum'
     verbose_name = _("Monthly Sum")
     aggregated_history = True
+    history_aggregate = Sum
     
     def filter(self, dataset, date=None):
         if date is None:
@@ -112,6 +116,7 @@ class MonthlyAvg(MonthlySum):
     name = 'monthly-avg'
     verbose_name = _("Monthly AVG")
     aggregated_history = False
+    history_aggregate = Avg
     
     def get_epoch(self, date=None):
         if date is None:
@@ -1,9 +1,12 @@
+import datetime
 import json
 from urllib.parse import parse_qs
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
-from .helpers import get_history_data
+from .helpers import HISTORY_BUCKETS, get_history_data, get_history_series
 from .models import ResourceData
 
 
@@ -13,3 +16,55 @@ def history_data(request):
     history = get_history_data(queryset)
     response = json.dumps(history, indent=4)
     return HttpResponse(response, content_type="application/json")
+
+
+def parse_history_date(value):
+    """ ISO date or datetime, naive values are on the current timezone """
+    date = parse_datetime(value)
+    if date is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("%s is not a valid date." % value)
+        date = datetime.datetime.combine(date, datetime.time.min)
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+def history_series(request):
+    """
+    ?ids=<resource data ids>&bucket=hour|day|month&ini=<date>&end=<date>
+    streams the history as columnar series, one monitor query at a time
+    """
+    query = parse_qs(request.META['QUERY_STRING'])
+    bucket = query.get('bucket', ['day'])[0]
+    try:
+        ids = [int(pk) for pk in query['ids'][0].split(',')]
+        ini = parse_history_date(query['ini'][0]) if 'ini' in query else None
+        end = parse_history_date(query['end'][0]) if 'end' in query else None
+    except (KeyError, ValueError) as error:
+        return HttpResponseBadRequest(str(error))
+    if bucket not in HISTORY_BUCKETS:
+        return HttpResponseBadRequest("bucket should be one of %s." % ', '.join(HISTORY_BUCKETS))
+    queryset = ResourceData.objects.filter(id__in=ids).select_related('resource')
+    
+    def stream():
+        objects = []
+        for rdata in queryset:
+            resource = rdata.resource
+            objects.append({
+                'id': rdata.pk,
+                'object_name': rdata.content_object_repr,
+                'resource': resource.name,
+                'verbose_name': str(resource.get_verbose_name()),
+                'aggregation': str(resource.aggregation_instance.verbose_name),
+                'unit': resource.unit,
+                'current': round(float(rdata.used or 0), 3),
+                'allocated': float(rdata.allocated) if rdata.allocated is not None else None,
+            })
+        yield '{"bucket": %s, "objects": %s, "series": [' % (json.dumps(bucket), json.dumps(objects))
+        for ix, serie in enumerate(get_history_series(queryset, bucket=bucket, ini=ini, end=end)):
+            yield (',\n' if ix else '\n') + json.dumps(serie)
+        yield '\n]}\n'
+    
+    return StreamingHttpResponse(stream(), content_type="application/json")
@@ -1,4 +1,6 @@
 import datetime
+import os
+import textwrap
 
 from django.utils import timezone
 from django.utils.functional import cached_property
@@ -6,7 +8,7 @@ from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceBackend
 
-from . import helpers
+from . import diskscan, helpers, logscan, settings
 
 
 class ServiceMonitor(ServiceBackend):
@@ -56,6 +58,28 @@ class ServiceMonitor(ServiceBackend):
             return self.current_date - datetime.timedelta(days=1)
         return data.created_at
     
+    def get_last_dates(self, object_ids):
+        """ get_last_date() of many objects with a single query """
+        from django.db.models import Max
+        from .models import MonitorData
+        dataset = MonitorData.objects.filter(content_type=self.content_type,
+            monitor=self.get_name(), object_id__in=object_ids)
+        dataset = dataset.values('object_id').annotate(last=Max('created_at'))
+        last_dates = dict.fromkeys(object_ids, self.current_date - datetime.timedelta(days=1))
+        last_dates.update(dataset.values_list('object_id', 'last'))
+        return last_dates
+    
+    def get_checkpoint_path(self):
+        return os.path.join(settings.RESOURCES_MONITOR_CHECKPOINTS_DIR, '%s.json' % self.get_name())
+    
+    def append_logscan(self):
+        """ incremental log scanning for python monitoring scripts, see logscan """
+        self.append(logscan.get_source())
+    
+    def append_diskscan(self):
+        """ quota based and incremental disk usage for python monitoring scripts, see diskscan """
+        self.append(diskscan.get_source())
+    
     def process(self, line):
         """ line -> object_id, value, state"""
         result = line.split()
@@ -98,3 +122,133 @@ class ServiceMonitor(ServiceBackend):
             return helpers.delete_old_equal_values(dataset)
         elif cls.monthly_sum_old_values:
             return helpers.monthly_sum_old_values(dataset)
+
+
+class ServiceLogMonitor(ServiceMonitor):
+    """
+    Base class for traffic monitors that parse logs on the server, see logscan.
+    A single python script is generated per server, every log is read once, for all
+    the monitored objects, and only the lines appended since the previous run.
+    
+    Subclasses provide:
+        matcher: logscan expression that builds the line matcher of a log,
+            with <tt>keys</tt> (key: object_id of the log) and <tt>checkpoint</tt> in scope
+        parse_date: logscan date parser, only used on logs without checkpoint
+        get_key(obj): key that identifies obj on the log lines
+        get_log_files(obj): logs where obj traffic is found
+    
+    Offsets are shared by all the objects of a log: when only some objects are monitored
+    (e.g. ResourceData.monitor()) the other objects routed to the server are matched as well,
+    and their traffic is kept on the checkpoint until they are monitored. Monitors with a
+    log per object set shared_logs to False and skip this.
+    """
+    resource = ServiceMonitor.TRAFFIC
+    script_executable = '/usr/bin/python3'
+    monthly_sum_old_values = True
+    abstract = True
+    matcher = None
+    parse_date = None
+    shared_logs = True
+    
+    def __init__(self):
+        super(ServiceLogMonitor, self).__init__()
+        self.monitored = set()
+        self.partial = False
+    
+    def get_key(self, obj):
+        raise NotImplementedError
+    
+    def get_log_files(self, obj):
+        raise NotImplementedError
+    
+    def get_matcher(self):
+        return self.matcher
+    
+    def get_exclude_hosts(self):
+        """ client addresses, on the first field of the log lines, that are not accounted """
+        return ()
+    
+    def prepare(self):
+        self.append_logscan()
+        context = {
+            'checkpoint': self.get_checkpoint_path(),
+            'exclude_hosts': tuple(self.get_exclude_hosts()),
+        }
+        self.append(textwrap.dedent("""
+            checkpoint = Checkpoint(%(checkpoint)r)
+            exclude = get_exclude(%(exclude_hosts)r)
+            # {key: traffic} of objects not monitored on previous runs
+            pending = checkpoint.data.setdefault('pending', {})
+            objects = {}
+            ini_dates = {}
+            logs = {}
+            
+            def prepare(object_id, key, ini_date, *log_files):
+                objects[key] = object_id
+                ini_dates[key] = ini_date
+                for log_file in log_files:
+                    logs.setdefault(log_file, {})[key] = object_id
+            
+            def prepare_pending(key, ini_date, *log_files):
+                # Objects not being monitored, only matched on logs that are read anyway
+                ini_dates.setdefault(key, ini_date)
+                for log_file in log_files:
+                    if log_file in logs:
+                        logs[log_file].setdefault(key, None)
+            
+            def report(object_id, key, size):
+                print(object_id, size)
+            """) % context
+        )
+    
+    def monitor(self, obj):
+        self.monitored.add(obj.pk)
+        # Set by tasks.get_monitor_operations() when only some objects are monitored
+        if getattr(obj, 'partial_monitor', False):
+            self.partial = True
+        context = {
+            'object_id': obj.pk,
+            'key': self.get_key(obj),
+            'last_date': self.get_last_date(obj.pk).timestamp(),
+            'log_files': ', '.join(map(repr, self.get_log_files(obj))),
+        }
+        self.append("prepare(%(object_id)i, %(key)r, %(last_date)i, %(log_files)s)" % context)
+    
+    def get_unmonitored(self):
+        """ objects routed to the same server that are not being monitored on partial runs """
+        if not self.partial or not self.shared_logs or self.route is None:
+            return []
+        objects = self.model_class().objects.exclude(pk__in=self.monitored)
+        return [obj for obj in objects if self.route.matches(obj)]
+    
+    def commit(self):
+        unmonitored = self.get_unmonitored()
+        last_dates = self.get_last_dates([obj.pk for obj in unmonitored])
+        for obj in unmonitored:
+            context = {
+                'key': self.get_key(obj),
+                'last_date': last_dates[obj.pk].timestamp(),
+                'log_files': ', '.join(map(repr, self.get_log_files(obj))),
+            }
+            self.append("prepare_pending(%(key)r, %(last_date)i, %(log_files)s)" % context)
+        context = {
+            'matcher': self.get_matcher(),
+            'parse_date': self.parse_date,
+            'complete': not self.partial,
+        }
+        self.append(textwrap.dedent("""
+            totals = {}
+            for log_file, keys in logs.items():
+                match = %(matcher)s
+                scan(checkpoint, log_file, match, %(parse_date)s, ini_dates, totals, exclude=exclude)
+            sizes = {key: totals.get(key, 0) + pending.pop(key, 0) for key in objects}
+            if %(complete)r:
+                # Every object has been monitored, what is left belongs to removed objects
+                pending.clear()
+            for key, total in totals.items():
+                if key not in objects and total:
+                    pending[key] = pending.get(key, 0) + total
+            checkpoint.save()
+            for key, object_id in objects.items():
+                report(object_id, key, sizes[key])""") % context
+        )
@@ -0,0 +1,196 @@
+"""
+Incremental disk usage for disk monitors
+
+This module is shipped verbatim at the beginning of the monitoring scripts, so it only
+depends on the Python 3 standard library. Filesystem quotas are preferred, with one
+report per filesystem: XFS project quotas (directories listed on /etc/projects) and
+user quotas (repquota). Directories without quotas fall back to an incremental du:
+a cache keeps the mtime, files size and subdirectories of every directory, so
+unchanged directories cost a single lstat instead of a stat per file.
+"""
+import json
+import os
+import random
+import stat
+import subprocess
+import time
+
+
+# Files modified in place do not change the mtime of their directory,
+# cached directories are refreshed after a randomized period
+RESCAN_PERIOD = 7*24*60*60
+
+
+def get_mounts(options=()):
+    """ {mount_point: (fs_type, options)} of the mounted filesystems """
+    mounts = {}
+    with open('/proc/mounts', 'r') as handler:
+        for line in handler:
+            __, mount_point, fs_type, fs_options = line.split()[:4]
+            fs_options = {option.split('=')[0] for option in fs_options.split(',')}
+            if not options or fs_options.intersection(options):
+                mounts[mount_point.replace('\\040', ' ')] = (fs_type, fs_options)
+    return mounts
+
+
+def get_mount_point(path, mounts):
+    """ longest mount point that contains path """
+    path = os.path.realpath(path)
+    while path not in mounts:
+        if path == '/':
+            return None
+        path = os.path.dirname(path)
+    return path
+
+
+def read_projects(path='/etc/projects'):
+    """ {directory: project_id} of XFS project quotas """
+    projects = {}
+    try:
+        with open(path, 'r') as handler:
+            for line in handler:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    project_id, directory = line.split(':', 1)
+                    projects[os.path.normpath(directory)] = project_id
+    except FileNotFoundError:
+        pass
+    return projects
+
+
+def run(cmd):
+    """ stdout lines, or nothing when quotas are not available """
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return output.decode('utf8', 'replace').splitlines()
+
+
+def project_usage(mount_point):
+    """ {project_id: bytes} xfs_quota report, blocks of 1KiB """
+    usage = {}
+    for line in run(['xfs_quota', '-x', '-c', 'report -p -b -n -N', mount_point]):
+        fields = line.split()
+        if len(fields) > 1 and fields[0].startswith('#') and fields[1].isdigit():
+            usage[fields[0][1:]] = int(fields[1])*1024
+    return usage
+
+
+def user_usage(mount_point):
+    """ {username: bytes} repquota report, blocks of 1KiB """
+    usage = {}
+    for line in run(['repquota', '-u', '-O', 'csv', mount_point]):
+        fields = line.split(',')
+        if len(fields) > 3 and fields[3].isdigit():
+            usage[fields[0]] = int(fields[3])*1024
+    return usage
+
+
+class DirectoryCache(object):
+    """ {directory: [mtime, expires, files_size, subdirectories]} stored as JSON """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as handler:
+                self.dirs = json.loads(handler.read())
+        except (FileNotFoundError, ValueError):
+            self.dirs = {}
+        self.seen = set()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Removed directories are not kept
+        dirs = {path: entry for path, entry in self.dirs.items() if path in self.seen}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as handler:
+            handler.write(json.dumps(dirs))
+        os.rename(tmp_path, self.path)
+
+    def list_dir(self, path):
+        """ (size of the non-directory entries, subdirectories) """
+        size = 0
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    pass
+        return size, subdirs
+
+    def du(self, home, now=None):
+        """ apparent size of home, like du -bs, only listing changed directories """
+        now = now or time.time()
+        total = 0
+        stack = [home]
+        while stack:
+            path = stack.pop()
+            try:
+                dir_stat = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            total += dir_stat.st_size
+            if not stat.S_ISDIR(dir_stat.st_mode):
+                continue
+            self.seen.add(path)
+            entry = self.dirs.get(path)
+            if entry is None or entry[0] != dir_stat.st_mtime_ns or entry[1] < now:
+                try:
+                    size, subdirs = self.list_dir(path)
+                except (FileNotFoundError, PermissionError):
+                    continue
+                expires = now + RESCAN_PERIOD*random.uniform(0.5, 1)
+                entry = self.dirs[path] = [dir_stat.st_mtime_ns, expires, size, subdirs]
+            total += entry[2]
+            stack.extend(os.path.join(path, subdir) for subdir in entry[3])
+        return total
+
+
+def disk_usage(homes, cache_dir, quotas=('project', 'user')):
+    """
+    {key: bytes} of homes {key: directory}, key is the username
+    quotas: enabled quota reports, 'project' and/or 'user'
+    """
+    usage = {}
+    pending = dict(homes)
+    if 'project' in quotas:
+        projects = read_projects()
+        mounts = get_mounts(('prjquota', 'pquota'))
+        reports = {}
+        for key, home in list(pending.items()):
+            project_id = projects.get(os.path.normpath(home))
+            mount_point = get_mount_point(home, mounts) if project_id else None
+            if mount_point:
+                if mount_point not in reports:
+                    reports[mount_point] = project_usage(mount_point)
+                if project_id in reports[mount_point]:
+                    usage[key] = reports[mount_point][project_id]
+                    pending.pop(key)
+    if 'user' in quotas and pending:
+        mounts = get_mounts(('usrquota', 'uquota', 'usrjquota'))
+        reports = {}
+        for key, home in list(pending.items()):
+            mount_point = get_mount_point(home, mounts)
+            if mount_point:
+                if mount_point not in reports:
+                    reports[mount_point] = user_usage(mount_point)
+                if key in reports[mount_point]:
+                    usage[key] = reports[mount_point][key]
+                    pending.pop(key)
+    for key, home in pending.items():
+        cache = DirectoryCache(os.path.join(cache_dir, '%s.json' % key))
+        usage[key] = cache.du(home)
+        cache.save()
+    return usage
+
+
+def get_source():
+    """ module source, to be embedded into monitoring scripts """
+    with open(__file__.replace('.pyc', '.py'), 'r') as handler:
+        return handler.read()
@@ -1,5 +1,7 @@
 import decimal
+from collections import OrderedDict, deque
 
+from django.db.models.functions import Trunc
 from django.template.defaultfilters import date as date_format
 
 
@@ -83,6 +85,162 @@ def get_history_data(queryset):
     return result
 
 
+HISTORY_BUCKETS = ('hour', 'day', 'month')
+
+
+def get_history_series(queryset, bucket='day', ini=None, end=None):
+    """
+    yields the history of the ResourceData queryset as columnar series,
+    values are aggregated per bucket (hour, day or month) by the database:
+    one query per monitor, for all the objects
+        {'id', 'monitor', 'dates': [epoch ms], 'values': [scaled values]}
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from .backends import ServiceMonitor
+    from .models import MonitorData
+    if bucket not in HISTORY_BUCKETS:
+        raise ValueError("%s is not a valid bucket, choose from %s." % (bucket, HISTORY_BUCKETS))
+    groups = OrderedDict()
+    for rdata in queryset.select_related('resource'):
+        resource = rdata.resource
+        for monitor in resource.monitors:
+            key = (resource, monitor)
+            groups.setdefault(key, []).append(rdata)
+    for (resource, monitor), rdatas in groups.items():
+        scale = resource.get_scale()
+        aggregate = resource.aggregation_instance.history_aggregate
+        # {monitored object_id: rdata}, monitors of related objects are summed up
+        path = resource.get_model_path(monitor)
+        monitor_model = ServiceMonitor.get_backend(monitor).model_class()
+        rdata_ids = {rdata.object_id: rdata for rdata in rdatas}
+        if path == []:
+            objects = rdata_ids
+        else:
+            field = '__'.join(path)
+            objects = monitor_model.objects.filter(**{
+                field + '__in': rdata_ids,
+            }).values_list('id', field)
+            objects = {pk: rdata_ids[rdata_id] for pk, rdata_id in objects}
+        dataset = MonitorData.objects.filter(
+            monitor=monitor,
+            content_type=ContentType.objects.get_for_model(monitor_model),
+            object_id__in=objects,
+        )
+        if ini is not None:
+            dataset = dataset.filter(created_at__gte=ini)
+        if end is not None:
+            dataset = dataset.filter(created_at__lt=end)
+        dataset = dataset.annotate(bucket=Trunc('created_at', bucket)).values('object_id', 'bucket')
+        dataset = dataset.annotate(total=aggregate('value')).order_by('bucket')
+        series = OrderedDict()
+        for object_id, date, value in dataset.values_list('object_id', 'bucket', 'total').iterator():
+            serie = series.setdefault(objects[object_id].pk, OrderedDict())
+            date = int(date.timestamp())*1000
+            serie[date] = serie.get(date, 0) + float(value)
+        for rdata_id, serie in series.items():
+            yield {
+                'id': rdata_id,
+                'monitor': monitor,
+                'dates': list(serie.keys()),
+                'values': [round(value/scale, 3) for value in serie.values()],
+            }
+
+
+def get_sampling_intervals(resource, max_interval, samples=5, tolerance=0.05, limit=0.8, ini=None):
+    """
+    {object_id: runs between samples} of the objects of resource, from 1 to max_interval,
+    based on the changes between the last samples values of each monitor:
+        objects close to their allocation (used >= allocated*limit), with a short history
+        or with relative changes above tolerance are sampled on every run,
+        the interval of stable objects grows up to max_interval
+    one query per monitor, for all the objects
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from .backends import ServiceMonitor
+    from .models import MonitorData
+    changes = {}
+    for monitor in resource.monitors:
+        # {monitored object_id: object_id}, changes of related objects are combined
+        path = resource.get_model_path(monitor)
+        monitor_model = ServiceMonitor.get_backend(monitor).model_class()
+        objects = None
+        if path != []:
+            objects = dict(monitor_model.objects.values_list('id', '__'.join(path)))
+        dataset = MonitorData.objects.filter(
+            monitor=monitor,
+            content_type=ContentType.objects.get_for_model(monitor_model),
+        )
+        if ini is not None:
+            dataset = dataset.filter(created_at__gte=ini)
+        dataset = dataset.order_by('object_id', 'created_at').values_list('object_id', 'value')
+        series = {}
+        for object_id, value in dataset.iterator():
+            series.setdefault(object_id, deque(maxlen=samples)).append(float(value))
+        for object_id, serie in series.items():
+            if objects is not None:
+                object_id = objects.get(object_id)
+            change = None
+            if len(serie) == samples:
+                serie = list(serie)
+                change = max(abs(value-prev)/max(abs(prev), 1) for prev, value in zip(serie, serie[1:]))
+            changes.setdefault(object_id, []).append(change)
+    intervals = {}
+    for object_id, used, allocated in resource.dataset.values_list('object_id', 'used', 'allocated'):
+        change = changes.get(object_id, [None])
+        if None in change or used is None or (allocated and float(used) >= allocated*limit):
+            intervals[object_id] = 1
+        else:
+            stability = 1 - min(max(change)/tolerance, 1) if tolerance else 0
+            intervals[object_id] = 1 + int(round((max_interval-1)*stability))
+    return intervals
+
+
+def prefetch_resources(objects, names=None):
+    """
+    loads the ResourceData of objects (queryset or list) with a single query,
+    obj.resources.<name> is served from the per-object cache afterwards
+        names: resource names, all the active resources of the model by default
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from .models import Resource, ResourceData
+    objects = list(objects)
+    by_model = OrderedDict()
+    for obj in objects:
+        if obj.pk is not None:
+            by_model.setdefault(type(obj), []).append(obj)
+    for model, model_objects in by_model.items():
+        content_type = ContentType.objects.get_for_model(model)
+        resources = Resource.objects.filter(content_type=content_type, is_active=True)
+        if names is not None:
+            resources = resources.filter(name__in=names)
+        resources = list(resources)
+        if not resources:
+            continue
+        rdatas = ResourceData.objects.filter(
+            content_type=content_type,
+            object_id__in=[obj.pk for obj in model_objects],
+            resource__in=resources,
+        ).select_related('resource')
+        rdatas = {(rdata.object_id, rdata.resource_id): rdata for rdata in rdatas}
+        for obj in model_objects:
+            try:
+                cache = obj._resource_cache
+            except AttributeError:
+                cache = obj._resource_cache = {}
+            for resource in resources:
+                rdata = rdatas.get((obj.pk, resource.pk))
+                if rdata is None:
+                    rdata = ResourceData(
+                        content_object_repr=str(obj),
+                        resource=resource,
+                        allocated=resource.default_allocation
+                    )
+                # Avoids fetching obj again
+                rdata.content_object = obj
+                cache[resource.name] = rdata
+    return objects
+
+
 def delete_old_equal_values(dataset):
     """ only first and last values of an equal serie (+-error) are kept """
     prev_value = None
@@ -0,0 +1,349 @@
+"""
+Incremental log scanning for traffic monitors
+
+This module is shipped verbatim at the beginning of the monitoring scripts, so it only
+depends on the Python 3 standard library. A checkpoint file keeps the inode, byte
+offset and first bytes of every scanned log: each run only reads the lines appended
+since the previous one, following rotations by inode (log.1) or by content (log.1.gz).
+Logs without checkpoint (first run) are read along with their rotated file and
+filtered by date.
+"""
+import calendar
+import fcntl
+import gzip
+import json
+import os
+import re
+import time
+
+
+MONTHS = {
+    b'Jan': 1, b'Feb': 2, b'Mar': 3, b'Apr': 4, b'May': 5, b'Jun': 6,
+    b'Jul': 7, b'Aug': 8, b'Sep': 9, b'Oct': 10, b'Nov': 11, b'Dec': 12,
+}
+# Bytes used for recognizing a log once it has been rotated and compressed
+HEAD_SIZE = 64
+
+
+def local_epoch(year, month, day, hour, minute, second):
+    return time.mktime((year, month, day, hour, minute, second, 0, 0, -1))
+
+
+def parse_clf_date(line):
+    """ b'... [11/Jul/2014:13:50:41 +0200] ...' -> epoch, without strptime """
+    ix = line.index(b'[') + 1
+    date = line[ix:ix+26]
+    epoch = calendar.timegm((
+        int(date[7:11]), MONTHS[date[3:6]], int(date[0:2]),
+        int(date[12:14]), int(date[15:17]), int(date[18:20]),
+    ))
+    offset = (int(date[22:24])*60 + int(date[24:26])) * 60
+    if date[21:22] == b'-':
+        return epoch + offset
+    return epoch - offset
+
+
+def parse_syslog_date(line):
+    """ b'Mar  9 17:13:22 host ...' -> epoch, the year is not logged """
+    now = time.localtime()
+    month = MONTHS[line[0:3]]
+    year = now.tm_year
+    if month == 12 and now.tm_mon == 1:
+        year -= 1
+    return local_epoch(year, month, int(line[4:6]),
+        int(line[7:9]), int(line[10:12]), int(line[13:15]))
+
+
+def parse_iso_date(line):
+    """ b'2016-03-09 17:13:22 ...' -> epoch """
+    return local_epoch(int(line[0:4]), int(line[5:7]), int(line[8:10]),
+        int(line[11:13]), int(line[14:16]), int(line[17:19]))
+
+
+def parse_ctime_date(line):
+    """ b'Wed Mar  9 17:13:22 2016 ...' -> epoch """
+    return local_epoch(int(line[20:24]), MONTHS[line[4:7]], int(line[8:10]),
+        int(line[11:13]), int(line[14:16]), int(line[17:19]))
+
+
+def parse_mailman_date(line):
+    """ b'Mar 09 17:13:22 2016 (1234) ...' -> epoch """
+    return local_epoch(int(line[16:20]), MONTHS[line[0:3]], int(line[4:6]),
+        int(line[7:9]), int(line[10:12]), int(line[13:15]))
+
+
+def open_log(name):
+    if name.endswith('.gz'):
+        return gzip.open(name, 'rb')
+    return open(name, 'rb')
+
+
+def read_head(name):
+    try:
+        with open_log(name) as handler:
+            return handler.read(HEAD_SIZE).decode('latin-1')
+    except (OSError, EOFError):
+        return None
+
+
+def is_same_log(name, head):
+    """ whether name starts with head, the first bytes of the log when it was checkpointed """
+    current = read_head(name)
+    return current is not None and current[:len(head)] == head
+
+
+class Checkpoint(object):
+    """
+    {'logs': {path: [inode, offset, head]}, 'data': {}} stored as JSON,
+    data is available for matchers that keep state between runs
+    
+    An exclusive lock is held from loading until save(), concurrent runs of the same monitor
+    would otherwise read the same lines and overwrite each other's offsets
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = open(path + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(path, 'r') as handler:
+                state = json.loads(handler.read())
+        except (FileNotFoundError, ValueError):
+            state = {}
+        self.logs = state.get('logs', {})
+        self.data = state.get('data', {})
+
+    def save(self):
+        state = {
+            'logs': self.logs,
+            'data': self.data,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as handler:
+            handler.write(json.dumps(state))
+        os.rename(tmp_path, self.path)
+        self.release()
+    
+    def release(self):
+        """ releases the lock without saving, e.g. on errors """
+        if not self.lock.closed:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+
+    def get_files(self, path):
+        """ returns (resumed, [(file, offset)]) to be read in order """
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            self.logs.pop(path, None)
+            return True, []
+        rotated = path + '.1'
+        try:
+            rotated_inode = os.stat(rotated).st_ino
+        except FileNotFoundError:
+            rotated_inode = None
+        try:
+            last_inode, offset, head = self.logs[path]
+        except (KeyError, ValueError):
+            files = [(path, 0)]
+            if rotated_inode is not None:
+                files.insert(0, (rotated, 0))
+            elif os.path.exists(rotated + '.gz'):
+                files.insert(0, (rotated + '.gz', 0))
+            return False, files
+        # Inodes of removed files are reused, heads are compared as well
+        if last_inode == inode and is_same_log(path, head):
+            if os.path.getsize(path) < offset:
+                # Truncated
+                offset = 0
+            return True, [(path, offset)]
+        if last_inode == rotated_inode and is_same_log(rotated, head):
+            return True, [(rotated, offset), (path, 0)]
+        if rotated_inode is None and is_same_log(rotated + '.gz', head):
+            # Compressed on rotation
+            return True, [(rotated + '.gz', offset), (path, 0)]
+        # Rotated more than once since the last run, the remainder is lost
+        return True, [(path, 0)]
+
+    def read(self, path):
+        """ returns (resumed, lines), lines appended to path are lazily yielded """
+        resumed, files = self.get_files(path)
+        return resumed, self.iter_lines(path, files)
+
+    def iter_lines(self, path, files):
+        """ yields complete lines, updating the checkpoint of path when exhausted """
+        for ix, (name, offset) in enumerate(files):
+            with open_log(name) as handler:
+                handler.seek(offset)
+                for line in handler:
+                    if not line.endswith(b'\n'):
+                        # Still being written
+                        break
+                    offset += len(line)
+                    yield line
+                if ix == len(files)-1:
+                    inode = os.fstat(handler.fileno()).st_ino
+                    handler.seek(0)
+                    head = handler.read(HEAD_SIZE).decode('latin-1')
+                    self.logs[path] = [inode, offset, head]
+
+
+def get_exclude(hosts):
+    """ compiled once, returns a predicate of the lines whose first field is one of hosts """
+    if not hosts:
+        return None
+    regex = re.compile(b'(?:%s) ' % b'|'.join(re.escape(host.encode()) for host in hosts))
+    return regex.match
+
+
+def scan(checkpoint, path, match, parse_date, ini, totals, exclude=None):
+    """
+    adds the values of the lines appended to path to totals
+        match: line -> (key, value) or None
+        parse_date: line -> epoch, only used on logs without checkpoint
+        ini: {key: epoch} lines before ini are ignored on logs without checkpoint
+    """
+    resumed, lines = checkpoint.read(path)
+    for line in lines:
+        if exclude and exclude(line):
+            continue
+        result = match(line)
+        if result is None:
+            continue
+        key, value = result
+        if resumed or parse_date(line) > ini.get(key, 0):
+            totals[key] = totals.get(key, 0) + value
+
+
+def last_field_int(keys):
+    """ matcher of the log of a single object, with lines that end with a size """
+    key = next(iter(keys))
+    def match(line):
+        value = line.rsplit(None, 1)[-1]
+        if value.isdigit():
+            return key, int(value)
+        return None
+    return match
+
+
+def host_matcher(hosts, include_received=False):
+    """ Apache logs shared by many sites, ... %>s [%I] %O %{Host}i """
+    def match(line):
+        fields = line.rsplit(None, 3)
+        host = fields[-1].decode()
+        if host not in hosts or not fields[-2].isdigit():
+            return None
+        size = int(fields[-2])
+        if include_received and fields[-3].isdigit():
+            size += int(fields[-3])
+        return host, size
+    return match
+
+
+class PostfixMailscannerMatcher(object):
+    """
+    size of the messages sent by authenticated users times their delivered recipients
+        <id>: client=..., sasl_method=PLAIN, sasl_username=... (Authenticated sender: <user>)
+        MailScanner ... Requeue: <id>.<n> to <req_id>
+        postfix/qmgr ... <req_id>: from=<...>, size=<size>, nrcpt=...
+        postfix/smtp ... <req_id>: to=<...>, ..., status=sent
+    in-flight messages are kept on the checkpoint data until the next run
+    """
+    user_regex = re.compile(rb'\(Authenticated sender: ([^ ]+)\)')
+
+    def __init__(self, checkpoint, users):
+        self.users = users
+        self.data = checkpoint.data.setdefault('postfix', {})
+        # Messages of the previous run are carried over only once
+        self.delivers = self.data.pop('delivers', {})
+        self.targets = self.data.pop('targets', {})
+        self.new_delivers = self.data['delivers'] = {}
+        self.new_targets = self.data['targets'] = {}
+
+    def __call__(self, line):
+        if b'(Authenticated sender: ' in line:
+            username = self.user_regex.search(line).group(1).decode()
+            if username in self.users:
+                msg_id = line.split()[5][:-1].decode()
+                self.delivers[msg_id] = self.new_delivers[msg_id] = username
+        elif b' Requeue: ' in line:
+            msg_id, __, req_id = line.split()[6:9]
+            msg_id = msg_id.split(b'.')[0].decode()
+            username = self.delivers.get(msg_id)
+            if username is not None:
+                target = [username, 0]
+                req_id = req_id.decode()
+                self.targets[req_id] = self.new_targets[req_id] = target
+        elif b' postfix/' in line:
+            fields = line.split(None, 8)
+            if len(fields) < 8:
+                return None
+            proc, req_id, msize = fields[4], fields[5][:-1].decode(), fields[7]
+            target = self.targets.get(req_id)
+            if target is None:
+                return None
+            if msize.startswith(b'size='):
+                target[1] = int(msize[5:-1])
+            elif proc.startswith(b'postfix/smtp'):
+                return target[0], target[1]
+        return None
+
+
+def exim4_matcher(users):
+    """ messages sent from the server by local users, U=<user> ... S=<size> """
+    user_regex = re.compile(rb' U=([^ ]+) ')
+    size_regex = re.compile(rb' S=([0-9]+)')
+    def match(line):
+        if b' <= ' in line and b'P=local' in line:
+            username = user_regex.search(line)
+            if username:
+                username = username.group(1).decode()
+                if username in users:
+                    return username, int(size_regex.search(line).group(1))
+        return None
+    return match
+
+
+def vsftpd_matcher(users):
+    """ transfers of users, [<user>] OK ... , <size> bytes, """
+    user_regex = re.compile(rb'\] \[([^ ]+)\] (?:OK|FAIL) ')
+    bytes_regex = re.compile(rb', ([0-9]+) bytes, ')
+    def match(line):
+        if b' bytes, ' in line:
+            username = user_regex.search(line)
+            if username:
+                username = username.group(1).decode()
+                if username in users:
+                    return username, int(bytes_regex.search(line).group(1))
+        return None
+    return match
+
+
+def mailman_matcher(lists):
+    """ post to <list> from <addr>, size=<size>, discarding mailman messages """
+    mailman_addr = re.compile(
+        rb'.*-(admin|bounces|confirm|join|leave|owner|request|subscribe|unsubscribe)@.*|mailman@.*')
+    def match(line):
+        fields = line.split()
+        if len(fields) < 11:
+            return None
+        list_name = fields[7].decode()
+        if list_name not in lists:
+            return None
+        # discard mailman messages because of inconsistent POST logging
+        if mailman_addr.match(fields[9]):
+            return None
+        size = fields[10][5:-1]
+        if not size.isdigit():
+            # anonymized post
+            return None
+        return list_name, int(size)
+    return match
+
+
+def get_source():
+    """ module source, to be embedded into monitoring scripts """
+    with open(__file__.replace('.pyc', '.py'), 'r') as handler:
+        return handler.read()
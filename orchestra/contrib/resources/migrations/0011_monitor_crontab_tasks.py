@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def group_periodic_tasks(apps, schema_editor):
+    """ replaces the per-resource monitoring tasks by one task per crontab """
+    PeriodicTask = apps.get_model('djcelery', 'PeriodicTask')
+    Resource = apps.get_model('resources', 'Resource')
+    PeriodicTask.objects.filter(task='resources.Monitor').delete()
+    crontabs = Resource.objects.filter(is_active=True, crontab__isnull=False).values_list(
+        'crontab', flat=True).distinct()
+    for crontab_id in crontabs:
+        PeriodicTask.objects.get_or_create(
+            name='monitor.crontab-%i' % crontab_id,
+            defaults={
+                'task': 'resources.MonitorCrontab',
+                'args': [crontab_id],
+                'crontab_id': crontab_id,
+            }
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djcelery', '__first__'),
+        ('resources', '0010_auto_20160219_1108'),
+    ]
+
+    operations = [
+        migrations.RunPython(group_periodic_tasks, migrations.RunPython.noop),
+    ]
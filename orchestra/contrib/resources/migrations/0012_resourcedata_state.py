@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resources', '0011_monitor_crontab_tasks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resourcedata',
+            name='state',
+            field=models.CharField(blank=True, choices=[('ok', 'Ok'), ('exceeded', 'Exceeded')], editable=False, help_text='State of the last exceeded or recovery trigger, triggers only run on state transitions.', max_length=16, verbose_name='state'),
+        ),
+    ]
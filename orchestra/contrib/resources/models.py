@@ -121,25 +121,25 @@ class Resource(models.Model):
         apps.get_app_config('resources').reload_relations()
     
     def sync_periodic_task(self, delete=False):
-        """ sync periodic task on save/delete resource operations """
-        name = 'monitor.%s' % self
-        if delete or not self.crontab or not self.is_active:
-            PeriodicTask.objects.filter(name=name).delete()
-        elif self.pk:
-            try:
-                task = PeriodicTask.objects.get(name=name)
-            except PeriodicTask.DoesNotExist:
-                if self.is_active:
-                    PeriodicTask.objects.create(
-                        name=name,
-                        task='resources.Monitor',
-                        args=[self.pk],
-                        crontab=self.crontab
-                    )
-            else:
-                if task.crontab != self.crontab:
-                    task.crontab = self.crontab
-                    task.save(update_fields=['crontab'])
+        """
+        sync periodic tasks on save/delete resource operations,
+        resources that share a crontab are monitored together by a single task
+        """
+        if not delete and self.crontab_id and self.is_active:
+            name = 'monitor.crontab-%i' % self.crontab_id
+            if not PeriodicTask.objects.filter(name=name).exists():
+                PeriodicTask.objects.create(
+                    name=name,
+                    task='resources.MonitorCrontab',
+                    args=[self.crontab_id],
+                    crontab_id=self.crontab_id
+                )
+        # Crontabs without active resources
+        in_use = Resource.objects.filter(is_active=True, crontab__isnull=False)
+        if delete:
+            in_use = in_use.exclude(pk=self.pk)
+        PeriodicTask.objects.filter(task='resources.MonitorCrontab').exclude(
+            crontab__in=in_use.values('crontab')).delete()
     
     def get_model_path(self, monitor):
         """ returns a model path between self.content_type and monitor.model """
@@ -178,6 +178,13 @@ class ResourceDataQuerySet(models.QuerySet):
 
 class ResourceData(models.Model):
     """ Stores computed resource usage and allocation """
+    OK = 'ok'
+    EXCEEDED = 'exceeded'
+    STATES = (
+        (OK, _("Ok")),
+        (EXCEEDED, _("Exceeded")),
+    )
+    
     resource = models.ForeignKey(Resource, related_name='dataset', verbose_name=_("resource"))
     content_type = models.ForeignKey(ContentType, verbose_name=_("content type"))
     object_id = models.PositiveIntegerField(_("object id"))
@@ -187,6 +194,10 @@ class ResourceData(models.Model):
     allocated = models.PositiveIntegerField(_("allocated"), null=True, blank=True)
     content_object_repr = models.CharField(_("content object representation"), max_length=256,
         editable=False)
+    state = models.CharField(_("state"), max_length=16, choices=STATES, blank=True,
+        editable=False,
+        help_text=_("State of the last exceeded or recovery trigger, triggers only run on "
+                    "state transitions."))
     
     content_object = GenericForeignKey()
     objects = ResourceDataQuerySet.as_manager()
@@ -297,18 +308,23 @@ class MonitorData(models.Model):
 def create_resource_relation():
     class ResourceHandler(object):
         """ account.resources.web """
+        def __init__(self, obj=None):
+            self.obj = obj
+        
         def __getattr__(self, attr):
-            """ get or build ResourceData """
+            """ get or build ResourceData, cached on the object, see helpers.prefetch_resources """
             if attr.startswith('_'):
                 raise AttributeError
             try:
-                return self.obj.__resource_cache[attr]
+                cache = self.obj._resource_cache
             except AttributeError:
-                self.obj.__resource_cache = {}
+                cache = self.obj._resource_cache = {}
+            try:
+                return cache[attr]
             except KeyError:
                 pass
             try:
-                rdata = self.obj.resource_set.get(resource__name=attr)
+                rdata = self.obj.resource_set.select_related('resource').get(resource__name=attr)
             except ResourceData.DoesNotExist:
                 model = self.obj._meta.model_name
                 resource = Resource.objects.get(
@@ -322,13 +338,14 @@ def create_resource_relation():
                     resource=resource,
                     allocated=resource.default_allocation
                 )
-            self.obj.__resource_cache[attr] = rdata
+            cache[attr] = rdata
             return rdata
         
         def __get__(self, obj, cls):
-            """ proxy handled object """
-            self.obj = obj
-            return self
+            """ proxy handled object, bound on each access so handlers are never shared """
+            if obj is None:
+                return self
+            return type(self)(obj)
         
         def __iter__(self):
             return iter(self.obj.resource_set.all())
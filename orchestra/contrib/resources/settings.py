@@ -4,3 +4,47 @@ from orchestra.contrib.settings import Setting
 RESOURCES_OLD_MONITOR_DATA_DAYS = Setting('RESOURCES_OLD_MONITOR_DATA_DAYS',
     40,
 )
+
+
+RESOURCES_MONITOR_CHECKPOINTS_DIR = Setting('RESOURCES_MONITOR_CHECKPOINTS_DIR',
+    '/var/lib/orchestra/monitors',
+    help_text=("Directory of the monitored servers where log parsing monitors keep the offsets "
+               "of the logs already processed."),
+)
+
+
+RESOURCES_MONITOR_MAX_SERVERS = Setting('RESOURCES_MONITOR_MAX_SERVERS',
+    8,
+    help_text=("Number of servers monitored concurrently, each server runs all its monitors on "
+               "a single SSH session.<br><tt>0</tt> monitors all the servers at once."),
+)
+
+
+RESOURCES_MONITOR_SAMPLING_MAX_INTERVAL = Setting('RESOURCES_MONITOR_SAMPLING_MAX_INTERVAL',
+    1,
+    help_text=("Adaptive sampling of scheduled monitors: stable objects are monitored every up to "
+               "this number of crontab runs, objects close to their allocation or with a volatile "
+               "history on every run. Cumulative monitors (traffic) are never skipped.<br>"
+               "Runs are numbered from their time, so sampling assumes regular crontabs (evenly "
+               "spaced runs, e.g. <tt>*/30</tt> minutes); irregular ones monitor every object.<br>"
+               "<tt>1</tt> monitors every object on every run."),
+)
+
+
+RESOURCES_MONITOR_SAMPLING_SAMPLES = Setting('RESOURCES_MONITOR_SAMPLING_SAMPLES',
+    5,
+    help_text="Number of last monitored values used for computing the volatility of an object.",
+)
+
+
+RESOURCES_MONITOR_SAMPLING_TOLERANCE = Setting('RESOURCES_MONITOR_SAMPLING_TOLERANCE',
+    0.05,
+    help_text=("Relative change between consecutive monitored values from which an object "
+               "is considered volatile and sampled on every run."),
+)
+
+
+RESOURCES_MONITOR_SAMPLING_LIMIT = Setting('RESOURCES_MONITOR_SAMPLING_LIMIT',
+    0.8,
+    help_text="Ratio of the allocation from which an object is sampled on every run.",
+)
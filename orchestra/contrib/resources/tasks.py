@@ -1,26 +1,32 @@
 import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from celery.task.schedules import crontab
+from django import db
 from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from orchestra.contrib.orchestration import Operation
 from orchestra.contrib.tasks import task, periodic_task
 from orchestra.models.utils import get_model_field_path
+from orchestra.utils.python import OrderedSet
 from orchestra.utils.sys import LockFile
 
-from . import settings
+from . import helpers, settings
 from .backends import ServiceMonitor
 
 
-@task(name='resources.Monitor')
-def monitor(resource_id, ids=None):
-    with LockFile('/dev/shm/resources.monitor-%i.lock' % resource_id, expire=60*60, unlocked=bool(ids)):
-        from .models import ResourceData, Resource
-        resource = Resource.objects.get(pk=resource_id)
+def get_monitor_operations(resources):
+    """
+    monitoring operations of resources [(resource, ids)], ids is None for all the objects,
+    monitors shared between resources run once
+    """
+    operations = OrderedSet()
+    for resource, ids in resources:
         resource_model = resource.content_type.model_class()
-        logs = []
-        # Execute monitors
         for monitor_name in resource.monitors:
             backend = ServiceMonitor.get_backend(monitor_name)
             model = backend.model_class()
@@ -31,31 +37,254 @@ def monitor(resource_id, ids=None):
                 kwargs = {
                     path: ids
                 }
-            # Execute monitor
-            monitorings = []
             for obj in model.objects.filter(**kwargs):
-                op = Operation(backend, obj, Operation.MONITOR)
-                monitorings.append(op)
-            logs += Operation.execute(monitorings, async=False)
-        
+                if ids:
+                    # ServiceLogMonitor keeps the traffic of the objects left out
+                    obj.partial_monitor = True
+                operations.add(Operation(backend, obj, Operation.MONITOR))
+    return list(operations)
+
+
+def execute_server_monitors(server, scripts):
+    """
+    executes all the monitoring scripts of a server on a single SSH session,
+    the output of each script is stored by its own monitor
+    """
+    from orchestra.contrib.orchestration import manager, methods
+    logs = []
+    bundle = []
+    try:
+        for backend, operations in scripts:
+            log = backend.create_log(server)
+            logs.append(log)
+            if log.state != log.NOTHING and methods.is_bundleable(backend, interpreters=True):
+                bundle.append((backend, log, operations))
+            else:
+                # ServiceMonitor.execute() stores the monitored data
+                task = manager.keep_log(backend.execute, log, operations)
+                task(server, async=False, log=log)
+        if bundle:
+            manager.keep_bundle_logs(server, bundle, async=False)
+            for backend, log, operations in bundle:
+                if log.state == log.SUCCESS:
+                    backend.store(log)
+    finally:
+        # Threads have their own connection
+        db.connection.close()
+    return logs
+
+
+def execute_monitors(operations, max_servers=None):
+    """
+    executes the monitoring operations with one combined execution per server,
+    running at most max_servers (RESOURCES_MONITOR_MAX_SERVERS) servers at a time
+    """
+    from orchestra.contrib.orchestration import manager
+    from orchestra.contrib.orchestration import settings as orchestration_settings
+    if orchestration_settings.ORCHESTRATION_DISABLE_EXECUTION:
+        return []
+    scripts, __ = manager.generate(operations)
+    servers = OrderedDict()
+    for key, value in scripts.items():
+        route = key[0]
+        servers.setdefault(route.host, []).append(value)
+    max_servers = max_servers or settings.RESOURCES_MONITOR_MAX_SERVERS
+    logs = []
+    with ThreadPoolExecutor(max_workers=max_servers or len(servers) or 1) as executor:
+        futures = [
+            executor.submit(execute_server_monitors, server, server_scripts)
+                for server, server_scripts in servers.items()
+        ]
+        for future in futures:
+            logs += future.result()
+    return logs
+
+
+def get_trigger_operations(resource, ids=None):
+    """
+    exceeded and recovery operations of the objects whose usage has crossed their allocation
+    since the last trigger, transitions are computed with set-wise queries; the state of the
+    objects without trigger backends is stored right away, the rest by store_trigger_states()
+    """
+    from .models import ResourceData
+    backends = [ServiceMonitor.get_backend(monitor) for monitor in resource.monitors]
+    model = resource.content_type.model_class()
+    dataset = resource.dataset.all()
+    if ids:
+        dataset = dataset.filter(object_id__in=ids)
+    allocated = Coalesce('allocated', Value(0))
+    transitions = (
+        (Operation.EXCEEDED, ResourceData.EXCEEDED,
+            dataset.filter(used__gt=allocated).exclude(state=ResourceData.EXCEEDED)),
+        # Unknown states ('') also recover, e.g. objects exceeded before states were tracked
+        (Operation.RECOVERY, ResourceData.OK,
+            dataset.filter(used__lt=allocated).exclude(state=ResourceData.OK)),
+    )
+    operations = []
+    for action, state, transited in transitions:
+        object_ids = list(transited.values_list('object_id', flat=True))
+        if not object_ids:
+            continue
+        # Monitors of related models can not act on the objects of the resource
+        action_backends = [
+            backend for backend in backends
+                if action in backend.get_actions() and backend.model_class() is model
+        ]
+        if action_backends:
+            for obj in model.objects.filter(pk__in=object_ids):
+                for backend in action_backends:
+                    operations.append(Operation(backend, obj, action))
+        else:
+            dataset.filter(object_id__in=object_ids).update(state=state)
+    return operations
+
+
+def store_trigger_states(resource, operations, logs):
+    """
+    stores the state of the objects whose trigger operations have not failed,
+    failed ones keep their previous state so they are triggered again on the next run
+    """
+    from orchestra.contrib.orchestration.models import BackendLog, BackendOperation
+    from .models import ResourceData
+    failed = BackendOperation.objects.filter(log__in=logs, content_type=resource.content_type)
+    failed = set(failed.exclude(log__state__in=(BackendLog.SUCCESS, BackendLog.NOTHING)).values_list(
+        'action', 'object_id'))
+    states = (
+        (Operation.EXCEEDED, ResourceData.EXCEEDED),
+        (Operation.RECOVERY, ResourceData.OK),
+    )
+    for action, state in states:
+        object_ids = set(
+            operation.instance.pk for operation in operations
+                if operation.action == action and (action, operation.instance.pk) not in failed
+        )
+        if object_ids:
+            resource.dataset.filter(object_id__in=object_ids).update(state=state)
+
+
+def trigger_resources(resources):
+    """ executes the exceeded and recovery operations of resources [(resource, ids)] """
+    triggers = []
+    for resource, ids in resources:
+        if not resource.disable_trigger:
+            triggers.append((resource, get_trigger_operations(resource, ids=ids)))
+    # A single script per backend and server for all the objects,
+    # waiting for the outcome that decides which states are stored
+    logs = Operation.execute([operation for __, operations in triggers for operation in operations],
+        async=False)
+    for resource, operations in triggers:
+        store_trigger_states(resource, operations, logs)
+    return logs
+
+
+def update_resources(resources):
+    """
+    updates used resources [(resource, ids)] and triggers resource exceeded and recovery
+    """
+    from .models import ResourceData
+    for resource, ids in resources:
         kwargs = {'id__in': ids} if ids else {}
-        # Update used resources and trigger resource exceeded and revovery
-        triggers = []
         model = resource.content_type.model_class()
         for obj in model.objects.filter(**kwargs):
             data, __ = ResourceData.objects.get_or_create(obj, resource)
             data.update()
-            if not resource.disable_trigger:
-                a = data.used
-                b = data.allocated
-                if data.used > (data.allocated or 0):
-                    op = Operation(backend, obj, Operation.EXCEEDED)
-                    triggers.append(op)
-                elif data.used < (data.allocated or 0):
-                    op = Operation(backend, obj, Operation.RECOVERY)
-                    triggers.append(op)
-        Operation.execute(triggers)
-        return logs
+    trigger_resources(resources)
+
+
+def monitor_resources(resources):
+    """
+    monitors resources [(resource, ids)] at once: the monitors of all the resources that
+    run on the same server are executed together, and every monitor only once
+    """
+    operations = get_monitor_operations(resources)
+    logs = execute_monitors(operations)
+    update_resources(resources)
+    return logs
+
+
+def get_crontab_run(crontab, now, runs=2):
+    """
+    (run, period) of the current run of a crontab schedule,
+    runs are numbered since the epoch so no state is kept between runs
+    
+    Numbering assumes a regular crontab, one whose runs are evenly spaced (e.g. every 30
+    minutes); (None, None) is returned when the gaps between the next runs (at least 2)
+    are not, e.g. hour='9,17'
+    """
+    schedule = crontab.schedule
+    next_run = now + schedule.remaining_estimate(now)
+    period = None
+    last_run = next_run
+    # Gaps between the next runs
+    for __ in range(max(runs, 2)):
+        following = now + schedule.remaining_estimate(last_run)
+        if period is None:
+            period = following - last_run
+        elif following - last_run != period:
+            return None, None
+        last_run = following
+    return int(next_run.timestamp() // period.total_seconds()) - 1, period
+
+
+def get_sampled_ids(resource, run, period, now):
+    """
+    adaptive sampling: ids of the objects of resource monitored on this run,
+    None when all of them are (RESOURCES_MONITOR_SAMPLING_MAX_INTERVAL), as on irregular
+    crontabs (run is None, see get_crontab_run())
+    """
+    max_interval = settings.RESOURCES_MONITOR_SAMPLING_MAX_INTERVAL
+    if max_interval <= 1 or run is None:
+        return None
+    backends = [ServiceMonitor.get_backend(monitor) for monitor in resource.monitors]
+    if any(backend.monthly_sum_old_values for backend in backends):
+        # Cumulative monitors (traffic) would lose the values of the skipped runs
+        return None
+    samples = settings.RESOURCES_MONITOR_SAMPLING_SAMPLES
+    intervals = helpers.get_sampling_intervals(resource, max_interval,
+        samples=samples,
+        tolerance=settings.RESOURCES_MONITOR_SAMPLING_TOLERANCE,
+        limit=settings.RESOURCES_MONITOR_SAMPLING_LIMIT,
+        ini=now - period*max_interval*samples,
+    )
+    updated = dict(resource.dataset.values_list('object_id', 'updated_at'))
+    model = resource.content_type.model_class()
+    ids = []
+    for pk in model.objects.values_list('pk', flat=True):
+        interval = intervals.get(pk, 1)
+        updated_at = updated.get(pk)
+        # Objects are spread over the runs, and never left unsampled longer than their interval
+        if (run + pk) % interval == 0 or updated_at is None or now - updated_at > period*(interval-0.5):
+            ids.append(pk)
+    return ids
+
+
+@task(name='resources.Monitor')
+def monitor(resource_id, ids=None):
+    with LockFile('/dev/shm/resources.monitor-%i.lock' % resource_id, expire=60*60, unlocked=bool(ids)):
+        from .models import Resource
+        resource = Resource.objects.get(pk=resource_id)
+        return monitor_resources([(resource, ids)])
+
+
+@task(name='resources.MonitorCrontab')
+def monitor_crontab(crontab_id):
+    """
+    monitors all the active resources that share a crontab schedule,
+    stable objects are only sampled on some runs, see get_sampled_ids()
+    """
+    with LockFile('/dev/shm/resources.monitor-crontab-%i.lock' % crontab_id, expire=60*60):
+        from djcelery.models import CrontabSchedule
+        from .models import Resource
+        now = timezone.now()
+        schedule = CrontabSchedule.objects.get(pk=crontab_id)
+        run, period = get_crontab_run(schedule, now,
+            runs=settings.RESOURCES_MONITOR_SAMPLING_MAX_INTERVAL)
+        resources = []
+        for resource in Resource.objects.filter(crontab_id=crontab_id, is_active=True):
+            ids = get_sampled_ids(resource, run, period, now)
+            if ids is None or ids:
+                resources.append((resource, ids))
+        return monitor_resources(resources)
 
 
 @periodic_task(run_every=crontab(hour=2, minute=30), name='resources.cleanup_old_monitors')
@@ -0,0 +1,111 @@
+"""
+Traffic monitors log scanning benchmark
+
+    python3 manage.py shell -c "from orchestra.contrib.resources.tests.benchmarks import run; run()"
+
+Generates a log corpus per format on a temporary directory and measures the throughput
+of the logscan matchers, on a first run (date filtering of logs without checkpoint)
+and on a run that resumes from a checkpoint after the logs have grown.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from .. import logscan
+
+
+USERS = ['user%i' % ix for ix in range(500)]
+
+
+def apache_lines(num):
+    for ix in range(num):
+        # Sites are named after users, Host header is the last field
+        site = USERS[ix % len(USERS)]
+        yield ('10.0.0.1 - - [09/Mar/2016:17:13:22 +0100] "GET /page%i HTTP/1.1" 200 %i %i %s\n') % (
+            ix, 300+ix, 1000+ix, site)
+
+
+def postfix_lines(num):
+    for ix in range(num):
+        user = USERS[ix % len(USERS)]
+        msg_id = 'A%07X' % ix
+        req_id = 'B%07X' % ix
+        yield ('Mar  9 17:13:22 mail postfix/smtpd[1234]: %s: client=host[10.0.0.1], '
+               'sasl_method=PLAIN, sasl_username=%s (Authenticated sender: %s)\n') % (msg_id, user, user)
+        yield ('Mar  9 17:13:23 mail MailScanner[1235]: Requeue: %s.ABCDE to %s\n') % (msg_id, req_id)
+        yield ('Mar  9 17:13:23 mail postfix/qmgr[1236]: %s: from=<%s@example.org>, '
+               'size=%i, nrcpt=2 (queue active)\n') % (req_id, user, 1000+ix)
+        for rcpt in range(2):
+            yield ('Mar  9 17:13:24 mail postfix/smtp[1237]: %s: to=<rcpt%i@example.com>, '
+                   'relay=mx.example.com[10.0.0.2]:25, delay=1, status=sent (250 OK)\n') % (req_id, rcpt)
+        yield 'Mar  9 17:13:25 mail postfix/anvil[1238]: statistics: max connection rate 1/60s\n'
+
+
+def exim4_lines(num):
+    for ix in range(num):
+        user = USERS[ix % len(USERS)]
+        yield ('2016-03-09 17:13:22 1aXYZ-000%i-AB <= %s@web.example.org U=%s P=local '
+               'S=%i id=%i@web.example.org\n') % (ix, user, user, 1000+ix, ix)
+        yield '2016-03-09 17:13:23 1aXYZ-000%i-AB => rcpt@example.com R=dnslookup T=remote_smtp\n' % ix
+
+
+def vsftpd_lines(num):
+    for ix in range(num):
+        user = USERS[ix % len(USERS)]
+        yield ('Wed Mar  9 17:13:22 2016 [pid 1234] [%s] OK UPLOAD: Client "10.0.0.1", '
+               '"/home/%s/file%i", %i bytes, 512.00Kbyte/sec\n') % (user, user, ix, 1000+ix)
+        yield 'Wed Mar  9 17:13:22 2016 [pid 1234] CONNECT: Client "10.0.0.1"\n'
+
+
+def mailman_lines(num):
+    for ix in range(num):
+        name = USERS[ix % len(USERS)]
+        yield ('Mar 09 17:13:22 2016 (1234) post to %s from sender%i@example.org, size=%i, '
+               'message-id=<%i@example.org>, success\n') % (name, ix, 1000+ix, ix)
+
+
+FORMATS = (
+    ('apache', apache_lines, logscan.parse_clf_date,
+        lambda checkpoint, keys: logscan.host_matcher(keys, include_received=True)),
+    ('postfix', postfix_lines, logscan.parse_syslog_date,
+        lambda checkpoint, keys: logscan.PostfixMailscannerMatcher(checkpoint, keys)),
+    ('exim4', exim4_lines, logscan.parse_iso_date,
+        lambda checkpoint, keys: logscan.exim4_matcher(keys)),
+    ('vsftpd', vsftpd_lines, logscan.parse_ctime_date,
+        lambda checkpoint, keys: logscan.vsftpd_matcher(keys)),
+    ('mailman', mailman_lines, logscan.parse_mailman_date,
+        lambda checkpoint, keys: logscan.mailman_matcher(keys)),
+)
+
+
+def measure(directory, name, parse_date, get_matcher):
+    path = os.path.join(directory, name + '.log')
+    checkpoint = logscan.Checkpoint(os.path.join(directory, name + '.json'))
+    keys = {key: ix for ix, key in enumerate(USERS)}
+    ini = dict.fromkeys(keys, 0)
+    start = time.time()
+    totals = {}
+    logscan.scan(checkpoint, path, get_matcher(checkpoint, keys), parse_date, ini, totals)
+    checkpoint.save()
+    return time.time() - start, sum(totals.values())
+
+
+def run(num=200000):
+    directory = tempfile.mkdtemp()
+    try:
+        for name, lines, parse_date, get_matcher in FORMATS:
+            path = os.path.join(directory, name + '.log')
+            with open(path, 'w') as handler:
+                handler.writelines(lines(num))
+            size = os.path.getsize(path)/1024/1024
+            elapsed, total = measure(directory, name, parse_date, get_matcher)
+            print("%-8s first run:  %6.1f MB in %.2fs (%.1f MB/s) %i bytes" % (
+                name, size, elapsed, size/elapsed, total))
+            with open(path, 'a') as handler:
+                handler.writelines(lines(num))
+            elapsed, total = measure(directory, name, parse_date, get_matcher)
+            print("%-8s resumed:    %6.1f MB in %.2fs (%.1f MB/s) %i bytes" % (
+                name, size, elapsed, size/elapsed, total))
+    finally:
+        shutil.rmtree(directory)
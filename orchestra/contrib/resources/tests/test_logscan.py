@@ -0,0 +1,231 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import logscan
+
+
+class CheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'access.log')
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoints', 'monitor.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, content, path=None, mode='a'):
+        with open(path or self.path, mode) as handler:
+            handler.write(content)
+
+    def read(self):
+        """ reads the appended lines as a monitor run does, saving the checkpoint """
+        checkpoint = logscan.Checkpoint(self.checkpoint_path)
+        resumed, lines = checkpoint.read(self.path)
+        lines = [line.decode() for line in lines]
+        checkpoint.save()
+        return resumed, lines
+
+    def test_first_run(self):
+        self.write('old 1\n', path=self.path + '.1')
+        self.write('new 1\n')
+        checkpoint = logscan.Checkpoint(self.checkpoint_path)
+        self.assertEqual((False, [(self.path + '.1', 0), (self.path, 0)]), checkpoint.get_files(self.path))
+        checkpoint.release()
+        self.assertEqual((False, ['old 1\n', 'new 1\n']), self.read())
+
+    def test_first_run_compressed(self):
+        with gzip.open(self.path + '.1.gz', 'wb') as handler:
+            handler.write(b'old 1\n')
+        self.write('new 1\n')
+        self.assertEqual((False, ['old 1\n', 'new 1\n']), self.read())
+
+    def test_resume(self):
+        self.write('a 1\nb 2\n')
+        self.read()
+        self.write('c 3\n')
+        self.assertEqual((True, ['c 3\n']), self.read())
+        self.assertEqual((True, []), self.read())
+
+    def test_rotation_by_inode(self):
+        self.write('a 1\n')
+        self.read()
+        self.write('b 2\n')
+        os.rename(self.path, self.path + '.1')
+        self.write('c 3\n')
+        self.assertEqual((True, ['b 2\n', 'c 3\n']), self.read())
+        self.assertEqual((True, []), self.read())
+
+    def test_rotation_compressed(self):
+        self.write('a 1\n')
+        self.read()
+        self.write('b 2\n')
+        with open(self.path, 'rb') as source, gzip.open(self.path + '.1.gz', 'wb') as target:
+            target.write(source.read())
+        os.remove(self.path)
+        self.write('c 3\n')
+        self.assertEqual((True, ['b 2\n', 'c 3\n']), self.read())
+
+    def test_rotated_twice(self):
+        self.write('a 1\n')
+        self.read()
+        os.rename(self.path, self.path + '.2')
+        self.write('b 2\n', path=self.path + '.1')
+        self.write('c 3\n')
+        # The remainder of the checkpointed log is lost, the current log is read in full
+        self.assertEqual((True, ['c 3\n']), self.read())
+
+    def test_truncation(self):
+        first = 'a %s\n' % ('x'*logscan.HEAD_SIZE)
+        self.write(first + 'b 2\n')
+        self.read()
+        with open(self.path, 'r+') as handler:
+            handler.truncate(len(first))
+        self.write('c\n')
+        self.assertEqual((True, [first, 'c\n']), self.read())
+
+    def test_inode_reuse(self):
+        self.write('a 1\nb 2\n')
+        self.read()
+        # Same inode, different log
+        self.write('c 3\nd 4\ne 5\n', mode='w')
+        self.assertEqual((True, ['c 3\n', 'd 4\n', 'e 5\n']), self.read())
+
+    def test_partial_line(self):
+        self.write('a 1\nb ')
+        self.assertEqual((False, ['a 1\n']), self.read())
+        self.write('2\n')
+        self.assertEqual((True, ['b 2\n']), self.read())
+
+    def test_removed_log(self):
+        self.write('a 1\n')
+        self.read()
+        os.remove(self.path)
+        self.assertEqual((True, []), self.read())
+
+    def test_data(self):
+        checkpoint = logscan.Checkpoint(self.checkpoint_path)
+        checkpoint.data['pending'] = {'user': 10}
+        checkpoint.save()
+        checkpoint = logscan.Checkpoint(self.checkpoint_path)
+        self.assertEqual({'pending': {'user': 10}}, checkpoint.data)
+        checkpoint.release()
+
+    def test_scan(self):
+        self.write('a 10\nb 20\na 5\n')
+        match = lambda line: tuple(int(field) if field.isdigit() else field.decode()
+                                   for field in line.split())
+        # Logs without checkpoint are filtered by date, per key
+        parse_date = lambda line: 100 if line.startswith(b'a 5') else 0
+        totals = {}
+        checkpoint = logscan.Checkpoint(self.checkpoint_path)
+        logscan.scan(checkpoint, self.path, match, parse_date, {'a': 50, 'b': 50}, totals)
+        checkpoint.save()
+        self.assertEqual({'a': 5}, totals)
+        self.write('b 1\n10.0.0.1 1\n')
+        totals = {}
+        checkpoint = logscan.Checkpoint(self.checkpoint_path)
+        exclude = logscan.get_exclude(['10.0.0.1'])
+        logscan.scan(checkpoint, self.path, match, parse_date, {}, totals, exclude=exclude)
+        checkpoint.save()
+        self.assertEqual({'b': 1}, totals)
+
+
+class MatcherTests(unittest.TestCase):
+    def test_get_exclude(self):
+        exclude = logscan.get_exclude(['10.0.0.1', '::1'])
+        self.assertTrue(exclude(b'10.0.0.1 - - [09/Mar/2016:17:13:22 +0100] "GET /"'))
+        self.assertTrue(exclude(b'::1 - - [09/Mar/2016:17:13:22 +0100] "GET /"'))
+        self.assertFalse(exclude(b'10.0.0.11 - - [09/Mar/2016:17:13:22 +0100] "GET /"'))
+        self.assertFalse(exclude(b'10.0.0.2 - - [09/Mar/2016:17:13:22 +0100] "GET /10.0.0.1 "'))
+        self.assertIsNone(logscan.get_exclude([]))
+
+    def test_parse_dates(self):
+        self.assertEqual(1457540002, logscan.parse_clf_date(
+            b'10.0.0.1 - - [09/Mar/2016:17:13:22 +0100] "GET / HTTP/1.1" 200 300'))
+        self.assertEqual(logscan.local_epoch(2016, 3, 9, 17, 13, 22), logscan.parse_iso_date(
+            b'2016-03-09 17:13:22 1aXYZ-0001-AB <= user@example.org'))
+        self.assertEqual(logscan.local_epoch(2016, 3, 9, 17, 13, 22), logscan.parse_ctime_date(
+            b'Wed Mar  9 17:13:22 2016 [pid 1234] [user] OK UPLOAD'))
+        self.assertEqual(logscan.local_epoch(2016, 3, 9, 17, 13, 22), logscan.parse_mailman_date(
+            b'Mar 09 17:13:22 2016 (1234) post to list'))
+
+    def test_last_field_int(self):
+        match = logscan.last_field_int({'site': 1})
+        self.assertEqual(('site', 1234), match(b'10.0.0.1 - - [...] "GET / HTTP/1.1" 200 1234\n'))
+        self.assertIsNone(match(b'10.0.0.1 - - [...] "GET / HTTP/1.1" 304 -\n'))
+
+    def test_host_matcher(self):
+        line = b'10.0.0.1 - - [...] "GET / HTTP/1.1" 200 300 1000 example.org\n'
+        match = logscan.host_matcher({'example.org': 1})
+        self.assertEqual(('example.org', 1000), match(line))
+        self.assertIsNone(match(line.replace(b'example.org', b'example.net')))
+        match = logscan.host_matcher({'example.org': 1}, include_received=True)
+        self.assertEqual(('example.org', 1300), match(line))
+
+    def test_exim4_matcher(self):
+        match = logscan.exim4_matcher({'user': 1})
+        self.assertEqual(('user', 1234), match(
+            b'2016-03-09 17:13:22 1aXYZ-0001-AB <= user@web.example.org U=user P=local '
+            b'S=1234 id=1@web.example.org\n'))
+        self.assertIsNone(match(
+            b'2016-03-09 17:13:22 1aXYZ-0001-AB <= other@web.example.org U=other P=local S=1\n'))
+        self.assertIsNone(match(
+            b'2016-03-09 17:13:23 1aXYZ-0001-AB => rcpt@example.com R=dnslookup T=remote_smtp\n'))
+
+    def test_vsftpd_matcher(self):
+        match = logscan.vsftpd_matcher({'user': 1})
+        self.assertEqual(('user', 1234), match(
+            b'Wed Mar  9 17:13:22 2016 [pid 1234] [user] OK UPLOAD: Client "10.0.0.1", '
+            b'"/home/user/file", 1234 bytes, 512.00Kbyte/sec\n'))
+        self.assertEqual(('user', 10), match(
+            b'Wed Mar  9 17:13:22 2016 [pid 1234] [user] FAIL DOWNLOAD: Client "10.0.0.1", '
+            b'"/home/user/file", 10 bytes, 1.00Kbyte/sec\n'))
+        self.assertIsNone(match(b'Wed Mar  9 17:13:22 2016 [pid 1234] CONNECT: Client "10.0.0.1"\n'))
+
+    def test_mailman_matcher(self):
+        match = logscan.mailman_matcher({'list': 1})
+        line = (b'Mar 09 17:13:22 2016 (1234) post to list from %s, size=%s, '
+                b'message-id=<1@example.org>, success\n')
+        self.assertEqual(('list', 1234), match(line % (b'sender@example.org', b'1234')))
+        self.assertIsNone(match(line % (b'list-bounces@example.org', b'1234')))
+        self.assertIsNone(match(line % (b'sender@example.org', b'None')))
+        self.assertIsNone(match(line.replace(b'to list ', b'to other ') % (b'a@example.org', b'1')))
+
+    def test_postfix_mailscanner_matcher(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'postfix.json')
+        lines = [
+            b'Mar  9 17:13:22 mail postfix/smtpd[1]: A1: client=host[10.0.0.1], sasl_method=PLAIN, '
+            b'sasl_username=user (Authenticated sender: user)\n',
+            b'Mar  9 17:13:23 mail MailScanner[2]: Requeue: A1.ABCDE to B1\n',
+            b'Mar  9 17:13:23 mail postfix/qmgr[3]: B1: from=<user@example.org>, size=1000, '
+            b'nrcpt=2 (queue active)\n',
+            b'Mar  9 17:13:24 mail postfix/smtp[4]: B1: to=<a@example.com>, relay=mx[10.0.0.2]:25, '
+            b'delay=1, status=sent (250 OK)\n',
+            b'Mar  9 17:13:24 mail postfix/smtp[4]: B1: to=<b@example.com>, relay=mx[10.0.0.2]:25, '
+            b'delay=1, status=sent (250 OK)\n',
+        ]
+        checkpoint = logscan.Checkpoint(path)
+        match = logscan.PostfixMailscannerMatcher(checkpoint, {'user': 1})
+        results = [match(line) for line in lines[:4]]
+        checkpoint.save()
+        self.assertEqual([None, None, None, ('user', 1000)], results)
+        # In-flight messages are carried over to the next run
+        checkpoint = logscan.Checkpoint(path)
+        match = logscan.PostfixMailscannerMatcher(checkpoint, {'user': 1})
+        self.assertEqual(('user', 1000), match(lines[4]))
+        checkpoint.save()
+        # but only once
+        checkpoint = logscan.Checkpoint(path)
+        match = logscan.PostfixMailscannerMatcher(checkpoint, {'user': 1})
+        self.assertIsNone(match(lines[4]))
+        checkpoint.release()
+        # Messages of other users are ignored
+        checkpoint = logscan.Checkpoint(path)
+        match = logscan.PostfixMailscannerMatcher(checkpoint, {'other': 2})
+        self.assertEqual([None]*5, [match(line) for line in lines])
+        checkpoint.release()
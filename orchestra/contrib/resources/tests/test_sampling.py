@@ -0,0 +1,95 @@
+import datetime
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.databases.backends import MysqlDisk
+from orchestra.contrib.databases.models import Database
+from orchestra.utils.tests import BaseTestCase
+
+from .. import helpers, settings, tasks
+from ..models import MonitorData, Resource, ResourceData
+
+
+class SamplingTests(BaseTestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.period = datetime.timedelta(minutes=30)
+        self.resource = Resource.objects.create(
+            name='disk',
+            content_type=ContentType.objects.get_for_model(Database),
+            verbose_name='Database disk',
+            unit='MB',
+            scale='10**6',
+            monitors=[MysqlDisk.get_name()],
+        )
+        self.account = self.create_account()
+        self.stable = self.create_database('stable', [100, 100, 100, 100, 100])
+        self.slow = self.create_database('slow', [100, 101, 102, 103, 104])
+        self.volatile = self.create_database('volatile', [100, 200, 100, 200, 100])
+        self.short = self.create_database('short', [100, 100])
+        self.full = self.create_database('full', [900, 900, 900, 900, 900])
+
+    def create_database(self, name, values, allocated=1000):
+        database = Database.objects.create(name=name, account=self.account, type=Database.MYSQL)
+        for ix, value in enumerate(values):
+            MonitorData.objects.create(monitor=MysqlDisk.get_name(), content_object=database,
+                value=value, created_at=self.now - self.period*(len(values)-ix))
+        data, __ = ResourceData.objects.get_or_create(database, self.resource)
+        data.used = values[-1]
+        data.allocated = allocated
+        data.updated_at = self.now
+        data.save()
+        return database
+
+    def get_intervals(self):
+        return helpers.get_sampling_intervals(self.resource, 5, samples=5, tolerance=0.05, limit=0.8,
+            ini=self.now - self.period*5*5)
+
+    def test_get_sampling_intervals(self):
+        intervals = self.get_intervals()
+        self.assertEqual(5, intervals[self.stable.pk])
+        # 1% changes with a 5% tolerance
+        self.assertEqual(4, intervals[self.slow.pk])
+        self.assertEqual(1, intervals[self.volatile.pk])
+        self.assertEqual(1, intervals[self.short.pk])
+        # close to its allocation
+        self.assertEqual(1, intervals[self.full.pk])
+
+    def test_get_sampling_intervals_ini(self):
+        # values older than ini are not part of the history
+        intervals = helpers.get_sampling_intervals(self.resource, 5, samples=5,
+            ini=self.now - self.period*2)
+        self.assertEqual(1, intervals[self.stable.pk])
+
+    def get_sampled_ids(self, run):
+        with mock.patch.object(settings, 'RESOURCES_MONITOR_SAMPLING_MAX_INTERVAL', 5):
+            return tasks.get_sampled_ids(self.resource, run, self.period, self.now)
+
+    def test_get_sampled_ids(self):
+        runs = [self.get_sampled_ids(run) for run in range(100, 110)]
+        for ids in runs:
+            self.assertIn(self.volatile.pk, ids)
+            self.assertIn(self.short.pk, ids)
+            self.assertIn(self.full.pk, ids)
+        # Once every interval runs
+        sampled = [run for run, ids in enumerate(runs) if self.stable.pk in ids]
+        self.assertEqual(2, len(sampled))
+        self.assertEqual(5, sampled[1]-sampled[0])
+        sampled = [run for run, ids in enumerate(runs) if self.slow.pk in ids]
+        self.assertIn(len(sampled), (2, 3))
+
+    def test_get_sampled_ids_outdated(self):
+        # never left unsampled longer than its interval
+        self.resource.dataset.filter(object_id=self.stable.pk).update(
+            updated_at=self.now - self.period*5)
+        for run in range(100, 105):
+            self.assertIn(self.stable.pk, self.get_sampled_ids(run))
+        self.resource.dataset.filter(object_id=self.stable.pk).update(updated_at=None)
+        self.assertIn(self.stable.pk, self.get_sampled_ids(100))
+
+    def test_get_sampled_ids_disabled(self):
+        self.assertIsNone(tasks.get_sampled_ids(self.resource, 100, self.period, self.now))
+        # irregular crontab
+        self.assertIsNone(self.get_sampled_ids(None))
@@ -0,0 +1,102 @@
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentType
+
+from orchestra.contrib.accounts.models import Account
+from orchestra.contrib.databases.backends import MysqlDisk
+from orchestra.contrib.databases.models import Database
+from orchestra.contrib.orchestration import Operation
+from orchestra.contrib.orchestration.models import BackendLog, Server
+from orchestra.utils.tests import BaseTestCase
+
+from .. import tasks
+from ..models import Resource, ResourceData
+
+
+class TriggerTests(BaseTestCase):
+    def setUp(self):
+        self.server = Server.objects.create(name='db.example.com')
+        self.resource = Resource.objects.create(
+            name='disk',
+            content_type=ContentType.objects.get_for_model(Database),
+            verbose_name='Database disk',
+            unit='MB',
+            scale='10**6',
+            disable_trigger=False,
+            monitors=[MysqlDisk.get_name()],
+        )
+        account = self.create_account()
+        self.database = Database.objects.create(name='db', account=account, type=Database.MYSQL)
+        self.data, __ = ResourceData.objects.get_or_create(self.database, self.resource)
+        self.executed = []
+
+    def set_usage(self, used, allocated=10, state=''):
+        self.data.used = used
+        self.data.allocated = allocated
+        self.data.state = state
+        self.data.save()
+
+    def trigger(self, state=BackendLog.SUCCESS):
+        """ runs the triggers, their execution ends with state """
+        def execute(operations, **kwargs):
+            operations = list(operations)
+            self.executed.append(operations)
+            log = BackendLog.objects.create(backend=MysqlDisk.get_name(), server=self.server, state=state)
+            for operation in operations:
+                operation.store(log)
+            return [log]
+
+        with mock.patch.object(Operation, 'execute', execute):
+            tasks.trigger_resources([(self.resource, None)])
+        self.data.refresh_from_db()
+        return [(operation.action, operation.instance) for operation in self.executed[-1]]
+
+    def test_exceeded(self):
+        self.set_usage(20)
+        self.assertEqual([(Operation.EXCEEDED, self.database)], self.trigger())
+        self.assertEqual(ResourceData.EXCEEDED, self.data.state)
+        # Not triggered again
+        self.assertEqual([], self.trigger())
+        self.assertEqual(ResourceData.EXCEEDED, self.data.state)
+
+    def test_recovery(self):
+        self.set_usage(5, state=ResourceData.EXCEEDED)
+        self.assertEqual([(Operation.RECOVERY, self.database)], self.trigger())
+        self.assertEqual(ResourceData.OK, self.data.state)
+        self.assertEqual([], self.trigger())
+
+    def test_failed_trigger(self):
+        self.set_usage(20, state=ResourceData.OK)
+        self.assertEqual([(Operation.EXCEEDED, self.database)], self.trigger(state=BackendLog.FAILURE))
+        self.assertEqual(ResourceData.OK, self.data.state)
+        # Triggered again until it succeeds
+        self.assertEqual([(Operation.EXCEEDED, self.database)], self.trigger(state=BackendLog.TIMEOUT))
+        self.assertEqual(ResourceData.OK, self.data.state)
+        self.assertEqual([(Operation.EXCEEDED, self.database)], self.trigger())
+        self.assertEqual(ResourceData.EXCEEDED, self.data.state)
+        self.assertEqual([], self.trigger())
+
+    def test_no_trigger_backends(self):
+        self.resource.monitors = []
+        self.resource.save()
+        self.set_usage(20)
+        self.assertEqual([], self.trigger())
+        self.assertEqual(ResourceData.EXCEEDED, self.data.state)
+
+    def test_related_model_backends(self):
+        resource = Resource.objects.create(
+            name='databases-disk',
+            content_type=ContentType.objects.get_for_model(Account),
+            verbose_name='Databases disk',
+            unit='MB',
+            scale='10**6',
+            disable_trigger=False,
+            monitors=[MysqlDisk.get_name()],
+        )
+        data, __ = ResourceData.objects.get_or_create(self.database.account, resource)
+        data.used = 20
+        data.allocated = 10
+        data.save()
+        self.assertEqual([], tasks.get_trigger_operations(resource))
+        data.refresh_from_db()
+        self.assertEqual(ResourceData.EXCEEDED, data.state)
@@ -5,12 +5,151 @@ import textwrap
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceController, replace
-from orchestra.contrib.resources import ServiceMonitor
+from orchestra.contrib.resources import ServiceMonitor, ServiceLogMonitor
 
 from . import settings
 
 
-class UNIXUserController(ServiceController):
+class UNIXUserBulkMixin(object):
+    """
+    Single-pass user database updates for executions that save many UNIX users
+    
+    Controllers register the per-user state commands with append_user_state(). On commit,
+    executions with at least get_bulk_threshold() users replace them by one pass of
+    newusers, usermod/gpasswd (only for users whose state differs) and chpasswd -e,
+    run before any other content, and home directories are created by parallel workers.
+    
+    Both paths leave users in the same state: append_user_state() arguments have to describe
+    exactly what the per-user commands do. Homes created by newusers are owned by the user,
+    like the ones of the per-user commands, and dirs applies the same modes and owners.
+    Content appended with append() (skel, ACLs, quotas) runs on both paths.
+    """
+    bulk_processes = 8
+    # Variable set when passwords have been updated
+    bulk_password_flag = None
+    
+    def __init__(self):
+        super().__init__()
+        self.bulk_users = []
+    
+    def get_bulk_threshold(self):
+        """ 0 disables bulk updates """
+        return 0
+    
+    def append_user_state(self, user, *commands, password='', home='', shell='', groups=None,
+                          members=(), dirs=()):
+        """
+        appends the per-user commands, discarded by bulk commits in favour of:
+            groups: supplementary groups, None for leaving them untouched
+            members: (member, group) memberships to add
+            dirs: (path, mode, owner) directories, owner can be None
+        """
+        self.bulk_users.append({
+            'user': user,
+            'password': password,
+            'home': home,
+            'shell': shell,
+            'groups': '*' if groups is None else ','.join(sorted(groups)),
+            'members': members,
+            'dirs': dirs,
+            'commands': commands,
+        })
+        for command in commands:
+            self.append(command)
+    
+    def is_bulk(self):
+        threshold = self.get_bulk_threshold()
+        return bool(threshold and len(self.bulk_users) >= threshold)
+    
+    def update_users_in_bulk(self):
+        # content is a list of (method, commands)
+        discarded = set()
+        for user in self.bulk_users:
+            discarded.update(user['commands'])
+        for __, commands in self.content:
+            commands[:] = [command for command in commands if command not in discarded]
+        context = {
+            'num': len(self.bulk_users),
+            'processes': self.bulk_processes,
+            'users': '\n'.join(
+                '%(user)s:%(password)s:%(home)s:%(shell)s:%(groups)s' % user for user in self.bulk_users
+            ),
+            'members': '\n'.join(
+                '%s %s' % member for user in self.bulk_users for member in user['members']
+            ),
+            'dirs': '\n'.join(
+                '%s %s %s' % (path, mode, owner or '-')
+                    for user in self.bulk_users for path, mode, owner in user['dirs']
+            ),
+            'password_flag': '%s=1' % self.bulk_password_flag if self.bulk_password_flag else 'true',
+        }
+        self.append(textwrap.dedent("""
+            # Bulk update of %(num)i UNIX users
+            bulk_users=$(mktemp)
+            cat << 'EOF' > $bulk_users
+            %(users)s
+            EOF
+            getent passwd > $bulk_users.passwd
+            getent shadow > $bulk_users.shadow
+            # Create missing users on a single transaction
+            awk -F: 'NR==FNR {exists[$1]=1; next} !($1 in exists) {print $1":*::::"$3":"$4}' \\
+                $bulk_users.passwd $bulk_users > $bulk_users.new
+            if [[ -s $bulk_users.new ]]; then
+                newusers $bulk_users.new || exit_code=$?
+            fi
+            # Update home and shell of existing users, if needed
+            while read user home shell; do
+                usermod "$user" --home "$home" --shell "$shell" || exit_code=$?
+            done < <(awk -F: 'NR==FNR {home[$1]=$6; shell[$1]=$7; next}
+                              ($1 in home) && (home[$1] != $3 || shell[$1] != $4) {print $1, $3, $4}' \\
+                         $bulk_users.passwd $bulk_users)
+            # Set supplementary groups of users whose membership differs
+            awk -F: 'NR==FNR {if ($5 != "*") managed[$1]=1; next}
+                     {n=split($4, m, ","); for (i=1; i<=n; i++) if (m[i] in managed) print m[i], $1}' \\
+                $bulk_users <(getent group) | sort > $bulk_users.current
+            awk -F: '$5 != "*" {n=split($5, g, ","); for (i=1; i<=n; i++) print $1, g[i]}' \\
+                $bulk_users | sort > $bulk_users.groups
+            while read user; do
+                groups=$(awk -F: -v user="$user" '$1 == user {print $5}' $bulk_users)
+                usermod "$user" --groups "$groups" || exit_code=$?
+            done < <(comm -3 $bulk_users.current $bulk_users.groups | awk '{print $1}' | sort -u)
+            # Add missing group members
+            cat << 'EOF' | sort > $bulk_users.members
+            %(members)s
+            EOF
+            while read member group; do
+                gpasswd -a "$member" "$group" > /dev/null || exit_code=$?
+            done < <(comm -13 <(getent group | awk -F: '{n=split($4, m, ","); for (i=1; i<=n; i++) print m[i], $1}' | sort) \\
+                              <(grep -v '^$' $bulk_users.members))
+            # Update changed passwords on a single transaction
+            awk -F: 'NR==FNR {password[$1]=$2; next} password[$1] != $2 {print $1":"$2}' \\
+                $bulk_users.shadow $bulk_users > $bulk_users.passwords
+            if [[ -s $bulk_users.passwords ]]; then
+                chpasswd -e < $bulk_users.passwords || exit_code=$?
+            fi
+            # Like the per-user commands, only for passwords of existing users
+            if awk -F: 'NR==FNR {exists[$1]=1; next} ($1 in exists)' \\
+                    $bulk_users.passwd $bulk_users.passwords | grep -q .; then
+                %(password_flag)s
+            fi
+            # Create homes in parallel
+            xargs -r -P %(processes)i -L 1 bash -c '
+                mkdir -p "$1" && chmod $2 "$1" && { [[ $3 == - ]] || chown $3 "$1"; }' _ << 'EOF' || exit_code=$?
+            %(dirs)s
+            EOF
+            rm -f $bulk_users $bulk_users.*""") % context
+        )
+    
+    def commit(self):
+        if self.is_bulk():
+            # Users have to exist before the remaining content runs
+            self.set_head()
+            self.update_users_in_bulk()
+            self.set_tail()
+        super().commit()
+
+
+class UNIXUserController(UNIXUserBulkMixin, ServiceController):
     """
     Basic UNIX system user/group support based on <tt>useradd</tt>, <tt>usermod</tt>, <tt>userdel</tt> and <tt>groupdel</tt>.
     Autodetects and uses ACL if available, for better permission management.
@@ -21,15 +160,25 @@ class UNIXUserController(ServiceController):
     doc_settings = (settings, (
         'SYSTEMUSERS_DEFAULT_GROUP_MEMBERS',
         'SYSTEMUSERS_MOVE_ON_DELETE_PATH',
-        'SYSTEMUSERS_FORBIDDEN_PATHS'
+        'SYSTEMUSERS_FORBIDDEN_PATHS',
+        'SYSTEMUSERS_BULK_THRESHOLD',
     ))
     
+    def get_bulk_threshold(self):
+        return settings.SYSTEMUSERS_BULK_THRESHOLD
+    
     def save(self, user):
         context = self.get_context(user)
         if not context['user']:
             return
+        members = [(member, context['user']) for member in settings.SYSTEMUSERS_DEFAULT_GROUP_MEMBERS]
+        if not user.is_main:
+            members.append((context['mainuser'], context['user']))
+        commands = [
+            'usermod -a -G %s %s || exit_code=$?' % (group, member) for member, group in members
+        ]
         # TODO userd add will fail if %(user)s group already exists
-        self.append(textwrap.dedent("""
+        self.append_user_state(context['user'], textwrap.dedent("""
             # Update/create user state for %(user)s
             if id %(user)s ; then
                 usermod %(user)s --home '%(home)s' \\
@@ -56,7 +205,13 @@ class UNIXUserController(ServiceController):
             fi
             mkdir -p '%(base_home)s'
             chmod 750 '%(base_home)s'
-        """) % context
+        """) % context, *commands,
+            password=context['password'],
+            home=context['home'],
+            shell=context['shell'],
+            groups=[group for group in context['groups'].split(',') if group],
+            members=members,
+            dirs=[(context['base_home'], '750', None)]
         )
         if context['home'] != context['base_home']:
             self.append(textwrap.dedent("""\
@@ -86,11 +241,6 @@ class UNIXUserController(ServiceController):
                 done
                 """) % context
             )
-        for member in settings.SYSTEMUSERS_DEFAULT_GROUP_MEMBERS:
-            context['member'] = member
-            self.append('usermod -a -G %(user)s %(member)s || exit_code=$?' % context)
-        if not user.is_main:
-            self.append('usermod -a -G %(user)s %(mainuser)s || exit_code=$?' % context)
     
     def delete(self, user):
         context = self.get_context(user)
@@ -278,176 +428,90 @@ class UNIXUserDisk(ServiceMonitor):
         return replace(context, "'", '"')
 
 
-class Exim4Traffic(ServiceMonitor):
+class UNIXUserIncrementalDisk(ServiceMonitor):
     """
-    Exim4 mainlog parser for mails sent on the webserver by system users (e.g. via PHP <tt>mail()</tt>)
+    Disk usage of all the users of a server on a single python script,
+    based on filesystem quotas when available (<tt>xfs_quota</tt>, <tt>repquota</tt>),
+    otherwise on an incremental <tt>du -bs &lt;home&gt;</tt> that only lists
+    the directories modified since the previous run.
     """
     model = 'systemusers.SystemUser'
-    resource = ServiceMonitor.TRAFFIC
-    verbose_name = _("Exim4 traffic")
-    script_executable = '/usr/bin/python'
-    monthly_sum_old_values = True
+    resource = ServiceMonitor.DISK
+    verbose_name = _('UNIX user disk (incremental)')
+    script_executable = '/usr/bin/python3'
+    delete_old_equal_values = True
     doc_settings = (settings,
-        ('SYSTEMUSERS_MAIL_LOG_PATH',)
+        ('SYSTEMUSERS_DISK_QUOTAS',)
     )
     
     def prepare(self):
-        mainlog = settings.SYSTEMUSERS_MAIL_LOG_PATH
-        context = {
-            'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'mainlogs': str((mainlog, mainlog+'.1')),
-        }
-        self.append(textwrap.dedent("""\
-            import re
-            import sys
-            from datetime import datetime
-            from dateutil import tz
-            
-            def to_local_timezone(date, tzlocal=tz.tzlocal()):
-                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
-                date = date.replace(tzinfo=tz.tzutc())
-                date = date.astimezone(tzlocal)
-                return date
-            
-            mainlogs = {mainlogs}
-            # Use local timezone
-            end_date = to_local_timezone('{current_date}')
-            end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
-            users = {{}}
-            
-            def prepare(object_id, username, ini_date):
-                global users
-                ini_date = to_local_timezone(ini_date)
-                ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
-                users[username] = [ini_date, object_id, 0]
+        self.append_diskscan()
+        self.append(textwrap.dedent("""
+            homes = {}
+            users = {}
             
-            def monitor(users, end_date, mainlogs):
-                user_regex = re.compile(r' U=([^ ]+) ')
-                for mainlog in mainlogs:
-                    try:
-                        with open(mainlog, 'r') as mainlog:
-                            for line in mainlog.readlines():
-                                if ' <= ' in line and 'P=local' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        sender = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        date, time, id, __, __, user, protocol, size = line.split()[:8]
-                                        date = date.replace('-', '')
-                                        date += time.replace(':', '')
-                                        if sender[0] < int(date) < end_date:
-                                            sender[2] += int(size[2:])
-                    except IOError as e:
-                        sys.stderr.write(str(e))
-                
-                for username, opts in users.iteritems():
-                    __, object_id, size = opts
-                    print object_id, size
-            """).format(**context)
+            def monitor(object_id, username, home):
+                homes[username] = home
+                users[username] = object_id
+            """)
         )
     
-    def commit(self):
-        self.append('monitor(users, end_date, mainlogs)')
-    
     def monitor(self, user):
         context = self.get_context(user)
-        self.append("prepare(%(object_id)s, '%(username)s', '%(last_date)s')" % context)
+        self.append("monitor(%(object_id)i, %(username)r, %(base_home)r)" % context)
     
-    def get_context(self, user):
+    def commit(self):
         context = {
-            'username': user.username,
+            'cache_dir': os.path.splitext(self.get_checkpoint_path())[0],
+            'quotas': tuple(settings.SYSTEMUSERS_DISK_QUOTAS),
+        }
+        self.append(textwrap.dedent("""
+            usage = disk_usage(homes, %(cache_dir)r, quotas=%(quotas)r)
+            for username, object_id in users.items():
+                print(object_id, usage[username])""") % context
+        )
+    
+    def get_context(self, user):
+        return {
             'object_id': user.pk,
-            'last_date': self.get_last_date(user.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
+            'username': user.username,
+            'base_home': user.get_base_home(),
         }
-        return context
 
 
-class VsFTPdTraffic(ServiceMonitor):
+class Exim4Traffic(ServiceLogMonitor):
+    """
+    Exim4 mainlog parser for mails sent on the webserver by system users (e.g. via PHP <tt>mail()</tt>)
+    """
+    model = 'systemusers.SystemUser'
+    verbose_name = _("Exim4 traffic")
+    matcher = 'exim4_matcher(keys)'
+    parse_date = 'parse_iso_date'
+    doc_settings = (settings,
+        ('SYSTEMUSERS_MAIL_LOG_PATH',)
+    )
+    
+    def get_key(self, user):
+        return user.username
+    
+    def get_log_files(self, user):
+        return (settings.SYSTEMUSERS_MAIL_LOG_PATH,)
+
+
+class VsFTPdTraffic(ServiceLogMonitor):
     """
     vsFTPd log parser.
     """
     model = 'systemusers.SystemUser'
-    resource = ServiceMonitor.TRAFFIC
     verbose_name = _('VsFTPd traffic')
-    script_executable = '/usr/bin/python'
-    monthly_sum_old_values = True
+    matcher = 'vsftpd_matcher(keys)'
+    parse_date = 'parse_ctime_date'
     doc_settings = (settings,
         ('SYSTEMUSERS_FTP_LOG_PATH',)
     )
     
-    def prepare(self):
-        vsftplog = settings.SYSTEMUSERS_FTP_LOG_PATH
-        context = {
-            'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'vsftplogs': str((vsftplog, vsftplog+'.1')),
-        }
-        self.append(textwrap.dedent("""\
-            import re
-            import sys
-            from datetime import datetime
-            from dateutil import tz
-            
-            def to_local_timezone(date, tzlocal=tz.tzlocal()):
-                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
-                date = date.replace(tzinfo=tz.tzutc())
-                date = date.astimezone(tzlocal)
-                return date
-            
-            vsftplogs = {vsftplogs}
-            # Use local timezone
-            end_date = to_local_timezone('{current_date}')
-            end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
-            users = {{}}
-            months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
-            months = dict((m, '%02d' % n) for n, m in enumerate(months, 1))
-            
-            def prepare(object_id, username, ini_date):
-                global users
-                ini_date = to_local_timezone(ini_date)
-                ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
-                users[username] = [ini_date, object_id, 0]
-            
-            def monitor(users, end_date, months, vsftplogs):
-                user_regex = re.compile(r'\] \[([^ ]+)\] (OK|FAIL) ')
-                bytes_regex = re.compile(r', ([0-9]+) bytes, ')
-                for vsftplog in vsftplogs:
-                    try:
-                        with open(vsftplog, 'r') as vsftplog:
-                            for line in vsftplog.readlines():
-                                if ' bytes, ' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        user = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        __, month, day, time, year = line.split()[:5]
-                                        date = year + months[month] + day + time.replace(':', '')
-                                        if user[0] < int(date) < end_date:
-                                            bytes = bytes_regex.search(line).groups()[0]
-                                            user[2] += int(bytes)
-                    except IOError as e:
-                        sys.stderr.write(str(e))
-                
-                for username, opts in users.items():
-                    __, object_id, size = opts
-                    print object_id, size
-            """).format(**context)
-        )
-    
-    def monitor(self, user):
-        context = self.get_context(user)
-        self.append("prepare(%(object_id)s, '%(username)s', '%(last_date)s')" % context)
+    def get_key(self, user):
+        return user.username
     
-    def commit(self):
-        self.append('monitor(users, end_date, months, vsftplogs)')
-    
-    def get_context(self, user):
-        context = {
-            'last_date': self.get_last_date(user.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'object_id': user.pk,
-            'username': user.username,
-        }
-        return replace(context, "'", '"')
+    def get_log_files(self, user):
+        return (settings.SYSTEMUSERS_FTP_LOG_PATH,)
@@ -64,3 +64,20 @@ SYSTEMUSERS_FORBIDDEN_PATHS = Setting('SYSTEMUSERS_FORBIDDEN_PATHS',
     help_text=("Exlude ACL operations or home locations on provided globs, relative to user's home.<br>"
                "e.g. ('logs', 'logs/apache*', 'webapps')"),
 )
+
+
+SYSTEMUSERS_BULK_THRESHOLD = Setting('SYSTEMUSERS_BULK_THRESHOLD',
+    100,
+    help_text=("Number of system users saved on a single execution from which the user database "
+               "is updated in a single pass (<tt>newusers</tt>, <tt>chpasswd</tt>) instead of "
+               "user by user.<br><tt>0</tt> disables bulk updates."),
+)
+
+
+SYSTEMUSERS_DISK_QUOTAS = Setting('SYSTEMUSERS_DISK_QUOTAS',
+    ('project', 'user'),
+    help_text=("Filesystem quota reports used by the incremental disk monitor: "
+               "<tt>project</tt> (XFS project quotas of the homes listed on "
+               "<tt>/etc/projects</tt>), preferred over <tt>user</tt> (<tt>repquota</tt>).<br>"
+               "Homes without quota are measured with an incremental <tt>du</tt>."),
+)
@@ -10,6 +10,8 @@ class WebAppServiceMixin(object):
         ('webapps.WebAppOption', 'webapp'),
     )
     directive = None
+    # Webapps are owned by system users
+    dependencies = ('UNIXUserController',)
     doc_settings = (settings,
         ('WEBAPPS_UNDER_CONSTRUCTION_PATH', 'WEBAPPS_MOVE_ON_DELETE_PATH',)
     )
@@ -20,6 +20,7 @@ class PHPController(WebAppServiceMixin, ServiceController):
     
     verbose_name = _("PHP FPM/FCGID")
     default_route_match = "webapp.type.endswith('php')"
+    coalesce = True
     doc_settings = (settings, (
         'WEBAPPS_MERGE_PHP_WEBAPPS',
         'WEBAPPS_FPM_DEFAULT_MAX_CHILDREN',
@@ -79,9 +79,10 @@ class WebApp(models.Model):
     
     def get_path(self):
         path = self.get_base_path()
-        public_root = self.options.filter(name='public-root').first()
-        if public_root:
-            path = os.path.join(path, public_root.value)
+        # Filtered in Python in order to take advantage of prefetched options
+        public_roots = [opt for opt in self.options.all() if opt.name == 'public-root']
+        if public_roots:
+            path = os.path.join(path, public_roots[0].value)
         return os.path.normpath(path.replace('//', '/'))
     
     def get_user(self):
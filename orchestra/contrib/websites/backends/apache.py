@@ -1,17 +1,25 @@
 import os
 import re
 import textwrap
+from functools import lru_cache
 
 from django.template import Template, Context
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceController
-from orchestra.contrib.resources import ServiceMonitor
+from orchestra.contrib.resources import ServiceLogMonitor
 
 from .. import settings
 from ..utils import normurlpath
 
 
+@lru_cache()
+def compile_template(source):
+    """ templates are compiled once per process and rendered for every site """
+    return Template(source)
+
+
 class Apache2Controller(ServiceController):
     """
     Apache &ge;2.4 backend with support for the following directives:
@@ -28,6 +36,9 @@ class Apache2Controller(ServiceController):
         ('webapps.WebApp', 'website_set'),
     )
     verbose_name = _("Apache 2")
+    coalesce = True
+    # Virtual hosts point to FPM pools, FCGID wrappers and uWSGI sockets
+    dependencies = ('PHPController', 'uWSGIPythonController')
     doc_settings = (settings, (
         'WEBSITES_VHOST_EXTRA_DIRECTIVES',
         'WEBSITES_DEFAULT_SSL_CERT',
@@ -37,31 +48,8 @@ class Apache2Controller(ServiceController):
         'WEBSITES_DEFAULT_IPS',
         'WEBSITES_SAAS_DIRECTIVES',
     ))
-    
-    def get_extra_conf(self, site, context, ssl=False):
-        extra_conf = self.get_content_directives(site, context)
-        directives = site.get_directives()
-        if ssl:
-            extra_conf += self.get_ssl(directives)
-        extra_conf += self.get_security(directives)
-        extra_conf += self.get_redirects(directives)
-        extra_conf += self.get_proxies(directives)
-        extra_conf += self.get_saas(directives)
-        settings_context = site.get_settings_context()
-        for location, directive in settings.WEBSITES_VHOST_EXTRA_DIRECTIVES:
-            extra_conf.append((location, directive % settings_context))
-        # Order extra conf directives based on directives (longer first)
-        extra_conf = sorted(extra_conf, key=lambda a: len(a[0]), reverse=True)
-        return '\n'.join([conf for location, conf in extra_conf])
-    
-    def render_virtual_host(self, site, context, ssl=False):
-        context.update({
-            'port': self.HTTPS_PORT if ssl else self.HTTP_PORT,
-            'vhost_set_fcgid': False,
-            'server_alias_lines': ' \\\n                '.join(context['server_alias'])
-        })
-        context['extra_conf'] = self.get_extra_conf(site, context, ssl)
-        return Template(textwrap.dedent("""\
+    AGENT_RELOAD = "service apache2 status > /dev/null && service apache2 reload || service apache2 start"
+    VIRTUAL_HOST_TEMPLATE = textwrap.dedent("""\
             <VirtualHost{% for ip in ips %} {{ ip }}:{{ port }}{% endfor %}>
                 IncludeOptional /etc/apache2/site[s]-override/{{ site_unique_name }}.con[f]
                 ServerName {{ server_name }}\
@@ -76,11 +64,7 @@ class Apache2Controller(ServiceController):
                 {{ line | safe }}{% endfor %}
             </VirtualHost>
             """)
-        ).render(Context(context))
-    
-    def render_redirect_https(self, context):
-        context['port'] = self.HTTP_PORT
-        return Template(textwrap.dedent("""
+    REDIRECT_HTTPS_TEMPLATE = textwrap.dedent("""
             <VirtualHost{% for ip in ips %} {{ ip }}:{{ port }}{% endfor %}>
                 ServerName {{ server_name }}\
             {% if server_alias %}
@@ -94,19 +78,107 @@ class Apache2Controller(ServiceController):
                 RewriteRule (.*) https://%{HTTP_HOST}%{REQUEST_URI}
             </VirtualHost>
             """)
-        ).render(Context(context))
+    
+    def get_extra_conf(self, site, context, ssl=False):
+        extra_conf = self.get_content_directives(site, context)
+        directives = site.get_directives()
+        if ssl:
+            extra_conf += self.get_ssl(directives)
+        extra_conf += self.get_security(directives)
+        extra_conf += self.get_redirects(directives)
+        extra_conf += self.get_proxies(directives)
+        extra_conf += self.get_saas(directives)
+        settings_context = site.get_settings_context()
+        for location, directive in settings.WEBSITES_VHOST_EXTRA_DIRECTIVES:
+            extra_conf.append((location, directive % settings_context))
+        # Order extra conf directives based on directives (longer first)
+        extra_conf = sorted(extra_conf, key=lambda a: len(a[0]), reverse=True)
+        return '\n'.join([conf for location, conf in extra_conf])
+    
+    def render_virtual_host(self, site, context, ssl=False):
+        context.update({
+            'port': self.HTTPS_PORT if ssl else self.HTTP_PORT,
+            'vhost_set_fcgid': False,
+            'server_alias_lines': ' \\\n                '.join(context['server_alias'])
+        })
+        context['extra_conf'] = self.get_extra_conf(site, context, ssl)
+        return compile_template(self.VIRTUAL_HOST_TEMPLATE).render(Context(context))
+    
+    def render_redirect_https(self, context):
+        context['port'] = self.HTTP_PORT
+        return compile_template(self.REDIRECT_HTTPS_TEMPLATE).render(Context(context))
+    
+    def render_site(self, site, context):
+        apache_conf = '# %(banner)s\n' % context
+        if site.protocol in (site.HTTP, site.HTTP_AND_HTTPS):
+            apache_conf += self.render_virtual_host(site, context, ssl=False)
+        if site.protocol in (site.HTTP_AND_HTTPS, site.HTTPS_ONLY, site.HTTPS):
+            apache_conf += self.render_virtual_host(site, context, ssl=True)
+        if site.protocol == site.HTTPS_ONLY:
+            apache_conf += self.render_redirect_https(context)
+        return apache_conf.strip()
+    
+    @classmethod
+    def prefetch(cls, queryset):
+        """ loads in bulk all the related objects needed for rendering the sites """
+        return queryset.select_related('account__main_systemuser').prefetch_related(
+            'domains',
+            'directives',
+            'content_set__webapp__options',
+            'content_set__webapp__account__main_systemuser',
+        )
+    
+    def save_state(self, site, context):
+        """ orchestra-agent declarative counterpart of save() """
+        if context['server_name']:
+            self.append({
+                'type': 'file',
+                'path': context['sites_available'],
+                'content': self.render_site(site, context) + '\n',
+                'reload': self.AGENT_RELOAD,
+            })
+        if context['server_name'] and site.active:
+            self.append({
+                'type': 'symlink',
+                'path': context['sites_enabled'],
+                'target': '../sites-available/%s.conf' % context['site_unique_name'],
+                'reload': self.AGENT_RELOAD,
+            })
+        else:
+            self.append({
+                'type': 'absent',
+                'path': context['sites_enabled'],
+                'reload': self.AGENT_RELOAD,
+            })
+    
+    def get_inputs(self, site, context):
+        """ everything the site configuration depends on, see is_unchanged() """
+        contents = []
+        for content in site.content_set.all():
+            webapp = content.webapp
+            contents.append(
+                (content.path, webapp.type, webapp.name, webapp.get_path(), webapp.get_directive())
+            )
+        return {
+            'context': {key: value for key, value in context.items() if key not in ('site', 'banner')},
+            'protocol': site.protocol,
+            'active': site.active,
+            'directives': site.get_directives(),
+            'contents': contents,
+            'settings_context': site.get_settings_context(),
+            'settings': [getattr(settings, name) for name in self.doc_settings[1]],
+            'templates': [self.VIRTUAL_HOST_TEMPLATE, self.REDIRECT_HTTPS_TEMPLATE],
+            'agent': self.is_agent_enabled(),
+        }
     
     def save(self, site):
         context = self.get_context(site)
+        if self.is_unchanged(context['sites_available'], self.get_inputs(site, context)):
+            return
+        if self.is_agent_enabled():
+            return self.save_state(site, context)
         if context['server_name']:
-            apache_conf = '# %(banner)s\n' % context
-            if site.protocol in (site.HTTP, site.HTTP_AND_HTTPS):
-                apache_conf += self.render_virtual_host(site, context, ssl=False)
-            if site.protocol in (site.HTTP_AND_HTTPS, site.HTTPS_ONLY, site.HTTPS):
-                apache_conf += self.render_virtual_host(site, context, ssl=True)
-            if site.protocol == site.HTTPS_ONLY:
-                apache_conf += self.render_redirect_https(context)
-            context['apache_conf'] = apache_conf.strip()
+            context['apache_conf'] = self.render_site(site, context)
             self.append(textwrap.dedent("""
                 # Generate Apache config for site %(site_name)s
                 read -r -d '' apache_conf << 'EOF' || true
@@ -132,8 +204,19 @@ class Apache2Controller(ServiceController):
                 """) % context
             )
     
+    def delete_state(self, site, context):
+        for path in (context['sites_enabled'], context['sites_available']):
+            self.append({
+                'type': 'absent',
+                'path': path,
+                'reload': self.AGENT_RELOAD,
+            })
+    
     def delete(self, site):
         context = self.get_context(site)
+        self.forget_content(context['sites_available'])
+        if self.is_agent_enabled():
+            return self.delete_state(site, context)
         self.append(textwrap.dedent("""
             # Remove site configuration for %(site_name)s
             [[ $(a2dissite %(site_unique_name)s) =~ "already disabled" ]] || UPDATED_APACHE=1
@@ -142,6 +225,9 @@ class Apache2Controller(ServiceController):
         )
     
     def prepare(self):
+        if self.is_agent_enabled():
+            # orchestra-agent coalesces reloads by itself
+            return
         super(Apache2Controller, self).prepare()
         # Coordinate apache restart with php backend in order not to overdo it
         self.append(textwrap.dedent("""
@@ -187,6 +273,8 @@ class Apache2Controller(ServiceController):
     
     def commit(self):
         """ reload Apache2 if necessary """
+        if self.is_agent_enabled():
+            return
         self.append("coordinate_apache_reload")
         super(Apache2Controller, self).commit()
     
@@ -383,35 +471,47 @@ class Apache2Controller(ServiceController):
     def get_server_names(self, site):
         server_name = None
         server_alias = []
-        for domain in site.domains.all().order_by('name'):
+        # Sorted in Python in order to take advantage of prefetched domains
+        for domain in sorted(site.domains.all(), key=lambda d: d.name):
             if not server_name and not domain.name.startswith('*'):
                 server_name = domain.name
             else:
                 server_alias.append(domain.name)
         return server_name, server_alias
     
-    def get_context(self, site):
+    @cached_property
+    def shared_context(self):
+        """ context shared by all the sites rendered by this backend instance """
         base_apache_conf = settings.WEBSITES_BASE_APACHE_CONF
-        sites_available = os.path.join(base_apache_conf, 'sites-available')
-        sites_enabled = os.path.join(base_apache_conf, 'sites-enabled')
+        context = {
+            'ips': settings.WEBSITES_DEFAULT_IPS,
+            'sites_available_dir': os.path.join(base_apache_conf, 'sites-available'),
+            'sites_enabled_dir': os.path.join(base_apache_conf, 'sites-enabled'),
+            'banner': self.get_banner(),
+        }
+        if not context['ips']:
+            raise ValueError("WEBSITES_DEFAULT_IPS is empty.")
+        return context
+    
+    def get_context(self, site):
+        shared_context = self.shared_context
         server_name, server_alias = self.get_server_names(site)
+        unique_name = site.unique_name
         context = {
             'site': site,
             'site_name': site.name,
-            'ips': settings.WEBSITES_DEFAULT_IPS,
-            'site_unique_name': site.unique_name,
+            'ips': shared_context['ips'],
+            'site_unique_name': unique_name,
             'user': self.get_username(site),
             'group': self.get_groupname(site),
             'server_name': server_name,
             'server_alias': server_alias,
-            'sites_enabled': "%s.conf" % os.path.join(sites_enabled, site.unique_name),
-            'sites_available': "%s.conf" % os.path.join(sites_available, site.unique_name),
+            'sites_enabled': "%s.conf" % os.path.join(shared_context['sites_enabled_dir'], unique_name),
+            'sites_available': "%s.conf" % os.path.join(shared_context['sites_available_dir'], unique_name),
             'access_log': site.get_www_access_log_path(),
             'error_log': site.get_www_error_log_path(),
-            'banner': self.get_banner(),
+            'banner': shared_context['banner'],
         }
-        if not context['ips']:
-            raise ValueError("WEBSITES_DEFAULT_IPS is empty.")
         return context
     
     def set_content_context(self, content, context):
@@ -424,74 +524,26 @@ class Apache2Controller(ServiceController):
         context.update(content_context)
 
 
-class Apache2Traffic(ServiceMonitor):
+class Apache2Traffic(ServiceLogMonitor):
     """
     Parses apache logs,
     looking for the size of each request on the last word of the log line.
+    Only the lines appended since the previous run are read, following log rotations.
     """
     model = 'websites.Website'
-    resource = ServiceMonitor.TRAFFIC
     verbose_name = _("Apache 2 Traffic")
-    monthly_sum_old_values = True
+    matcher = 'last_field_int(keys)'
+    parse_date = 'parse_clf_date'
+    shared_logs = False
     doc_settings = (settings,
         ('WEBSITES_TRAFFIC_IGNORE_HOSTS',)
     )
     
-    def prepare(self):
-        super(Apache2Traffic, self).prepare()
-        ignore_hosts = '\\|'.join(settings.WEBSITES_TRAFFIC_IGNORE_HOSTS)
-        context = {
-            'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'ignore_hosts': '-v "%s"' % ignore_hosts if ignore_hosts else '',
-        }
-        self.append(textwrap.dedent("""\
-            function monitor () {
-                OBJECT_ID=$1
-                INI_DATE=$(date "+%%Y%%m%%d%%H%%M%%S" -d "$2")
-                END_DATE=$(date '+%%Y%%m%%d%%H%%M%%S' -d '%(current_date)s')
-                LOG_FILE="$3"
-                {
-                    { grep %(ignore_hosts)s ${LOG_FILE} || echo -e '\\r'; } \\
-                        | awk -v ini="${INI_DATE}" -v end="${END_DATE}" '
-                            BEGIN {
-                                sum = 0
-                                months["Jan"] = "01"
-                                months["Feb"] = "02"
-                                months["Mar"] = "03"
-                                months["Apr"] = "04"
-                                months["May"] = "05"
-                                months["Jun"] = "06"
-                                months["Jul"] = "07"
-                                months["Aug"] = "08"
-                                months["Sep"] = "09"
-                                months["Oct"] = "10"
-                                months["Nov"] = "11"
-                                months["Dec"] = "12"
-                            } {
-                                # date = [11/Jul/2014:13:50:41
-                                date = substr($4, 2)
-                                year = substr(date, 8, 4)
-                                month = months[substr(date, 4, 3)];
-                                day = substr(date, 1, 2)
-                                hour = substr(date, 13, 2)
-                                minute = substr(date, 16, 2)
-                                second = substr(date, 19, 2)
-                                line_date = year month day hour minute second
-                                if ( line_date > ini && line_date < end)
-                                    sum += $NF
-                            } END {
-                                print sum
-                            }' || [[ $? == 1 ]] && true
-                } | xargs echo ${OBJECT_ID}
-            }""") % context)
-    
-    def monitor(self, site):
-        context = self.get_context(site)
-        self.append('monitor {object_id} "{last_date}" {log_file}'.format(**context))
+    def get_exclude_hosts(self):
+        return settings.WEBSITES_TRAFFIC_IGNORE_HOSTS
     
-    def get_context(self, site):
-        return {
-            'log_file': '%s{,.1}' % site.get_www_access_log_path(),
-            'last_date': self.get_last_date(site.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'object_id': site.pk,
-        }
+    def get_key(self, site):
+        return site.pk
+    
+    def get_log_files(self, site):
+        return (site.get_www_access_log_path(),)
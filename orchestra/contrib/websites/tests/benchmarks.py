@@ -0,0 +1,123 @@
+"""
+Apache2Controller virtual host rendering benchmark
+
+    python3 manage.py shell -c "from orchestra.contrib.websites.tests.benchmarks import run; run()"
+
+Sites are in-memory objects, what is being measured is configuration rendering
+with templates compiled on every site (legacy behaviour) and compiled once per process.
+"""
+import time
+from collections import OrderedDict
+
+from ..backends.apache import Apache2Controller, compile_template
+
+
+class Manager(object):
+    def __init__(self, objects):
+        self.objects = objects
+    
+    def all(self):
+        return self.objects
+
+
+class Domain(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class WebApp(object):
+    type = 'static'
+    
+    def __init__(self, name, home):
+        self.name = name
+        self.path = '%s/webapps/%s' % (home, name)
+    
+    def get_path(self):
+        return self.path
+    
+    def get_directive(self):
+        return ('static', self.path)
+
+
+class Content(object):
+    def __init__(self, webapp, path):
+        self.webapp = webapp
+        self.path = path
+
+
+class Website(object):
+    HTTP = 'http'
+    HTTPS = 'https'
+    HTTP_AND_HTTPS = 'http/https'
+    HTTPS_ONLY = 'https-only'
+    
+    def __init__(self, num, protocol):
+        self.id = self.pk = num
+        self.name = 'site%i' % num
+        self.protocol = protocol
+        self.active = True
+        self.username = 'user%i' % (num//10)
+        self.home = '/home/%s' % self.username
+        self.domains = Manager([
+            Domain('www.%s.example.org' % self.name),
+            Domain('%s.example.org' % self.name),
+        ])
+        self.content_set = Manager([
+            Content(WebApp('static%i' % num, self.home), '/'),
+            Content(WebApp('media%i' % num, self.home), '/media'),
+        ])
+        self.directives = OrderedDict((
+            ('redirect', ['/old /new']),
+            ('proxy', ['/api http://127.0.0.1:8000/api']),
+        ))
+        self.unique_name = '%s-%s' % (self.username, self.name)
+    
+    def get_directives(self):
+        return self.directives
+    
+    def get_settings_context(self):
+        return {
+            'id': self.id,
+            'pk': self.pk,
+            'home': self.home,
+            'user': self.username,
+            'group': self.username,
+            'site_name': self.name,
+            'protocol': self.protocol,
+        }
+    
+    def get_username(self):
+        return self.username
+    
+    def get_groupname(self):
+        return self.username
+    
+    def get_www_access_log_path(self):
+        return '/var/log/apache2/virtual/%s.log' % self.unique_name
+    
+    def get_www_error_log_path(self):
+        return '/var/log/apache2/virtual/%s.error.log' % self.unique_name
+
+
+def get_sites(num):
+    protocols = (Website.HTTP, Website.HTTP_AND_HTTPS, Website.HTTPS_ONLY, Website.HTTPS)
+    return [Website(ix, protocols[ix % len(protocols)]) for ix in range(num)]
+
+
+def render(sites, precompiled):
+    backend = Apache2Controller()
+    start = time.time()
+    for site in sites:
+        if not precompiled:
+            compile_template.cache_clear()
+        backend.render_site(site, backend.get_context(site))
+    return time.time() - start
+
+
+def run(num=10000):
+    sites = get_sites(num)
+    legacy = render(sites, precompiled=False)
+    print("Compiled per site:  %.2fs (%.0f vhosts/s)" % (legacy, num/legacy))
+    precompiled = render(sites, precompiled=True)
+    print("Compiled once:      %.2fs (%.0f vhosts/s)" % (precompiled, num/precompiled))
+    print("Speedup:            %.2fx" % (legacy/precompiled))
@@ -105,3 +105,27 @@ def pairwise(iterable):
     a, b = tee(iterable)
     next(b, None)
     return zip(a, b)
+
+
+def toposort(items, get_dependencies):
+    """
+    Stable topological sort: items keep their original order unless a dependency requires otherwise
+    returns (sorted_items, cyclic_items)
+    """
+    pending = collections.OrderedDict()
+    for item in items:
+        pending[item] = None
+    for item in pending:
+        pending[item] = [dep for dep in get_dependencies(item) if dep in pending and dep != item]
+    ordered = []
+    done = set()
+    progress = True
+    while pending and progress:
+        progress = False
+        for item, dependencies in list(pending.items()):
+            if all(dep in done for dep in dependencies):
+                ordered.append(item)
+                done.add(item)
+                pending.pop(item)
+                progress = True
+    return ordered, list(pending)
@@ -30,6 +30,7 @@ setup(
     include_package_data = True,
     scripts=[
         'orchestra/bin/orchestra-admin',
+        'orchestra/bin/orchestra-agent',
         'orchestra/bin/orchestra-beat',
     ],
     packages = packages,